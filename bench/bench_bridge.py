@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# Benchmark: Modbus TCP bridge under many concurrent masters
+# The Modbus slave is started in a child process with the twisted reactor
+# (events written from a separate thread, as by the paho network thread) or
+# on a single asyncio event loop (events written by a task on the same
+# loop). Events are fed at a fixed rate while N masters poll the whole
+# register view (0x04) back to back; requests/s and latency percentiles are
+# reported per server and master count.
+# Requires pymodbus (twisted for the twisted server, pyserial-asyncio for
+# the asyncio server).
+
+import asyncio
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+logger_name = "modbus_mqtt"
+port = 5021
+event_rate = 2000
+duration = 3
+masters = (1, 16, 64, 256)
+
+def make_config():
+    from common.config import compile_config, modbus_schema
+    return compile_config({
+        "modbus": {"listen_addr": "127.0.0.1", "port": port},
+        "queue": {
+            "host": "localhost",
+            "port": 1883,
+            "client_name": "modbus",
+            "queues": {
+                "events": "myhome/paradox/events",
+                "requests": "myhome/paradox/requests",
+                "responses": "myhome/paradox/responses",
+                "broadcasts": "myhome/paradox/broadcasts"
+            }
+        }
+    }, modbus_schema)
+
+# Zone events as delivered by the MQTT client
+def event_stream(prefix):
+    import paho.mqtt.client as mqtt
+    stream = []
+    for i in range(1000):
+        zone = (i * 7) % 192 + 1
+        msg = mqtt.MQTTMessage(topic = ("%s/zone/%d" % (prefix, zone)).encode("utf-8"))
+        msg.payload = json.dumps({"type": "zone", "data": {"id": zone, "open": bool(i & 1)}}).encode("utf-8")
+        stream.append(msg)
+    return stream
+
+# Child process: Modbus slave with an event feeder
+def serve(kind):
+    from modbus.modbus_slave import Modbus
+    from modbus.event_router import EventRouter
+    logging.getLogger(logger_name).setLevel(logging.WARNING)
+    logging.getLogger("pymodbus").setLevel(logging.ERROR)
+    config = make_config()
+    modbus = Modbus(config, None)
+    router = EventRouter(config, modbus, logger_name)
+    stream = event_stream(config.topics.events)
+
+    if kind == "twisted":
+        def feed():
+            i = 0
+            while True:
+                router.dispatch(None, stream[i % len(stream)])
+                i += 1
+                time.sleep(1.0 / event_rate)
+        threading.Thread(target = feed, daemon = True).start()
+        modbus.loop()
+    else:
+        async def feed():
+            i = 0
+            while True:
+                router.dispatch(None, stream[i % len(stream)])
+                i += 1
+                await asyncio.sleep(1.0 / event_rate)
+        async def main():
+            asyncio.get_running_loop().create_task(feed())
+            await modbus.serve()
+        asyncio.run(main())
+
+# One master: 0x04 read of the whole register view, back to back
+async def master(unit, count, deadline, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    tid = 0
+    while time.perf_counter() < deadline:
+        tid = (tid + 1) & 0xffff
+        start = time.perf_counter()
+        writer.write(struct.pack(">HHHBBHH", tid, 0, 6, unit, 4, 0, count))
+        header = await reader.readexactly(7)
+        await reader.readexactly(struct.unpack(">H", header[4:6])[0] - 1)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+async def poll(count, size):
+    latencies = []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[master(1, size, deadline, latencies) for i in range(count)])
+    latencies.sort()
+    return len(latencies) / duration, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+def run(kind, size):
+    import subprocess
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", kind])
+    try:
+        time.sleep(1.5)
+        print("%s server" % (kind))
+        for count in masters:
+            rate, p50, p99 = asyncio.run(poll(count, size))
+            print("  %4d masters %9.0f req/s   p50 %7.2f ms   p99 %7.2f ms" % (count, rate, p50 * 1000, p99 * 1000))
+    finally:
+        server.kill()
+        server.wait()
+
+def main():
+    from common.config import modbus_zone_map, modbus_area_map
+    from modbus.datastore import RegisterMap, BitmapDataBlock, BitmapRegisterBlock
+    register_map = RegisterMap(modbus_zone_map, modbus_area_map, 192, 8)
+    size = BitmapRegisterBlock(1, BitmapDataBlock(1, register_map.size), register_map).size
+    print("0x04 read of %d registers, %d events/s, %d s per run" % (size, event_rate, duration))
+    for kind in ("twisted", "asyncio"):
+        run(kind, size)
+
+if __name__ == "__main__":
+    if (len(sys.argv) == 3) and (sys.argv[1] == "--serve"):
+        serve(sys.argv[2])
+    else:
+        main()
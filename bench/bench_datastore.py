@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Benchmark: server side handling of a whole-map discrete input poll
+# A SCADA master reads the complete zone / area map (0x02) every 100 ms;
+# the request is executed against the slave context and the response
+# encoded, for the former sequential data block (one list item per input)
+# and for the bitmap data block with and without the packed read request.
+# The same state is also read as packed input registers (0x04) in one
+# request, against the 0x02 reads of 100 inputs a master issued before.
+# Requires pymodbus.
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext
+from pymodbus.bit_read_message import ReadDiscreteInputsRequest
+from pymodbus.register_read_message import ReadInputRegistersRequest
+from common.config import modbus_zone_map, modbus_area_map
+from modbus.datastore import RegisterMap, BitmapDataBlock, BitmapRegisterBlock, BitmapReadDiscreteInputsRequest
+
+def poll(context, request_class, count, rounds, chunk = None):
+    chunk = chunk or count
+    requests = [request_class(address, min(chunk, count - address)) for address in range(0, count, chunk)]
+    start = time.perf_counter()
+    for i in range(rounds):
+        for request in requests:
+            request.execute(context).encode()
+    return (time.perf_counter() - start) / rounds
+
+def main():
+    register_map = RegisterMap(modbus_zone_map, modbus_area_map, 192, 8)
+    size = register_map.size
+    values = [random.random() < 0.3 for i in range(size)]
+
+    sequential = ModbusSequentialDataBlock(1, values)
+    bitmap = BitmapDataBlock(1, size)
+    bitmap.setValues(1, values)
+    registers = BitmapRegisterBlock(1, bitmap, register_map)
+
+    rounds = 5000
+    results = (
+        ("sequential block", poll(ModbusSlaveContext(di = sequential), ReadDiscreteInputsRequest, size, rounds)),
+        ("bitmap block", poll(ModbusSlaveContext(di = bitmap), ReadDiscreteInputsRequest, size, rounds)),
+        ("bitmap, packed read", poll(ModbusSlaveContext(di = bitmap), BitmapReadDiscreteInputsRequest, size, rounds))
+    )
+    print("Whole map poll (%d discrete inputs), execute + encode:" % (size))
+    for name, elapsed in results:
+        print("  %-20s %8.1f us" % (name, elapsed * 1e6))
+
+    results = (
+        ("%d x 0x02 reads" % ((size + 99) // 100), poll(ModbusSlaveContext(di = sequential), ReadDiscreteInputsRequest, size, rounds, 100)),
+        ("1 x 0x04 read", poll(ModbusSlaveContext(di = bitmap, ir = registers), ReadInputRegistersRequest, registers.size, rounds))
+    )
+    print("Whole state as %d input registers:" % (registers.size))
+    for name, elapsed in results:
+        print("  %-20s %8.1f us" % (name, elapsed * 1e6))
+
+if __name__ == "__main__":
+    main()
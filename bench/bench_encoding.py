@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# Microbenchmark: event / state encoding
+# Compares json.dumps() of payloads built from getData() with the cached
+# entity fragments, and JSON state messages with the compact binary state
+# records (encodings/sec and message size)
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from paradox.objects import PRT_Zone, PRT_User
+from paradox.payload import encode_event, has_fragment
+from paradox.store import StateStore
+from common.binary import encode_state, decode_state, zone_fields
+
+store = StateStore(192, zone_fields)
+zone = PRT_Zone(5, store)
+zone.name = "Living room PIR"
+zone.update({"open": True, "tamper": False, "fire": False, "alarm": False, "fire_alarm": False, "supervision_lost": False, "low_battery": False})
+user = PRT_User(7)
+user.name = "Front door keypad"
+
+def stale_json():
+    return json.dumps({"type": "zone", "event": "snapshot", "area": None, "data": zone.getData(), "version": 1, "timestamp": 0.0, "stale": True})
+
+def stale_fragment():
+    return encode_event({"type": "zone", "event": "snapshot", "area": None, "data": zone.getFragment(), "version": 1, "timestamp": 0.0, "stale": True})
+
+def arming_json():
+    return json.dumps({"type": "arm", "source": "usercode", "area": 1, "user": user.getData()})
+
+def arming_fragment():
+    return encode_event({"type": "arm", "source": "usercode", "area": 1, "user": user.getFragment()})
+
+# Events without fragments are sent with json.dumps() (see has_fragment)
+delta = {"type": "zone", "event": "open", "area": 1, "data": {"id": 5, "open": True}, "version": 3, "timestamp": 0.0, "stale": False}
+
+def delta_json():
+    return json.dumps(delta)
+
+def delta_encode():
+    return encode_event(delta) if has_fragment(delta) else json.dumps(delta)
+
+def state_json():
+    state = zone.getData()
+    state["version"] = zone.version
+    state["stale"] = False
+    return json.dumps(state, separators = (",", ":"))
+
+def state_binary():
+    state = zone.getData()
+    state["version"] = zone.version
+    state["stale"] = False
+    return encode_state("zone", zone.id, state, 0.0)
+
+def run(name, func, rounds):
+    start = time.time()
+    for _ in range(rounds):
+        data = func()
+    elapsed = time.time() - start
+    rate = rounds / elapsed
+    print("%-16s %12.0f /sec %6d bytes" % (name, rate, len(data)))
+    return rate
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    assert json.loads(stale_json()) == json.loads(stale_fragment())
+    assert json.loads(arming_json()) == json.loads(arming_fragment())
+    assert decode_state(state_binary())[1]["open"] == True
+
+    for before, after in ((stale_json, stale_fragment), (arming_json, arming_fragment), (delta_json, delta_encode), (state_json, state_binary)):
+        rate_before = run(before.__name__, before, rounds)
+        rate_after = run(after.__name__, after, rounds)
+        print("speedup          %12.2fx" % (rate_after / rate_before))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Microbenchmark: line framing of PRT3 serial input
+# Compares the original string buffer (concatenate + split on every read)
+# with LineFramer for bursts delivered in chunks of various sizes
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from paradox.framing import LineFramer
+
+# Line noise without any delimiter followed by a single line (eg. wrong
+# speed or a stuck device); the buffer grows until the delimiter arrives
+noise = b"x" * 65536 + b"\r"
+
+# Full zone status sweep (192 RZ replies) interleaved with G-events
+burst = b"".join(b"RZ%03dCOOOO\rG000N%03dA001\r" % (i, i) for i in range(1, 193))
+
+def frame_string(chunks):
+    buffer = ""
+    count = 0
+    for chunk in chunks:
+        buf = chunk.decode("ascii", "replace")
+        buffer = buffer + buf
+        if '\r' in buffer:
+            command = buffer.split('\r')
+            for x in range(0, len(command)-1):
+                count += 1
+            buffer = command[-1]
+    return count
+
+def frame_framer(chunks):
+    framer = LineFramer()
+    count = 0
+    for chunk in chunks:
+        framer.feed(chunk)
+        for frame in framer.frames():
+            str(frame, "ascii", "replace")
+            count += 1
+    return count
+
+def frame_lines(chunks):
+    framer = LineFramer()
+    count = 0
+    for chunk in chunks:
+        framer.feed(chunk)
+        for line in framer.lines():
+            count += 1
+    return count
+
+def run(name, func, chunks, rounds):
+    start = time.time()
+    for _ in range(rounds):
+        lines = func(chunks)
+    elapsed = time.time() - start
+    print("  %-8s %10.0f lines/sec  %8.2f ms/round" % (name, (lines * rounds) / elapsed, elapsed * 1000 / rounds))
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    for chunk_size in (1, 16, 256, 4096, len(burst)):
+        chunks = [burst[i:i+chunk_size] for i in range(0, len(burst), chunk_size)]
+        print("%d byte burst, %d byte chunks" % (len(burst), chunk_size))
+        run("string", frame_string, chunks, rounds)
+        run("frames", frame_framer, chunks, rounds)
+        run("lines", frame_lines, chunks, rounds)
+
+    for chunk_size in (16, 64):
+        chunks = [noise[i:i+chunk_size] for i in range(0, len(noise), chunk_size)]
+        print("%d byte noise, %d byte chunks" % (len(noise), chunk_size))
+        run("string", frame_string, chunks, 1)
+        run("frames", frame_framer, chunks, 1)
+        run("lines", frame_lines, chunks, 1)
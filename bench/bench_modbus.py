@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# Benchmark: replayed event stream through modbus_mqtt (events/sec)
+# A recorded-style stream of zone events is fed to the Modbus slave data
+# block twice: through the former per-message path (topic regexes, one
+# setValues call per field) and through the EventRouter (topic trie,
+# contiguous setValues per message).
+# Requires pymodbus.
+
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import paho.mqtt.client as mqtt
+from common.config import compile_config, modbus_schema
+from modbus.modbus_slave import Modbus
+from modbus.event_router import EventRouter
+
+logger_name = "modbus_mqtt"
+
+def make_config():
+    return compile_config({
+        "modbus": {"listen_addr": "127.0.0.1", "port": 5020},
+        "queue": {
+            "host": "localhost",
+            "port": 1883,
+            "client_name": "modbus",
+            "queues": {
+                "events": "myhome/paradox/events",
+                "requests": "myhome/paradox/requests",
+                "responses": "myhome/paradox/responses",
+                "broadcasts": "myhome/paradox/broadcasts",
+                "state": "myhome/paradox/state"
+            }
+        }
+    }, modbus_schema)
+
+def message(topic, payload):
+    msg = mqtt.MQTTMessage(topic = topic.encode("utf-8"))
+    msg.payload = json.dumps(payload).encode("utf-8")
+    return msg
+
+# Zone delta events as published by prt3_mqtt: zone n opens / closes,
+# every 8th event also changes tamper
+def zone_events(count):
+    events = []
+    for i in range(count):
+        zone = (i * 7) % 192 + 1
+        data = {"id": zone, "open": bool(i & 1)}
+        if i % 8 == 0:
+            data["tamper"] = bool(i & 2)
+        events.append(("zone/%d" % (zone), {"type": "zone", "event": "update", "area": 1, "data": data, "version": i, "timestamp": 0.0, "stale": False}))
+    return events
+
+def single_stream(events, prefix):
+    return [message(prefix + "/" + topic, event) for topic, event in events]
+
+def batch_stream(events, prefix, size):
+    stream = []
+    for i in range(0, len(events), size):
+        items = [{"topic": topic, "event": event} for topic, event in events[i:i + size]]
+        stream.append(message(prefix + "/zone/batch", {"type": "batch", "family": "zone", "events": items}))
+    return stream
+
+def snapshot_stream(rounds, topic):
+    zones = dict((str(zone), {"id": zone, "name": "Zone %d" % (zone), "open": bool(zone & 1), "tamper": False}) for zone in range(1, 193))
+    return [message(topic, {"timestamp": 0.0, "zone": zones})] * rounds
+
+# Former modbus_mqtt callback: topic regexes, data block written per field
+def regex_path(modbus, prefix, snapshot_topic):
+    topic_event_regex = re.compile("^" + re.escape(prefix) + "/([^/]+)/([0-9]+)$")
+    topic_batch_regex = re.compile("^" + re.escape(prefix) + "/[^/]+/batch$")
+    item_topic_regex = re.compile("^([^/]+)/([0-9]+)$")
+
+    def callback(msg):
+        message_data = json.loads(msg.payload)
+        rx = topic_event_regex.match(msg.topic)
+        if rx:
+            modbus.process_queue_event(rx.group(1), rx.group(2), message_data)
+            modbus.flush()
+        elif topic_batch_regex.match(msg.topic):
+            for item in message_data["events"]:
+                rx = item_topic_regex.match(item["topic"] or "")
+                if rx:
+                    modbus.process_queue_event(rx.group(1), rx.group(2), item["event"])
+                    modbus.flush()
+        elif msg.topic == snapshot_topic:
+            for zone in message_data.get("zone", {}).values():
+                modbus.process_queue_event("zone", zone["id"], {"data": zone})
+                modbus.flush()
+    return callback
+
+def router_path(router):
+    return lambda msg: router.dispatch(None, msg)
+
+def run(name, deliver, stream, events):
+    start = time.perf_counter()
+    for msg in stream:
+        deliver(msg)
+    elapsed = time.perf_counter() - start
+    print("  %-8s %9.0f events/s" % (name, events / elapsed))
+    return elapsed
+
+def main():
+    logging.getLogger(logger_name).setLevel(logging.WARNING)
+    config = make_config()
+    prefix = config.topics.events
+    snapshot_topic = config.topics.state + "/snapshot"
+
+    modbus = Modbus(config, None)
+    router = EventRouter(config, modbus, logger_name)
+    old = regex_path(modbus, prefix, snapshot_topic)
+    new = router_path(router)
+
+    count = 50000
+    events = zone_events(count)
+    scenarios = (
+        ("single zone events", single_stream(events, prefix), count),
+        ("batches of 64", batch_stream(events, prefix, 64), count),
+        ("192-zone snapshots", snapshot_stream(200, snapshot_topic), 200 * 192)
+    )
+    for title, stream, total in scenarios:
+        print("%s (%d events)" % (title, total))
+        before = run("regex", old, stream, total)
+        after = run("router", new, stream, total)
+        print("  speedup  %9.2fx" % (before / after))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Benchmark: full panel_sync sweep in asyncio mode with pipelined commands
+# A simulated panel on a pty answers every command after a fixed latency
+# (serial turnaround + panel processing) while still accepting new commands;
+# the sweep time is measured for several pipeline depths together with the
+# latency of a panic command submitted in the middle of the sweep
+
+import asyncio
+import logging
+import os
+import pty
+import sys
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from paradox.prt3_async import AsyncPRT
+from paradox.commands import PRIORITY_PANIC
+
+def panel(fd, latency):
+    lock = threading.Lock()
+    def reply(line):
+        if line[:1] == "P":
+            data = "%s&ok\r" % (line[:5])
+        elif line[:2] == "RZ":
+            data = "%sCOOOO\r" % (line[:5])
+        elif line[:2] == "RA":
+            data = "%sDOOOOOO\r" % (line[:5])
+        else:
+            data = "%s%-16s\r" % (line[:5], "Label " + line[2:5])
+        with lock:
+            os.write(fd, data.encode("ascii"))
+
+    buf = b""
+    while True:
+        try:
+            data = os.read(fd, 1024)
+        except OSError:
+            return
+        buf += data
+        while b"\r" in buf:
+            line, buf = buf.split(b"\r", 1)
+            threading.Timer(latency, reply, (line.decode("ascii"),)).start()
+
+def make_config(port, depth):
+    return {
+        "prt3": {
+            "port": port,
+            "speed": 57600,
+            "pipeline": {"depth": depth, "timeout": 5},
+            "refresh": {"area": 1, "zone": 2, "user": 5, "names": 10}
+        },
+        "panel": {
+            "type": "EVOHD",
+            "areas": [[1, 8]],
+            "zones": [[1, 192]],
+            "users": [[1, 32]]
+        }
+    }
+
+async def sweep(port, depth):
+    prt = AsyncPRT(make_config(port, depth), lambda payload, topic = None: None, asyncio.get_running_loop())
+    for entity in prt.areas + prt.zones:
+        if entity:
+            entity.last_state_update = None
+            entity.last_name_update = None
+    for user in prt.users.values():
+        user.last_name_update = None
+    async def panic():
+        await asyncio.sleep(0.1)
+        start = time.time()
+        await prt.command("PE001", "^PE001&(ok|fail)$", PRIORITY_PANIC)
+        return time.time() - start
+
+    start = time.time()
+    panic_latency, _ = await asyncio.gather(panic(), prt.panel_sync())
+    elapsed = time.time() - start
+    prt.close()
+    return elapsed, panic_latency
+
+if __name__ == "__main__":
+    logging.getLogger("prt3_mqtt").setLevel(logging.CRITICAL)
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.01
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    threading.Thread(target=panel, args=(master, latency), daemon=True).start()
+
+    for depth in (1, 2, 4, 8):
+        elapsed, panic_latency = asyncio.run(sweep(os.ttyname(slave), depth))
+        print("depth %d: %6.2f s per sweep, panic answered in %5.1f ms (8 areas, 192 zones, 32 users; %.0f ms latency)" % (depth, elapsed, panic_latency * 1000, latency * 1000))
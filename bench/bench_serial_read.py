@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Benchmark: PRT3 serial readers against a pseudo terminal
+# Feeds a burst of G-event lines into a pty and measures how fast each
+# read mode ("line" / "bulk") hands them over to PRT.input_serial. Framed
+# lines are counted (as parsed), not event callbacks: events repeating the
+# known zone state are not published
+
+import os
+import pty
+import sys
+import threading
+import time
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from paradox.prt3 import PRT
+
+def make_config(port, read_mode):
+    return {
+        "prt3": {
+            "port": port,
+            "speed": 57600,
+            "read_mode": read_mode,
+            "refresh": {"area": 1, "zone": 2, "user": 5, "names": 10}
+        },
+        "panel": {
+            "type": "EVOHD",
+            "areas": [[1, 8]],
+            "zones": [[1, 192]],
+            "users": [[1, 4]]
+        }
+    }
+
+def writer(fd, lines, burst):
+    data = "".join(lines).encode("ascii")
+    for i in range(0, len(data), burst):
+        os.write(fd, data[i:i+burst])
+
+def run(read_mode, count, burst):
+    master, slave = pty.openpty()
+    parsed = [0]
+    prt = PRT(make_config(os.ttyname(slave), read_mode), lambda payload, topic = None: None)
+    parse_event = prt.parse_event
+    def counting_parse_event(line, regex_response = None):
+        parsed[0] += 1
+        return parse_event(line, regex_response)
+    prt.parse_event = counting_parse_event
+    lines = ["G%03dN%03dA001\r" % (i % 2, (i % 192) + 1) for i in range(count)]
+
+    t = threading.Thread(target=writer, args=(master, lines, burst))
+    wall_start = time.time()
+    cpu_start = time.process_time()
+    t.start()
+    while parsed[0] < count and (time.time() - wall_start) < 60:
+        serin = prt._read()
+        if serin:
+            prt.input_serial(serin)
+    wall = time.time() - wall_start
+    cpu = time.process_time() - cpu_start
+    t.join()
+
+    prt.close()
+    os.close(master)
+    os.close(slave)
+    print("%-5s %8d lines  %10.0f lines/sec  cpu %.3f s" % (read_mode, parsed[0], parsed[0] / wall, cpu))
+
+if __name__ == "__main__":
+    logging.getLogger("prt3_mqtt").setLevel(logging.CRITICAL)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    burst = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    run("line", count, burst)
+    run("bulk", count, burst)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Microbenchmark: PRT3 line classification
+# Compares the original re.search()/re.split() classification in
+# PRT.parse_event with the single-pass tokenizer (lines/sec)
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from paradox.tokenizer import tokenize, match_response, ReplyToken
+
+# Sample traffic resembling an arming burst followed by a panel_sync sweep
+lines = []
+for i in range(1, 17):
+    lines.append("G001N%03dA001" % (i))
+    lines.append("G000N%03dA001" % (i))
+lines += ["G064N000A001", "G065N001A001", "G010N001A001", "PGM01ON", "PGM01OFF", "COMM&ok"]
+for i in range(1, 17):
+    lines.append("ZL%03d%-16s" % (i, "Zone %d" % (i)))
+    lines.append("RZ%03dCOOOO" % (i))
+lines.append("AA001&ok")
+
+responses = {
+    "ZL": "^(ZL)([0-9]{3})(.{16})$",
+    "RZ": "^(RZ)([0-9]{3})([COTF])([AO])([FO])([SO])([LO])$",
+    "AA": "^AA001&(ok|fail)$",
+}
+
+# Original implementation (pattern strings evaluated by re.search + re.split)
+def classify_regex(line, regex_response):
+    regex_comm = "^COMM&(ok|fail)$"
+    regex_event = "^G([0-9]{3})N([0-9]{3})A([0-9]{3})$"
+    regex_pgm = "^PGM([0-9]{2})(ON|OFF)$"
+
+    if (regex_response != None) and (re.search(regex_response, line)):
+        return re.split(regex_response, line)
+    elif (re.search(regex_comm, line)):
+        return re.split(regex_comm, line)
+    elif (re.search(regex_event, line)):
+        rx = re.split(regex_event, line)
+        return (int(rx[1]), int(rx[2]), int(rx[3]))
+    elif (re.search(regex_pgm, line)):
+        rx = re.split(regex_pgm, line)
+        return (int(rx[1]), rx[2])
+    return None
+
+def classify_tokenizer(line, regex_response):
+    token = tokenize(line)
+    if (type(token) is ReplyToken) and (regex_response != None):
+        return match_response(token, regex_response)
+    return token
+
+def run(name, func, rounds):
+    work = [(l, responses.get(l[:2])) for l in lines]
+    start = time.time()
+    for _ in range(rounds):
+        for line, regex in work:
+            func(line, regex)
+    elapsed = time.time() - start
+    rate = (rounds * len(work)) / elapsed
+    print("%-10s %12.0f lines/sec" % (name, rate))
+    return rate
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    before = run("regex", classify_regex, rounds)
+    after = run("tokenizer", classify_tokenizer, rounds)
+    print("speedup    %12.2fx" % (after / before))
@@ -0,0 +1,48 @@
+import struct
+
+# Field order of the packed zone / area state. Bit positions are shared by
+# the PRT state store, the state snapshot and the binary wire format, so
+# new fields may only be appended.
+zone_fields = ("open", "tamper", "fire", "alarm", "fire_alarm", "supervision_lost", "low_battery")
+area_fields = ("arm_disarmed", "arm_armed", "arm_force", "arm_stay", "arm_instant", "zone_in_memory",
+    "trouble", "not_ready", "in_programming", "in_alarm", "strobe")
+pgm_fields = ("state",)
+
+# Compact binary entity state (opt-in parallel topic tree, queue.queues.binary)
+#
+# Little endian, 20 bytes:
+#   kind (B; 1 = zone, 2 = area, 3 = pgm), flags (B; bit 0 = stale), id (H),
+#   version (I), known fields (H), set fields (H), timestamp (d)
+state_record = struct.Struct("<BBHIHHd")
+
+state_kinds = {
+    "zone": (1, zone_fields),
+    "area": (2, area_fields),
+    "pgm": (3, pgm_fields)
+}
+state_kind_names = dict((code, (kind, fields)) for kind, (code, fields) in state_kinds.items())
+
+def encode_state(kind, id, state, timestamp):
+    code, fields = state_kinds[kind]
+    known = 0
+    value = 0
+    for bit, field in enumerate(fields):
+        field_state = state.get(field)
+        if field_state != None:
+            known |= (1 << bit)
+            if field_state:
+                value |= (1 << bit)
+    return state_record.pack(code, 1 if state.get("stale") else 0, id, state.get("version") or 0, known, value, timestamp)
+
+# Returns (kind, state dict) with the same keys as the JSON state topics
+# (except name); unknown fields are None
+def decode_state(data):
+    code, flags, id, version, known, value, timestamp = state_record.unpack(data)
+    kind, fields = state_kind_names[code]
+    state = {"id": id}
+    for bit, field in enumerate(fields):
+        state[field] = bool(value & (1 << bit)) if known & (1 << bit) else None
+    state["version"] = version
+    state["stale"] = bool(flags & 1)
+    state["timestamp"] = timestamp
+    return kind, state
@@ -1,4 +1,6 @@
+import copy
 import logging
+import re
 import sys
 import serial
 
@@ -8,6 +10,13 @@ log = logging.getLogger(logger_name)
 # Get configuration option from config file using path
 # Example: get_config(config, "debug.enabled")
 def get_config(config, path):
+    if isinstance(config, Config):
+        try:
+            return config.paths[path]
+        except KeyError:
+            log.error("Unable to get configuration option: %s" % (path))
+            sys.exit(1)
+
     try:
         _path = path.split(".")
         ret = config
@@ -20,6 +29,13 @@ def get_config(config, path):
         return ret
 
 def get_config_default(config, path, defval = None):
+    if isinstance(config, Config):
+        try:
+            return config.paths[path]
+        except KeyError:
+            log.warning("Unable to get configuration option: %s" % (path))
+            return defval
+
     try:
         _path = path.split(".")
         ret = config
@@ -30,3 +46,341 @@ def get_config_default(config, path, defval = None):
         return defval
     else:
         return ret
+
+# ConfigError exception
+# Raised by compile_config with the list of all problems found
+class ConfigError(Exception):
+    errors = None
+
+    def __init__(self, errors):
+        Exception.__init__(self, "; ".join(errors))
+        self.errors = errors
+
+# ConfigNode class
+# Read-only configuration section. Options are available as attributes
+# (config.prt3.port) as well as items (config["prt3"]["port"]); lists are
+# turned into tuples.
+class ConfigNode:
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        object.__setattr__(self, "_data", data)
+
+    def __getattr__(self, name):
+        try:
+            return self._data[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise TypeError("Configuration is read-only")
+
+    def __getitem__(self, name):
+        return self._data[name]
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return repr(self._data)
+
+    def get(self, name, defval = None):
+        return self._data.get(name, defval)
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        return self._data.items()
+
+# Config class
+# Validated, immutable configuration (see compile_config). Every option is
+# also indexed by its dotted path (paths["prt3.refresh.zone"]) so that
+# get_config() does not walk the tree, and queue topics are available as
+# topics.<name>.
+class Config(ConfigNode):
+    __slots__ = ("paths", "topics")
+
+    def __init__(self, data, paths):
+        ConfigNode.__init__(self, data)
+        object.__setattr__(self, "paths", paths)
+        object.__setattr__(self, "topics", paths.get("queue.queues", ConfigNode({})))
+
+# Schema defaults: option must be present / option may be missing (no default)
+required = object()
+optional = object()
+
+def freeze(value, path, paths):
+    if isinstance(value, dict):
+        node = ConfigNode(dict((key, freeze(item, path + [key], paths)) for key, item in value.items()))
+    elif isinstance(value, list):
+        node = tuple(freeze(item, path, {}) for item in value)
+    else:
+        node = value
+    if path:
+        paths[".".join(path)] = node
+    return node
+
+def check_type(value, type):
+    if type == float:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if type == int:
+        return isinstance(value, int) and not isinstance(value, bool)
+    return isinstance(value, type)
+
+# Validators for compile_config schemas; return error text or None
+def choice(*values):
+    def check(value):
+        if value not in values:
+            return "must be one of: %s" % (", ".join(values))
+    return check
+
+def positive(value):
+    if value <= 0:
+        return "must be positive"
+
+def ranges(value):
+    for i in value:
+        if (not isinstance(i, list)) or (len(i) != 2) or (not all(check_type(n, int) for n in i)) or (i[0] > i[1]):
+            return "must be a list of [first, last] ranges"
+
+def address_map(value):
+    for key, address in value.items():
+        if (not check_type(address, int)) or (address < 0):
+            return "%s must be a non-negative address" % (key)
+
+def tls(value):
+    if value.get("enabled", False):
+        for key in ("cert", "key"):
+            if not isinstance(value.get(key), str):
+                return "%s is required when TLS is enabled" % (key)
+
+# Validates <config> (dict loaded from JSON) against <schema> and returns a
+# Config. Schema entries are (path, type, default[, validator]); missing
+# options get their default unless it is "required" (error) or "optional"
+# (left out). All errors are collected and raised as one ConfigError.
+# Defaults are filled in on a copy; <config> is left as it is.
+def compile_config(config, schema):
+    if not isinstance(config, dict):
+        raise ConfigError(["configuration not loaded"])
+
+    config = copy.deepcopy(config)
+    errors = []
+    for entry in schema:
+        path, type, default = entry[:3]
+        validator = entry[3] if len(entry) > 3 else None
+
+        keys = path.split(".")
+        parent = config
+        for key in keys[:-1]:
+            if not isinstance(parent.get(key, {}), dict):
+                parent = None
+                break
+            parent = parent.setdefault(key, {}) if default not in (required, optional) else parent.get(key, {})
+        if parent == None:
+            errors.append("%s: %s is not a section" % (path, key))
+            continue
+
+        if keys[-1] not in parent:
+            if default is required:
+                errors.append("%s: missing" % (path))
+            elif default is not optional:
+                parent[keys[-1]] = default
+            continue
+
+        value = parent[keys[-1]]
+        if (value == None) and (default is not required):
+            continue
+        if not check_type(value, type):
+            errors.append("%s: expected %s, got %r" % (path, type.__name__, value))
+            continue
+        if validator:
+            error = validator(value)
+            if error:
+                errors.append("%s: %s" % (path, error))
+
+    if errors:
+        raise ConfigError(errors)
+
+    paths = {}
+    data = freeze(config, [], paths)
+    return Config(data._data, paths)
+
+# <override> merged into a copy of <base>, section by section
+def merge_config(base, override):
+    merged = copy.deepcopy(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+# Panel ids are used as a topic level
+regex_panel_id = re.compile("^[A-Za-z0-9_-]+$")
+
+def panel_id(value):
+    if not regex_panel_id.match(value):
+        return "must be a name of letters, digits, \"-\" and \"_\""
+
+# Queue topic <name> (queue.queues.<name>) of the panel selected by
+# queue.panel: "<topic>/<panel id>" as published by a prt3_mqtt serving
+# several panels, the configured topic without queue.panel
+def panel_topic(config, name):
+    topic = get_config_default(config, "queue.queues." + name, None)
+    panel = get_config_default(config, "queue.panel", None)
+    if topic and panel:
+        topic += "/" + panel
+    return topic
+
+# Options that must not be shared by two panels
+panel_unique_options = ("prt3.port", "prt3.label_cache", "prt3.snapshot.path")
+
+# Validates a configuration with several panels and returns [(panel id,
+# Config)]. Every entry of the "panels" list ({"id": ..., "prt3": {...},
+# "panel": {...}, ...}) is merged over the top level options and compiled
+# against <schema> on its own. Without "panels" the top level is the only
+# panel (id None).
+def compile_panels(config, schema):
+    if not isinstance(config, dict):
+        raise ConfigError(["configuration not loaded"])
+    panels = config.get("panels")
+    if panels == None:
+        return [(None, compile_config(config, schema))]
+    if (not isinstance(panels, list)) or (not panels):
+        raise ConfigError(["panels: must be a non-empty list"])
+
+    base = dict((key, value) for key, value in config.items() if key != "panels")
+    errors = []
+    compiled = []
+    used = {}
+    for i, panel in enumerate(panels):
+        panel_id = panel.get("id") if isinstance(panel, dict) else None
+        if (not isinstance(panel_id, str)) or (not regex_panel_id.match(panel_id)):
+            errors.append("panels[%d].id: must be a name of letters, digits, \"-\" and \"_\"" % (i))
+            continue
+        if panel_id in [id for id, panel_config in compiled]:
+            errors.append("panels[%d].id: duplicate panel id %s" % (i, panel_id))
+            continue
+        try:
+            panel_config = compile_config(merge_config(base, dict((key, value) for key, value in panel.items() if key != "id")), schema)
+        except ConfigError as e:
+            errors.extend("panels.%s: %s" % (panel_id, error) for error in e.errors)
+            continue
+        for path in panel_unique_options:
+            value = panel_config.paths.get(path)
+            if value == None:
+                continue
+            if (path, value) in used:
+                errors.append("panels.%s: %s %s is also used by panel %s" % (panel_id, path, value, used[(path, value)]))
+            used[(path, value)] = panel_id
+        compiled.append((panel_id, panel_config))
+
+    if errors:
+        raise ConfigError(errors)
+    return compiled
+
+# Queue options shared by prt3_mqtt and modbus_mqtt
+queue_schema = (
+    ("queue.host", str, required),
+    ("queue.port", int, required),
+    ("queue.queues.events", str, required),
+    ("queue.queues.requests", str, required),
+    ("queue.queues.responses", str, required),
+    ("queue.queues.broadcasts", str, required),
+    ("queue.queues.state", str, None),
+    ("queue.queues.binary", str, None),
+    ("queue.tls", dict, optional, tls)
+)
+
+debug_schema = (
+    ("debug.loglevel", str, "info", choice("debug", "info", "warning", "error", "critical", "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")),
+    ("debug.enabled", bool, False),
+    ("debug.wait", bool, False)
+)
+
+prt3_schema = debug_schema + queue_schema + (
+    ("mode", str, "thread", choice("thread", "asyncio")),
+    ("prt3.port", str, required),
+    ("prt3.speed", int, required, positive),
+    ("prt3.read_mode", str, "bulk", choice("bulk", "line")),
+    ("prt3.label_cache", str, None),
+    ("prt3.snapshot.path", str, None),
+    ("prt3.snapshot.interval", float, 60, positive),
+    ("prt3.pipeline.depth", int, 4, positive),
+    ("prt3.pipeline.timeout", float, 5, positive),
+    ("prt3.refresh.area", float, required, positive),
+    ("prt3.refresh.zone", float, required, positive),
+    ("prt3.refresh.user", float, required, positive),
+    ("prt3.refresh.names", float, required, positive),
+    ("panel.type", str, required),
+    ("panel.areas", list, required, ranges),
+    ("panel.zones", list, required, ranges),
+    ("panel.users", list, required, ranges),
+    ("metrics.interval", float, 60),
+    ("queue.snapshot_interval", float, 1),
+    ("queue.batch.window", float, 0),
+    ("queue.batch.max", int, 64, positive),
+    ("queue.batch.compat", bool, True),
+    ("queue.publish.max_queued", int, 1000, positive),
+    ("queue.publish.high_water", int, 800, positive),
+    ("queue.publish.max_inflight", int, 20, positive),
+    ("queue.spool.path", str, None),
+    ("queue.spool.segment_size", int, 1048576, positive),
+    ("queue.spool.max_size", int, 67108864, positive),
+    ("queue.spool.overflow", str, "drop_oldest", choice("drop_oldest", "drop_new")),
+    ("queue.spool.replay_rate", float, 50, positive)
+)
+
+# Default Modbus discrete input map (field -> address of zone / area 1); open
+# and tamper keep their original addresses
+modbus_zone_map = {
+    "open": 0,
+    "tamper": 192,
+    "alarm": 384,
+    "low_battery": 576,
+    "fire": 768,
+    "supervision_lost": 960
+}
+modbus_area_map = {
+    "arm_armed": 1152,
+    "arm_stay": 1160,
+    "arm_force": 1168,
+    "arm_instant": 1176,
+    "in_alarm": 1184,
+    "trouble": 1192,
+    "not_ready": 1200
+}
+
+# Default Modbus coil map (group -> address of area / input / key 1)
+modbus_coil_map = {
+    "arm": 0,
+    "stay": 8,
+    "vinput": 16,
+    "utilitykey": 32,
+    "disarm": 48
+}
+
+modbus_schema = debug_schema + queue_schema + (
+    ("mode", str, "asyncio", choice("asyncio", "twisted")),
+    ("modbus.listen_addr", str, required),
+    ("modbus.port", int, required),
+    ("modbus.zones", int, 192, positive),
+    ("modbus.areas", int, 8, positive),
+    ("modbus.map.zone", dict, modbus_zone_map, address_map),
+    ("modbus.map.area", dict, modbus_area_map, address_map),
+    ("modbus.control.code", str, None),
+    ("modbus.control.timeout", float, 10, positive),
+    ("modbus.control.vinputs", int, 16, positive),
+    ("modbus.control.utility_keys", int, 16, positive),
+    ("modbus.control.coils", dict, modbus_coil_map, address_map),
+    ("modbus.control.registers.area", int, 100, positive),
+    ("queue.client_name", str, required),
+    ("queue.panel", str, None, panel_id)
+)
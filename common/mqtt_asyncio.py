@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import socket
+import paho.mqtt.client as mqtt
+
+# AsyncioHelper class
+# Drives a paho MQTT client from an asyncio event loop instead of the paho
+# network thread (loop_start). Socket readiness is delivered through event
+# loop reader/writer callbacks, keepalive housekeeping runs as a task and
+# lost connections are re-established from the loop.
+class AsyncioHelper:
+    _log = None
+    _loop = None
+    _client = None
+    _misc = None
+    _connect = None
+    _closing = False
+
+    reconnect_delay = 5
+
+    def __init__(self, loop, client, logger_name):
+        self._log = logging.getLogger(logger_name)
+        self._loop = loop
+        self._client = client
+
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._loop.add_reader(sock, self._on_readable)
+        self._misc = self._loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._loop.remove_reader(sock)
+        if self._misc:
+            self._misc.cancel()
+            self._misc = None
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+    def _on_readable(self):
+        self._client.loop_read()
+
+        # TLS sockets may hold already decrypted data the selector does not see
+        sock = self._client.socket()
+        while sock and hasattr(sock, "pending") and sock.pending():
+            self._client.loop_read()
+            sock = self._client.socket()
+
+    async def _misc_loop(self):
+        while self._client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def _connect_loop(self, delay):
+        if delay:
+            await asyncio.sleep(delay)
+        while not self._closing:
+            try:
+                self._client.reconnect()
+                break
+            except (socket.error, OSError) as e:
+                self._log.warning("Unable to connect to message broker: %s; retrying in %d s" % (e, self.reconnect_delay))
+                await asyncio.sleep(self.reconnect_delay)
+        self._connect = None
+
+    # Connect using the host/port previously set with connect_async()
+    def connect(self, delay = 0):
+        if (self._connect == None) and (not self._closing):
+            self._connect = self._loop.create_task(self._connect_loop(delay))
+
+    # Called from on_disconnect; unexpected disconnects are retried
+    def disconnected(self, rc):
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            self.connect(self.reconnect_delay)
+
+    def close(self):
+        self._closing = True
+        if self._connect:
+            self._connect.cancel()
+            self._connect = None
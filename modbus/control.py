@@ -0,0 +1,295 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from pymodbus.datastore.store import BaseModbusDataBlock
+from pymodbus.datastore import ModbusSlaveContext
+from common.config import ConfigError
+from modbus.datastore import BitmapDataBlock
+
+# Arm type by area control register value (0 disarms)
+arm_types = (None, "regular", "force", "stay", "instant")
+
+# Coil groups sending arming requests (mapped only with a user code)
+arming_groups = ("arm", "stay", "disarm")
+
+# True if a PRT3 command result (list of matched response lines) is "ok"
+def result_ok(result):
+    return bool(result) and all("ok" in line for line in result)
+
+# ControlRequests class
+# Turns Modbus writes into requests for prt3_mqtt and correlates the
+# responses. All operations of one Modbus write share one request id and
+# are sent as one MQTT request per operation ("<client>/arming", ...),
+# every element of which is answered on "<responses>/<client>/<operation>".
+# When all answers are in (or after <timeout> seconds) the write is logged
+# with its write-to-panel latency. <schedule>(delay, callback) is set by the
+# Modbus server (reactor.callLater or loop.call_later) and arms the timer
+# reporting unanswered writes; it is only called from the server's thread.
+class ControlRequests:
+    _log = None
+    _send = None
+    _client_name = None
+    _lock = None
+    _pending = None
+    _armed = False
+
+    code = None
+    timeout = None
+    schedule = None
+
+    # Counters
+    _writes = 0
+    _requests = 0
+    _completed = 0
+    _failed = 0
+    _timed_out = 0
+    _latency_last = None
+    _latency_sum = 0
+    _latency_max = 0
+
+    def __init__(self, send, client_name, code, timeout, logger_name):
+        self._log = logging.getLogger(logger_name)
+        self._send = send
+        self._client_name = client_name
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.code = code
+        self.timeout = timeout
+
+    # <operations> is a list of (operation, request element)
+    def submit(self, operations):
+        if not operations:
+            return None
+
+        request_id = uuid.uuid4().hex
+        requests = {}
+        for operation, element in operations:
+            requests.setdefault(operation, []).append(element)
+
+        with self._lock:
+            self._expire()
+            self._pending[request_id] = [time.time(), len(operations), []]
+            self._writes += 1
+            self._requests += len(operations)
+            arm = (self.schedule != None) and (not self._armed)
+            if arm:
+                self._armed = True
+
+        if arm:
+            self.schedule(self.timeout, self.expire)
+
+        for operation, elements in requests.items():
+            self._log.info("Sending %s request %s (%d operations)" % (operation, request_id, len(elements)))
+            self._send(json.dumps({"clientid": self._client_name, "reqid": request_id, "request": elements}),
+                self._client_name + "/" + operation)
+        return request_id
+
+    def response(self, payload):
+        request_id = payload.get("request_id")
+        now = time.time()
+        with self._lock:
+            pending = self._pending.get(request_id)
+            if pending == None:
+                return
+            result = payload.get("result")
+            for key in ("arm", "quickarm", "disarm"):
+                if key in payload:
+                    result = payload[key].get("result")
+            pending[2].append(result_ok(result))
+            if len(pending[2]) < pending[1]:
+                return
+            del self._pending[request_id]
+
+            latency = now - pending[0]
+            failed = pending[2].count(False)
+            self._completed += 1
+            if failed:
+                self._failed += 1
+            self._latency_last = latency
+            self._latency_sum += latency
+            if latency > self._latency_max:
+                self._latency_max = latency
+            self._expire()
+
+        self._log.info("Modbus write %s done in %.1f ms (%d operations, %d failed)" % (request_id, latency * 1000, pending[1], failed))
+
+    # Timer callback; re-armed for the oldest write still pending
+    def expire(self):
+        with self._lock:
+            self._expire()
+            self._armed = bool(self._pending)
+            if self._armed:
+                delay = min(pending[0] for pending in self._pending.values()) + self.timeout - time.time()
+
+        if self._armed:
+            self.schedule(max(delay, 0), self.expire)
+
+    def _expire(self):
+        now = time.time()
+        for request_id, pending in list(self._pending.items()):
+            if now - pending[0] >= self.timeout:
+                del self._pending[request_id]
+                self._timed_out += 1
+                self._log.warning("Modbus write %s timed out (%d of %d operations answered)" % (request_id, len(pending[2]), pending[1]))
+
+    def getData(self):
+        with self._lock:
+            return {
+                "writes": self._writes,
+                "requests": self._requests,
+                "completed": self._completed,
+                "failed": self._failed,
+                "timed_out": self._timed_out,
+                "pending": len(self._pending),
+                "latency": {
+                    "last": round(self._latency_last * 1000, 1) if self._latency_last != None else None,
+                    "avg": round(self._latency_sum * 1000 / self._completed, 1) if self._completed else None,
+                    "max": round(self._latency_max * 1000, 1)
+                }
+            }
+
+# ControlSlaveContext class
+# ModbusSlaveContext validating writes with validate_write() of the data
+# block when it has one; pymodbus checks reads and writes with validate()
+# alike, so a write to a read only range would otherwise be accepted and
+# dropped.
+class ControlSlaveContext(ModbusSlaveContext):
+    write_functions = (0x05, 0x06, 0x0F, 0x10, 0x16)
+
+    def validate(self, fx, address, count = 1):
+        store = self.store[self.decode(fx)]
+        if (fx in self.write_functions) and hasattr(store, "validate_write"):
+            if not self.zero_mode:
+                address = address + 1
+            return store.validate_write(address, count)
+        return ModbusSlaveContext.validate(self, fx, address, count)
+
+# ControlCoilBlock class
+# Writable coils mapped to panel requests by modbus.control.coils (group ->
+# address of area / input / key 1):
+#   arm          1 = arm (regular) area n (0 is ignored)
+#   stay         1 = stay arm area n (0 is ignored)
+#   disarm       1 = disarm area n (0 is ignored)
+#   vinput       1 = open, 0 = close virtual input n
+#   utilitykey   1 = press utility key n (0 is ignored)
+# Areas are only disarmed through their disarm coil, so a multi-coil write
+# over the arming groups never disarms as a side effect. Arming groups are
+# only mapped when modbus.control.code is set. Coils read back the last
+# value written. One write (0x05 or 0x0F) is one submit().
+class ControlCoilBlock(BitmapDataBlock):
+    _requests = None
+    _groups = None
+
+    def __init__(self, address, requests, coil_map, counts):
+        self._requests = requests
+        self._groups = []
+        errors = []
+        for group, base in coil_map.items():
+            if group not in counts:
+                errors.append("modbus.control.coils.%s: unknown group" % (group))
+            elif (group in arming_groups) and (not requests.code):
+                continue
+            else:
+                self._groups.append((base, base + counts[group], group))
+        self._groups.sort()
+        for (start, end, name), (next_start, next_end, next_name) in zip(self._groups, self._groups[1:]):
+            if next_start < end:
+                errors.append("modbus.control.coils: %s overlaps %s" % (name, next_name))
+        if errors:
+            raise ConfigError(errors)
+
+        BitmapDataBlock.__init__(self, address, max([end for start, end, name in self._groups] + [0]))
+
+    # Only mapped coils can be written
+    def validate(self, address, count = 1):
+        if not BitmapDataBlock.validate(self, address, count):
+            return False
+        offset = address - self.address
+        return all(any(start <= i < end for start, end, name in self._groups) for i in range(offset, offset + count))
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        BitmapDataBlock.setValues(self, address, values)
+
+        offset = address - self.address
+        operations = []
+        for i, value in enumerate(values):
+            for start, end, group in self._groups:
+                if start <= offset + i < end:
+                    operation = self.operation(group, offset + i - start + 1, bool(value))
+                    if operation:
+                        operations.append(operation)
+        self._requests.submit(operations)
+
+    def operation(self, group, number, value):
+        if (group == "arm" or group == "stay") and value:
+            return ("arming", {"code": self._requests.code, "arm": [{"area": number, "arm_type": "regular" if group == "arm" else "stay"}]})
+        if group == "disarm" and value:
+            return ("arming", {"code": self._requests.code, "disarm": [{"area": number}]})
+        if group == "vinput":
+            return ("vinput", {"id": number, "state": value})
+        if group == "utilitykey" and value:
+            return ("utilitykey", {"id": number})
+        return None
+
+# ControlRegisterBlock class
+# Holding registers: the read only state view (BitmapRegisterBlock) at 0
+# followed by one arm control register per area at <base>
+# (modbus.control.registers.area). Writing a control register arms area n
+# with the arm type of the value (see arm_types) or disarms it (0); it
+# reads back the last value written; writes to the state view are rejected
+# (IllegalAddress). One write (0x06 or 0x10) is one submit().
+class ControlRegisterBlock(BaseModbusDataBlock):
+    _view = None
+    _requests = None
+    _base = None
+    _controls = None
+    size = 0
+
+    def __init__(self, address, view, requests, base, areas):
+        self.address = address
+        self.default_value = 0
+        self._view = view
+        self._requests = requests
+        self._base = base
+        self._controls = [0] * (areas if requests.code else 0)
+        if self._controls and (base < view.size):
+            raise ConfigError(["modbus.control.registers.area: overlaps the state registers (0-%d)" % (view.size - 1)])
+        self.size = (base + len(self._controls)) if self._controls else view.size
+
+    def validate(self, address, count = 1):
+        offset = address - self.address
+        if (offset < 0) or (offset + count > self.size):
+            return False
+        return (offset + count <= self._view.size) or (offset >= self._base)
+
+    def validate_write(self, address, count = 1):
+        return self.validate(address, count) and (address - self.address >= self._base)
+
+    def getValues(self, address, count = 1):
+        offset = address - self.address
+        if offset >= self._base:
+            return self._controls[offset - self._base:offset - self._base + count]
+        return self._view.getValues(self._view.address + offset, count)
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        offset = address - self.address
+        if offset < self._base:
+            return
+
+        operations = []
+        for i, value in enumerate(values):
+            slot = offset - self._base + i
+            if not (0 <= value < len(arm_types)):
+                continue
+            self._controls[slot] = value
+            if arm_types[value]:
+                operations.append(("arming", {"code": self._requests.code, "arm": [{"area": slot + 1, "arm_type": arm_types[value]}]}))
+            else:
+                operations.append(("arming", {"code": self._requests.code, "disarm": [{"area": slot + 1}]}))
+        self._requests.submit(operations)
@@ -0,0 +1,226 @@
+import struct
+from pymodbus.datastore.store import BaseModbusDataBlock
+from pymodbus.bit_read_message import ReadDiscreteInputsRequest, ReadDiscreteInputsResponse
+from pymodbus.pdu import ModbusExceptions as merror
+from common.binary import zone_fields, area_fields
+from common.config import ConfigError
+
+# Bits of the area status word (bit 0 first)
+area_word_fields = ("arm_armed", "arm_stay", "arm_force", "arm_instant", "in_alarm", "trouble", "not_ready")
+
+# Bits of the status register (bit 0 first)
+status_bits = ("ready",)
+
+# Bits of every byte value, least significant first (Modbus bit order)
+byte_bits = [tuple(bool(value & (1 << bit)) for bit in range(8)) for value in range(256)]
+
+# RegisterMap class
+# Discrete input address of every mapped zone / area field, built from
+# modbus.map.zone and modbus.map.area: zero based address of the first zone /
+# area of a field; zone n / area n is at address + n - 1
+class RegisterMap:
+    zones = None
+    areas = None
+    size = 0
+    fields = None
+
+    def __init__(self, zone_map, area_map, zones, areas):
+        self.zones = zones
+        self.areas = areas
+        self.fields = {"zone": {}, "area": {}}
+
+        blocks = []
+        errors = []
+        for kind, field_map, known_fields, count in (("zone", zone_map, zone_fields, zones), ("area", area_map, area_fields, areas)):
+            for field, address in field_map.items():
+                if field not in known_fields:
+                    errors.append("modbus.map.%s.%s: unknown field" % (kind, field))
+                    continue
+                self.fields[kind][field] = address
+                blocks.append((address, address + count, "%s.%s" % (kind, field)))
+
+        blocks.sort()
+        for (start, end, name), (next_start, next_end, next_name) in zip(blocks, blocks[1:]):
+            if next_start < end:
+                errors.append("modbus.map: %s overlaps %s" % (name, next_name))
+        if errors:
+            raise ConfigError(errors)
+
+        self.size = max(end for start, end, name in blocks) if blocks else 0
+
+    # Address of <field> of zone / area <id> or None if not mapped
+    def address(self, kind, field, id):
+        base = self.fields[kind].get(field)
+        if base == None:
+            return None
+        return base + id - 1
+
+# BitmapDataBlock class
+# pymodbus data block holding single bit values in a packed bytearray in
+# Modbus wire order (bit n is bit n % 8 of byte n / 8). getBytes() returns
+# a range already packed for a read response.
+class BitmapDataBlock(BaseModbusDataBlock):
+    bits = None
+    size = 0
+
+    def __init__(self, address, size):
+        self.address = address
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self.default_value = False
+
+    def default(self, count, value = False):
+        self.size = count
+        self.bits = bytearray(b"\xff" if value else b"\0") * ((count + 7) // 8)
+        self.default_value = value
+
+    def reset(self):
+        self.bits[:] = (b"\xff" if self.default_value else b"\0") * len(self.bits)
+
+    def validate(self, address, count = 1):
+        return (self.address <= address) and (address + count <= self.address + self.size)
+
+    def getValues(self, address, count = 1):
+        offset = address - self.address
+        values = []
+        for value in self.bits[offset >> 3:(offset + count + 7) >> 3]:
+            values.extend(byte_bits[value])
+        return values[offset & 7:(offset & 7) + count]
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        offset = address - self.address
+        for i, value in enumerate(values):
+            self.setBit(offset + i, value)
+
+    # Zero based bit access
+    def setBit(self, offset, value):
+        if value:
+            self.bits[offset >> 3] |= (1 << (offset & 7))
+        else:
+            self.bits[offset >> 3] &= ~(1 << (offset & 7)) & 0xff
+
+    def getBit(self, offset):
+        return bool(self.bits[offset >> 3] & (1 << (offset & 7)))
+
+    # <count> bits from <offset> as an integer, first bit in bit 0
+    def getWord(self, offset, count):
+        value = int.from_bytes(self.bits[offset >> 3:(offset + count + 7) >> 3], "little") >> (offset & 7)
+        return value & ((1 << count) - 1)
+
+    # Replaces all bits at once with the bits of integer <value>, first bit
+    # in bit 0
+    def load(self, value):
+        self.bits[:] = (value & ((1 << self.size) - 1)).to_bytes(len(self.bits), "little")
+
+    def getBytes(self, address, count):
+        offset = address - self.address
+        if offset & 7 == 0:
+            data = self.bits[offset >> 3:(offset + count + 7) >> 3]
+            if count & 7:
+                data[-1] &= (1 << (count & 7)) - 1
+            return bytes(data)
+        value = int.from_bytes(self.bits[offset >> 3:(offset + count + 7) >> 3], "little") >> (offset & 7)
+        return (value & ((1 << count) - 1)).to_bytes((count + 7) // 8, "little")
+
+# BitmapRegisterBlock class
+# Read only 16-bit register view of a BitmapDataBlock, computed from the
+# same bits on every read so it is always in sync with the discrete inputs.
+# A register of zone flags is the next 16 zones of the field (fewer in the
+# last register if the zone count is not a multiple of 16).
+# Registers, starting at 0:
+#   - per mapped zone field (in discrete input address order), one register
+#     per 16 zones: zone 16 * i + 1 in bit 0 of register i
+#   - one status word per area (bits as in area_word_fields; unmapped
+#     fields read as 0)
+#   - the status register (bits as in status_bits, set in <status>); ready
+#     is clear until the data is loaded and must be checked by masters
+#     before acting on the other registers
+class BitmapRegisterBlock(BaseModbusDataBlock):
+    inputs = None
+    size = 0
+    status = 0
+    _layout = None
+    _zones = 0
+    _areas = 0
+    _area_bits = None
+
+    def __init__(self, address, inputs, register_map):
+        self.address = address
+        self.inputs = inputs
+        self.default_value = 0
+        self._zones = register_map.zones
+        self._areas = register_map.areas
+
+        # Zone flag registers: (field base, first zone slot); area words:
+        # (None, area slot)
+        self._layout = []
+        for field, base in sorted(register_map.fields["zone"].items(), key = lambda item: item[1]):
+            for first in range(0, register_map.zones, 16):
+                self._layout.append((base, first))
+        for area in range(register_map.areas):
+            self._layout.append((None, area))
+        self._layout.append((None, None))
+        self._area_bits = [(bit, register_map.fields["area"][field]) for bit, field in enumerate(area_word_fields)
+            if field in register_map.fields["area"]]
+        self.size = len(self._layout)
+
+    def validate(self, address, count = 1):
+        return (self.address <= address) and (address + count <= self.address + self.size)
+
+    # Every field block involved is read from the bitmap once as an integer
+    def getValues(self, address, count = 1):
+        offset = address - self.address
+        blocks = {}
+        area_fields = None
+        values = []
+        for base, first in self._layout[offset:offset + count]:
+            if base != None:
+                block = blocks.get(base)
+                if block == None:
+                    block = blocks[base] = self.inputs.getWord(base, self._zones)
+                values.append((block >> first) & 0xffff)
+            elif first == None:
+                values.append(self.status)
+            else:
+                if area_fields == None:
+                    area_fields = [(bit, self.inputs.getWord(base, self._areas)) for bit, base in self._area_bits]
+                word = 0
+                for bit, block in area_fields:
+                    word |= ((block >> first) & 1) << bit
+                values.append(word)
+        return values
+
+    # Read only
+    def setValues(self, address, values):
+        pass
+
+# Read discrete inputs (0x02) response built from already packed bytes
+class PackedDiscreteInputsResponse(ReadDiscreteInputsResponse):
+    packed = None
+
+    def __init__(self, packed, **kwargs):
+        ReadDiscreteInputsResponse.__init__(self, None, **kwargs)
+        self.packed = packed
+
+    def encode(self):
+        return struct.pack(">B", len(self.packed)) + self.packed
+
+    def __str__(self):
+        return "%s(%d bytes)" % (self.__class__.__name__, len(self.packed))
+
+# Read discrete inputs (0x02) served from a BitmapDataBlock without
+# converting the range to a list of bits (registered with the server as a
+# custom function)
+class BitmapReadDiscreteInputsRequest(ReadDiscreteInputsRequest):
+    def execute(self, context):
+        block = context.store.get("d")
+        if not isinstance(block, BitmapDataBlock):
+            return ReadDiscreteInputsRequest.execute(self, context)
+        if not (1 <= self.count <= 0x7d0):
+            return self.doException(merror.IllegalValue)
+        address = self.address + (0 if context.zero_mode else 1)
+        if not block.validate(address, self.count):
+            return self.doException(merror.IllegalAddress)
+        return PackedDiscreteInputsResponse(block.getBytes(address, self.count))
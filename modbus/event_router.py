@@ -0,0 +1,154 @@
+import json
+import logging
+from common.config import get_config_default, panel_topic
+from common.binary import decode_state
+
+# TopicTrie class
+# Maps MQTT topic filters ("+" wildcards only) to handlers, one trie level
+# per topic level. Matching is greedy: an exact level is preferred over "+"
+# without backtracking, so filters must not overlap beyond that.
+class TopicTrie:
+    _root = None
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, topic_filter, handler):
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.setdefault(level, {})
+        node[None] = handler
+
+    # Handler for <topic> or None
+    def match(self, topic):
+        node = self._root
+        for level in topic.split("/"):
+            next_node = node.get(level)
+            if next_node == None:
+                next_node = node.get("+")
+                if next_node == None:
+                    return None
+            node = next_node
+        return node.get(None)
+
+# EventRouter class
+# Feeds MQTT messages to the Modbus slave. Every topic family has its own
+# handler; topics are looked up in a TopicTrie built once from routes()
+# instead of being matched against regular expressions; the result is
+# cached per topic (the panel publishes a bounded set of topics). The data
+# block updates of one message are collected and written by a single Modbus
+# flush. With queue.panel set, the topics of that panel of a prt3_mqtt
+# serving several panels are used (see panel_topic).
+class EventRouter:
+    _log = None
+    _modbus = None
+    _snapshot_callback = None
+    _trie = None
+    _cache = None
+
+    cache_size = 4096
+
+    events_topic = None
+    binary_topic = None
+    snapshot_topic = None
+    responses_topic = None
+
+    def __init__(self, config, modbus, logger_name, snapshot_callback = None):
+        self._log = logging.getLogger(logger_name)
+        self._modbus = modbus
+        self._snapshot_callback = snapshot_callback
+        self.events_topic = panel_topic(config, "events")
+        self.binary_topic = panel_topic(config, "binary")
+        state_topic = panel_topic(config, "state")
+        if state_topic:
+            self.snapshot_topic = state_topic + "/snapshot"
+        client_name = get_config_default(config, "queue.client_name", None)
+        if client_name:
+            self.responses_topic = panel_topic(config, "responses") + "/" + client_name
+
+        self._cache = {}
+        self._trie = TopicTrie()
+        for topic_filter, handler in self.routes():
+            self._trie.add(topic_filter, handler)
+
+    # [(topic filter, handler(userdata, msg))]
+    def routes(self):
+        routes = [
+            (self.events_topic + "/+/+", self.on_event),
+            (self.events_topic + "/+/batch", self.on_batch)
+        ]
+        if self.binary_topic:
+            routes.append((self.binary_topic + "/+/+", self.on_binary))
+        if self.snapshot_topic:
+            routes.append((self.snapshot_topic, self.on_snapshot))
+        if self.responses_topic:
+            routes.append((self.responses_topic + "/+", self.on_response))
+        return routes
+
+    # Handles <msg> if its topic is routed; returns False otherwise
+    def dispatch(self, userdata, msg):
+        topic = msg.topic
+        handler = self._cache.get(topic)
+        if handler == None:
+            handler = self._trie.match(topic)
+            if handler == None:
+                return False
+            if len(self._cache) < self.cache_size:
+                self._cache[topic] = handler
+        handler(userdata, msg)
+        return True
+
+    def _parse(self, msg):
+        try:
+            return json.loads(msg.payload)
+        except:
+            self._log.error("Unable to parse message from queue: %s" % (msg.payload))
+            return None
+
+    # "<events>/<type>/<n>"
+    def on_event(self, userdata, msg):
+        event_type, event_input = msg.topic[len(self.events_topic) + 1:].split("/")
+        if not event_input.isdigit():
+            return
+        message_data = self._parse(msg)
+        if message_data:
+            self._modbus.process_queue_event(event_type, event_input, message_data)
+            self._modbus.flush()
+
+    # "<events>/<family>/batch"; items carry their own topic
+    def on_batch(self, userdata, msg):
+        message_data = self._parse(msg)
+        if not message_data:
+            return
+        for item in message_data["events"]:
+            item_topic = (item["topic"] or "").split("/")
+            if (len(item_topic) == 2) and item_topic[1].isdigit():
+                self._modbus.process_queue_event(item_topic[0], item_topic[1], item["event"])
+        self._modbus.flush()
+
+    # Compact binary entity state
+    def on_binary(self, userdata, msg):
+        try:
+            kind, state = decode_state(msg.payload)
+        except:
+            self._log.error("Unable to decode binary state in topic %s" % (msg.topic))
+            return
+        self._modbus.process_queue_event(kind, state["id"], {"data": state})
+        self._modbus.flush()
+
+    # Retained snapshot of the panel model (once, at startup; bulk loaded)
+    def on_snapshot(self, userdata, msg):
+        message_data = self._parse(msg)
+        if not message_data:
+            return
+        self._log.info("Loading zone and area states from snapshot")
+        self._modbus.load_snapshot(message_data)
+        if self._snapshot_callback:
+            self._snapshot_callback()
+
+    # "<responses>/<client>/<operation>": answer to a request sent for a
+    # Modbus write
+    def on_response(self, userdata, msg):
+        message_data = self._parse(msg)
+        if message_data:
+            self._modbus.process_response(message_data)
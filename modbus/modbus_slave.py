@@ -1,23 +1,52 @@
+import asyncio
+import importlib
 import logging
 import sys
+import time
 import paho.mqtt.client as mqtt
-from pymodbus.server.async import StartTcpServer
 from pymodbus.device import ModbusDeviceIdentification
-from pymodbus.datastore import ModbusSequentialDataBlock
-from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
+from pymodbus.datastore import ModbusServerContext
 from pymodbus.transaction import ModbusRtuFramer, ModbusAsciiFramer
 from common.config import get_config, get_config_default
+from modbus.datastore import RegisterMap, BitmapDataBlock, BitmapRegisterBlock, BitmapReadDiscreteInputsRequest, status_bits
+from modbus.control import ControlRequests, ControlSlaveContext, ControlCoilBlock, ControlRegisterBlock
 
 logger_name = 'modbus_mqtt'
 
+# pymodbus TCP server for the twisted reactor (blocking) or for asyncio
+def twisted_server():
+    try:
+        return importlib.import_module("pymodbus.server.asynchronous").StartTcpServer
+    except ImportError:
+        # pymodbus < 2.0 (module name is a keyword since Python 3.7)
+        return importlib.import_module("pymodbus.server.async").StartTcpServer
+
+def asyncio_server():
+    return importlib.import_module("pymodbus.server.async_io").StartTcpServer
+
 class Modbus:
     _log = None
     _config = None
     _modbus_callback = None
+    _pending = None
+    _updated = None
+    _server = None
+    _closing = False
 
     store = None
     context = None
     identity = None
+    map = None
+    inputs = None
+    registers = None
+    control = None
+    coils = None
+    holding = None
+    ready = False
+
+    # Pending connections of the asyncio server (many masters connecting at
+    # once)
+    backlog = 128
 
     def __init__(self, config, modbus_callback):
         self._log = logging.getLogger(logger_name)
@@ -25,10 +54,37 @@ class Modbus:
 
         self._log.info("Initializing Modbus slave")
         self._modbus_callback = modbus_callback
+        self._pending = {}
+        self._updated = set()
+
+        # Discrete inputs: packed bitmap laid out by modbus.map
+        self.map = RegisterMap(get_config(config, "modbus.map.zone"), get_config(config, "modbus.map.area"),
+            get_config(config, "modbus.zones"), get_config(config, "modbus.areas"))
+        self.inputs = BitmapDataBlock(1, self.map.size)
 
-        self.store = ModbusSlaveContext(
-           di = ModbusSequentialDataBlock(1, [0]*384)
-           # di = ModbusSequentialDataBlock(1, [0]*192)
+        # Input and holding registers: packed 16-bit view of the same bitmap
+        # (zone flags, 16 per register, and area status words)
+        self.registers = BitmapRegisterBlock(1, self.inputs, self.map)
+
+        # Coils and area control holding registers: writes are sent to
+        # prt3_mqtt as requests through <modbus_callback>(payload, topic)
+        self.control = ControlRequests(modbus_callback, get_config(config, "queue.client_name"),
+            get_config(config, "modbus.control.code"), get_config(config, "modbus.control.timeout"), logger_name)
+        self.coils = ControlCoilBlock(1, self.control, get_config(config, "modbus.control.coils"), {
+            "arm": self.map.areas,
+            "stay": self.map.areas,
+            "disarm": self.map.areas,
+            "vinput": get_config(config, "modbus.control.vinputs"),
+            "utilitykey": get_config(config, "modbus.control.utility_keys")
+        })
+        self.holding = ControlRegisterBlock(1, self.registers, self.control,
+            get_config(config, "modbus.control.registers.area"), self.map.areas)
+
+        self.store = ControlSlaveContext(
+           di = self.inputs,
+           co = self.coils,
+           ir = self.registers,
+           hr = self.holding
         )
 
         self.context = ModbusServerContext(slaves=self.store, single=True)
@@ -40,41 +96,127 @@ class Modbus:
         self.identity.ProductName = 'paradox-modbus interface'
         self.identity.ModelName   = 'paradox-modbus interface'
         self.identity.MajorMinorRevision = '1.0'
+
+        # Not ready until the state snapshot is loaded (see load_snapshot);
+        # without a state topic only events are available
+        if get_config_default(config, "queue.queues.state", None):
+            self._log.info("Modbus data not ready until the state snapshot is loaded")
+        else:
+            self._log.warning("No state topic configured; Modbus data is built from events only")
+            self.set_ready()
     
     def setValue(self, addr, value):
         self._log.debug("modbus.setValue: addr=%s, value=%s" % (addr, value))
         fx=0x2
         self.context.setValues(fx, addr, value)
 
+    # Discrete input updates are collected by process_queue_event and written
+    # to the bitmap by flush(), once per MQTT message
+    def flush(self):
+        if not self._pending:
+            return
+        for addr, value in self._pending.items():
+            self.inputs.setBit(addr, value)
+        self._pending = {}
+
+    # Twisted reactor; blocks until the reactor is stopped (^C)
     def loop(self):
         port = get_config(self._config, "modbus.port")
         listen_addr = get_config(self._config, "modbus.listen_addr")
-        StartTcpServer(self.context, identity=self.identity, address=(listen_addr, port))
+        from twisted.internet import reactor
+        self.control.schedule = reactor.callLater
+        twisted_server()(self.context, identity=self.identity, address=(listen_addr, port),
+            custom_functions=[BitmapReadDiscreteInputsRequest])
+
+    # asyncio mode: serves Modbus TCP on the running event loop until close()
+    async def serve(self):
+        port = get_config(self._config, "modbus.port")
+        listen_addr = get_config(self._config, "modbus.listen_addr")
+        self.control.schedule = asyncio.get_running_loop().call_later
+        self._server = await asyncio_server()(self.context, identity=self.identity, address=(listen_addr, port),
+            custom_functions=[BitmapReadDiscreteInputsRequest], allow_reuse_address=True, backlog=self.backlog)
+        self._log.info("Modbus TCP server listening on %s:%d" % (listen_addr, port))
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            if not self._closing:
+                raise
 
     def process_queue_event(self, event_type, event_input, event_data):
         # self._log.debug("Processing queue event: %s / %s / %s" % (type, input, data))
-        slave_id = 0x00
-        ctx = self.context[slave_id]
         if event_type == "zone":
-            try:
-                zone_number = event_data["data"]["id"]
-                zone_open = event_data["data"]["open"]
-                zone_tamper = event_data["data"]["tamper"]
+            count = self.map.zones
+        elif event_type == "area":
+            count = self.map.areas
+        else:
+            return
+
+        try:
+            data = event_data["data"]
+            number = data["id"]
+            if not (0 < number <= count):
+                return
+
+            self._log.info("Processing %s %d event" % (event_type, number))
+            if not self.ready:
+                self._updated.add((event_type, number))
+
+            # Events carry only the changed fields
+            fields = self.map.fields[event_type]
+            for field, state in data.items():
+                base = fields.get(field)
+                if (base != None) and (state != None):
+                    self._pending[base + number - 1] = 1 if state else 0
+        except:
+            self._log.error("Unable to parse %s event: %s" % (event_type, event_data))
 
-                addr_spacing = 192
-                modbus_open_addr = zone_number-1
-                modbus_tamper_addr = modbus_open_addr + addr_spacing
-                modbus_alarm_addr = modbus_tamper_addr + addr_spacing
-                modbus_lowbatt_addr = modbus_alarm_addr + addr_spacing
+    # Loads all zones and areas of a panel snapshot ({"zone": {id: state},
+    # "area": {id: state}}) with one write of the discrete input bitmap.
+    # Entities updated by events received before the snapshot keep their
+    # state. Sets the ready status.
+    def load_snapshot(self, snapshot):
+        start = time.time()
+        self.flush()
+        value = 0
+        mask = 0
+        loaded = 0
+        for kind, count in (("zone", self.map.zones), ("area", self.map.areas)):
+            fields = self.map.fields[kind]
+            for entity in snapshot.get(kind, {}).values():
+                try:
+                    number = entity["id"]
+                except:
+                    self._log.error("Unable to parse %s in snapshot: %s" % (kind, entity))
+                    continue
+                if (not (0 < number <= count)) or ((kind, number) in self._updated):
+                    continue
+                for field, base in fields.items():
+                    bit = 1 << (base + number - 1)
+                    mask |= bit
+                    if entity.get(field):
+                        value |= bit
+                loaded += 1
 
-                self._log.info("Processing zone %d event" % (zone_number))
+        current = int.from_bytes(self.inputs.bits, "little")
+        self.inputs.load((current & ~mask) | value)
+        self._log.info("Loaded %d zones and areas from snapshot in %.1f ms (%d kept from events)" % (loaded, (time.time() - start) * 1000, len(self._updated)))
+        self.set_ready()
 
-                fx = 0x02
-                ctx.setValues(fx, modbus_open_addr, [zone_open*1])
-                ctx.setValues(fx, modbus_tamper_addr, [zone_tamper*1])
-            except:
-                self._log.error("Unable to parse zone event: %s" % (event_data))
+    def set_ready(self):
+        self.ready = True
+        self._updated = set()
+        self.registers.status |= 1 << status_bits.index("ready")
 
+    # Response of prt3_mqtt to a request sent for a Modbus write
+    def process_response(self, response_data):
+        self.control.response(response_data)
 
     def close(self):
-            self._log.info("Destroying Modbus slave")
+        self._log.info("Destroying Modbus slave")
+        self._closing = True
+        if self._server and self._server.server:
+            # Masters are disconnected; the server only finishes closing
+            # when no connection is left
+            for connection in list(self._server.active_connections.values()):
+                connection.transport.close()
+            self._server.server_close()
@@ -1,6 +1,7 @@
 import logging
 import sys
-from common.config import get_config, get_config_default
+from common.config import get_config, get_config_default, panel_topic
+from common.mqtt_asyncio import AsyncioHelper
 import paho.mqtt.client as mqtt
 
 logger_name = 'modbus_mqtt'
@@ -10,15 +11,19 @@ class Client:
     _config = None
     _client = None
     _msg_callback = None
+    _aio = None
 
     client_name = None
+    requests_topic = None
+    snapshot_topic = None
+    binary_topic = None
 
     def _on_connect(self, client, userdata, flags, rc):
         self._log.info("Connected to queue with result code %d" % (rc))
 
-        req_topic_events = get_config(self._config, "queue.queues.events") + "/#"
-        req_topic_broadcasts = get_config(self._config, "queue.queues.broadcasts") + "/#"
-        req_topic_responses = get_config(self._config, "queue.queues.responses") + "/" + self.client_name+ "/#"
+        req_topic_events = panel_topic(self._config, "events") + "/#"
+        req_topic_broadcasts = panel_topic(self._config, "broadcasts") + "/#"
+        req_topic_responses = panel_topic(self._config, "responses") + "/" + self.client_name+ "/#"
 
         self._log.info("Subscribing to topic: %s" % (req_topic_events))
         self._log.info("Subscribing to topic: %s" % (req_topic_broadcasts))
@@ -27,25 +32,55 @@ class Client:
         client.subscribe(req_topic_broadcasts)
         client.subscribe(req_topic_responses)
 
+        # Retained model snapshot to bootstrap from
+        if self.snapshot_topic:
+            self._log.info("Subscribing to topic: %s" % (self.snapshot_topic))
+            client.subscribe(self.snapshot_topic)
+
+        # Compact binary entity states
+        if self.binary_topic:
+            self._log.info("Subscribing to topic: %s/#" % (self.binary_topic))
+            client.subscribe(self.binary_topic + "/#")
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._log.info("Disconnected from queue with result code %d" % (rc))
+        if self._aio:
+            self._aio.disconnected(rc)
+
     def _on_message(self, client, userdata, msg):
         if self._msg_callback:
             self._msg_callback(userdata, msg)
 
+    # Initial state is loaded; further changes arrive as events
+    def snapshot_received(self):
+        if self.snapshot_topic:
+            self._client.unsubscribe(self.snapshot_topic)
+            self.snapshot_topic = None
+
     def send_request(self, payload, topic = None):
         try:
-            _topic = get_config(self._config, "queue.queues.requests") + (("/" + topic) if topic else "")
+            _topic = self.requests_topic + (("/" + topic) if topic else "")
             self._client.publish(_topic, payload)
         except:
             self._log.error("Unable to send MQTT request")
 
-    def __init__(self, config, msg_callback):
+    # With an asyncio event loop given, the MQTT client is driven from that
+    # loop; otherwise paho runs its own network thread. Topics are those of
+    # the panel selected by queue.panel (see panel_topic).
+    def __init__(self, config, msg_callback, loop = None):
         self._log = logging.getLogger(logger_name)
         self._config = config
         self.client_name = get_config(config, "queue.client_name")
+        self.requests_topic = panel_topic(config, "requests")
+        state_topic = panel_topic(config, "state")
+        if state_topic:
+            self.snapshot_topic = state_topic + "/snapshot"
+        self.binary_topic = panel_topic(config, "binary")
 
         self._client = mqtt.Client(client_id = self.client_name)
         self._client.on_connect = self._on_connect
         self._client.on_message = self._on_message
+        self._client.on_disconnect = self._on_disconnect
 
         tls_enabled = False
         if (get_config_default(config, "queue.tls", False)):
@@ -66,8 +101,14 @@ class Client:
         self._client.connect_async(get_config(self._config, "queue.host"), get_config(self._config, "queue.port"))
 
         self._msg_callback = msg_callback
-        self._client.loop_start()
+        if loop:
+            self._aio = AsyncioHelper(loop, self._client, logger_name)
+            self._aio.connect()
+        else:
+            self._client.loop_start()
 
     def close(self):
         self._log.info("Disconnecting from message broker")
+        if self._aio:
+            self._aio.close()
         self._client.disconnect()
@@ -2,14 +2,14 @@
 
 import logging
 import sys
-import time
 import json
 import signal
+import asyncio
 import argparse
-import re
-from common.config import get_config
+from common.config import get_config, get_config_default, compile_config, modbus_schema, ConfigError
 from modbus.queue_client import Client
 from modbus.modbus_slave import Modbus
+from modbus.event_router import EventRouter
 from threading import Lock
 
 # Global constants
@@ -18,6 +18,8 @@ logger_name = 'modbus_mqtt'
 # Global variables
 config = None
 can_exit = False
+loop = None
+exit_event = None
 
 # Parse arguments
 parser = argparse.ArgumentParser(description='Paradox PRT3 to MQTT interface')
@@ -49,6 +51,14 @@ except:
     type, value, traceback = sys.exc_info()
     log.error("Unable to read configuration: %s" % (value))
 
+# Validate configuration (all problems are reported at once)
+try:
+    config = compile_config(config, modbus_schema)
+except ConfigError as e:
+    for error in e.errors:
+        log.error("Invalid configuration: %s" % (error))
+    sys.exit(1)
+
 # Set loglevel
 loglevel_string = get_config(config, "debug.loglevel").upper()
 try:
@@ -79,37 +89,78 @@ if get_config(config, "debug.enabled"):
 
 def mqtt_callback(userdata, msg):
     log.debug("Received MQTT message in topic %s" % (msg.topic))
-
-    message_data = None
+    router.dispatch(userdata, msg)
+
+def snapshot_received():
+    queue.snapshot_received()
+
+# Modbus write: request for prt3_mqtt
+def modbus_callback(payload, topic):
+    queue.send_request(payload, topic)
+
+# SIGINT / SIGTERM in asyncio mode (the twisted reactor handles its own)
+def exit_gracefully():
+    global can_exit
+    if (not can_exit):
+        log.info("Caught signal; exitting")
+        can_exit = True
+        exit_event.set()
+    else:
+        log.info("Caught second signal; force exitting")
+        sys.exit(1)
+
+# Main loop (twisted reactor for Modbus TCP; MQTT on paho network thread)
+def main():
+    global queue
+
+    # Init MQTT queue and set callback; events are routed by topic family
+    queue = Client(config, mqtt_callback)
+
+    modbus.loop()
+
+    queue.close()
+    modbus.close()
+
+# Main loop (asyncio; Modbus TCP server and MQTT on a single event loop, so
+# the datastore is only ever touched from the loop)
+async def main_async():
+    global loop
+    global exit_event
+    global queue
+
+    loop = asyncio.get_running_loop()
+    exit_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, exit_gracefully)
+
+    # Init MQTT queue and set callback; events are routed by topic family
+    queue = Client(config, mqtt_callback, loop)
+
+    server = loop.create_task(modbus.serve())
+    exit_wait = loop.create_task(exit_event.wait())
+    await asyncio.wait((server, exit_wait), return_when = asyncio.FIRST_COMPLETED)
+    exit_wait.cancel()
+
+    queue.close()
+    modbus.close()
     try:
-        message_data = json.loads(msg.payload)
-    except:
-        log.error("Unable to parse message from queue: %s" % (msg.payload))
-
-    if message_data:
-        # Check if incoming message is event
-        topic_events = get_config(config, "queue.queues.events")
-        topic_regex = "^"+topic_events+"/([^/]+)/([0-9]+)$"
-        if re.search(topic_regex, msg.topic):
-            rx = re.split(topic_regex, msg.topic)
-            event_type = rx[1]
-            event_input = rx[2]
-            modbus.process_queue_event(event_type, event_input, message_data)
-
-def modbus_callback():
-    log.debug("Received Modbus request")
+        await server
+    except Exception as e:
+        log.error("Modbus TCP server failed: %s" % (e))
+        return 1
+    return 0
 
-# Init MQTT queue and set callback
-queue = Client(config, mqtt_callback)
-
-# Init MQTT queue and set callback
-modbus = Modbus(config, modbus_callback)
-
-modbus.loop()
-
-# while (not can_exit):
-    # modbus.loop
-    #time.sleep(0.5)
-
-queue.close()
-modbus.close()
+# Init Modbus slave and set callback
+try:
+    modbus = Modbus(config, modbus_callback)
+except ConfigError as e:
+    for error in e.errors:
+        log.error("Invalid configuration: %s" % (error))
+    sys.exit(1)
+router = EventRouter(config, modbus, logger_name, snapshot_received)
+
+if get_config_default(config, "mode", "asyncio") == "asyncio":
+    log.info("Running in asyncio mode")
+    sys.exit(asyncio.run(main_async()))
+else:
+    main()
@@ -0,0 +1,96 @@
+import json
+import logging
+import threading
+from paradox.payload import encode_event, has_fragment
+
+# Batch size histogram buckets (upper bounds; larger batches go to "inf")
+batch_buckets = (1, 2, 4, 8, 16, 32, 64)
+
+# EventBatcher class
+# Optional micro-batching of outbound events. Events are collected per topic
+# family (first topic level: "zone/5" -> "zone") for a short window, or until
+# a family holds <max_items> events, and then sent as one message on
+# "<family>/batch":
+#
+#   {"type": "batch", "family": "zone", "events": [{"topic": "zone/5", "event": {...}}, ...]}
+#
+# With compat set every event is also sent on its own topic as before.
+# <schedule>(delay, callback) arms the window timer (threading.Timer or
+# loop.call_later).
+class EventBatcher:
+    _log = None
+    _send = None
+    _schedule = None
+    _lock = None
+    _pending = None
+    _armed = False
+    _histogram = None
+    _batches = 0
+    _events = 0
+
+    window = None
+    max_items = None
+    compat = False
+
+    def __init__(self, send, schedule, window, max_items, compat, logger_name):
+        self._log = logging.getLogger(logger_name)
+        self._send = send
+        self._schedule = schedule
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._histogram = [0] * (len(batch_buckets) + 1)
+        self.window = window
+        self.max_items = max_items
+        self.compat = compat
+
+    def add(self, event, topic = None):
+        data = encode_event(event) if has_fragment(event) else json.dumps(event)
+        if self.compat:
+            self._send(data, topic)
+
+        family = topic.split("/", 1)[0] if topic else "events"
+        with self._lock:
+            items = self._pending.setdefault(family, [])
+            items.append('{"topic":%s,"event":%s}' % (json.dumps(topic), data))
+            full = len(items) >= self.max_items
+            if full:
+                del self._pending[family]
+            arm = (not full) and (not self._armed)
+            if arm:
+                self._armed = True
+
+        if full:
+            self._send_batch(family, items)
+        if arm:
+            self._schedule(self.window, self.flush)
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._armed = False
+
+        for family, items in pending.items():
+            self._send_batch(family, items)
+
+    def _send_batch(self, family, items):
+        for bucket, limit in enumerate(batch_buckets):
+            if len(items) <= limit:
+                break
+        else:
+            bucket = len(batch_buckets)
+        self._histogram[bucket] += 1
+        self._batches += 1
+        self._events += len(items)
+
+        self._log.debug("Sending batch of %d %s events" % (len(items), family))
+        self._send('{"type":"batch","family":%s,"events":[%s]}' % (json.dumps(family), ",".join(items)), family + "/batch")
+
+    def getData(self):
+        histogram = dict((str(limit), self._histogram[bucket]) for bucket, limit in enumerate(batch_buckets))
+        histogram["inf"] = self._histogram[-1]
+        return {
+            "batches": self._batches,
+            "events": self._events,
+            "histogram": histogram
+        }
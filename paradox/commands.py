@@ -0,0 +1,229 @@
+import logging
+import heapq
+import itertools
+import threading
+import time
+from paradox.tokenizer import match_response
+
+# Command priorities (lower value is served first)
+PRIORITY_PANIC = 0
+PRIORITY_ARMING = 1
+PRIORITY_CONTROL = 2
+PRIORITY_POLL = 3
+
+priority_names = {
+    PRIORITY_PANIC: "panic",
+    PRIORITY_ARMING: "arming",
+    PRIORITY_CONTROL: "control",
+    PRIORITY_POLL: "poll"
+}
+
+# CommandStats class
+# Queue depth and wait time (queued -> sent) counters per priority
+class CommandStats:
+    _queued = None
+    _count = None
+    _wait_total = None
+    _wait_max = None
+
+    def __init__(self):
+        self._queued = dict((p, 0) for p in priority_names)
+        self._count = dict((p, 0) for p in priority_names)
+        self._wait_total = dict((p, 0.0) for p in priority_names)
+        self._wait_max = dict((p, 0.0) for p in priority_names)
+
+    def queued(self, priority):
+        self._queued[priority] += 1
+
+    def sent(self, priority, wait):
+        self._queued[priority] -= 1
+        self._count[priority] += 1
+        self._wait_total[priority] += wait
+        if wait > self._wait_max[priority]:
+            self._wait_max[priority] = wait
+
+    def dequeued(self, priority):
+        self._queued[priority] -= 1
+
+    def getData(self):
+        ret = {}
+        for priority, name in priority_names.items():
+            count = self._count[priority]
+            ret[name] = {
+                "queued": self._queued[priority],
+                "sent": count,
+                "wait_avg": (self._wait_total[priority] / count) if count else 0.0,
+                "wait_max": self._wait_max[priority]
+            }
+        return ret
+
+# PriorityLock class
+# Lock for the blocking PRT: when released, ownership goes to the waiter
+# with the highest priority (FIFO within the same priority). Only command
+# acquisitions are counted in the stats (not setup or serial reads).
+class PriorityLock:
+    _cond = None
+    _owned = False
+    _waiters = None
+    _seq = None
+
+    stats = None
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+        self.stats = CommandStats()
+
+    def acquire(self, priority = PRIORITY_POLL, counted = True):
+        queued = time.time()
+        with self._cond:
+            if counted:
+                self.stats.queued(priority)
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            while self._owned or (self._waiters[0] != entry):
+                self._cond.wait()
+            heapq.heappop(self._waiters)
+            self._owned = True
+            if counted:
+                self.stats.sent(priority, time.time() - queued)
+
+    def release(self):
+        with self._cond:
+            self._owned = False
+            self._cond.notify_all()
+
+# Queued / in-flight PRT3 command
+class PRT_Command:
+    cmd = None
+    prefix = None
+    regex = None
+    future = None
+    timeout = None
+    timer = None
+    priority = None
+    queued = None
+
+    def __init__(self, cmd, regex, future, timeout, priority):
+        self.cmd = cmd
+        self.prefix = cmd[:5]
+        self.regex = regex
+        self.future = future
+        self.timeout = timeout
+        self.priority = priority
+        self.queued = time.time()
+
+# CommandEngine class
+# Keeps several PRT3 commands in flight and correlates replies with
+# requests by their echo prefix (RZ005, AA001&ok, ZL012, ...). Every caller
+# gets a future resolved with the matched response (list of re.split() style
+# matches, same as PRT.prt3_command) or None on failure / timeout. Only one
+# command per prefix is in flight at a time so replies are unambiguous.
+# While a higher priority command is waiting (eg. behind a command with the
+# same prefix), polls leave the last pipeline slot free for it.
+class CommandEngine:
+    _log = None
+    _loop = None
+    _write = None
+    _queue = None
+    _inflight = None
+    _urgent = 0
+
+    depth = 4
+    timeout = 5.0
+
+    def __init__(self, loop, write, logger_name, depth = None, timeout = None):
+        self._log = logging.getLogger(logger_name)
+        self._loop = loop
+        self._write = write
+        self._queue = []
+        self._seq = itertools.count()
+        self._inflight = {}
+        self.stats = CommandStats()
+        if depth:
+            self.depth = depth
+        if timeout:
+            self.timeout = timeout
+
+    def submit(self, cmd, regex, timeout = None, priority = PRIORITY_POLL):
+        command = PRT_Command(cmd, regex, self._loop.create_future(), timeout or self.timeout, priority)
+        heapq.heappush(self._queue, (priority, next(self._seq), command))
+        self.stats.queued(priority)
+        if priority != PRIORITY_POLL:
+            self._urgent += 1
+        self._pump()
+        return command.future
+
+    # Send queued commands while there is room in the pipeline
+    def _pump(self):
+        blocked = []
+        while self._queue:
+            priority, seq, command = self._queue[0]
+            limit = self.depth - 1 if (priority == PRIORITY_POLL) and self._urgent and (self.depth > 1) else self.depth
+            if len(self._inflight) >= limit:
+                break
+
+            heapq.heappop(self._queue)
+            if command.future.done():
+                # Caller gave up (cancelled) before the command was sent
+                self.stats.dequeued(priority)
+                if priority != PRIORITY_POLL:
+                    self._urgent -= 1
+                continue
+            if command.prefix in self._inflight:
+                # Same prefix already waiting for a reply; keep for later
+                blocked.append((priority, seq, command))
+                continue
+
+            if priority != PRIORITY_POLL:
+                self._urgent -= 1
+            self._inflight[command.prefix] = command
+            self.stats.sent(priority, time.time() - command.queued)
+            self._log.debug("Sending command: %s" % (command.cmd))
+            self._write(command.cmd)
+            command.timer = self._loop.call_later(command.timeout, self._expire, command)
+
+        for entry in blocked:
+            heapq.heappush(self._queue, entry)
+
+    def _finish(self, command, result):
+        del self._inflight[command.prefix]
+        command.timer.cancel()
+        if not command.future.done():
+            command.future.set_result(result)
+        self._pump()
+
+    def _expire(self, command):
+        self._log.warning("No response to command %s" % (command.prefix))
+        self._finish(command, None)
+
+    # Match reply token against in-flight commands; returns False when the
+    # reply does not belong to any of them
+    def resolve(self, token):
+        command = self._inflight.get(token.prefix)
+        if command == None:
+            return False
+
+        rx = match_response(token, command.regex)
+        if rx:
+            self._finish(command, [rx])
+        elif token.data == "&fail":
+            self._log.warning("Command %s failed" % (command.prefix))
+            self._finish(command, None)
+        else:
+            return False
+        return True
+
+    def pending(self):
+        return len(self._queue) + len(self._inflight)
+
+    def close(self):
+        for command in list(self._inflight.values()) + [entry[2] for entry in self._queue]:
+            if command.timer:
+                command.timer.cancel()
+            if not command.future.done():
+                command.future.cancel()
+        self._inflight.clear()
+        del self._queue[:]
+        self._urgent = 0
@@ -0,0 +1,89 @@
+# LineFramer class
+# Splits the byte stream received from PRT3 into lines without copying
+#
+# Incoming chunks are appended to a single bytearray. The buffer is scanned
+# for the delimiter only from the offset where the previous scan stopped and
+# complete lines are handed out either as memoryview slices of the buffer
+# (frames) or decoded in a single pass when dispatched (lines). Consumed
+# bytes are dropped from the front of the buffer lazily (once they make up
+# more than half of it), so large bursts are processed in linear time.
+class LineFramer:
+    _buffer = None
+    _delimiter = None
+    _start = 0
+    _scan = 0
+
+    def __init__(self, delimiter = b"\r"):
+        self._buffer = bytearray()
+        self._delimiter = delimiter
+
+    def feed(self, data):
+        self._buffer += data
+
+    def pending(self):
+        # Number of buffered bytes not yet returned as a line
+        return len(self._buffer) - self._start
+
+    # Yields complete lines (without delimiter) as memoryview slices
+    # Each slice is only valid until the next one is requested; decode or
+    # copy it before moving on
+    def frames(self):
+        buf = self._buffer
+        delimiter = self._delimiter
+        end = buf.find(delimiter, self._scan)
+        if end < 0:
+            self._scan = len(buf)
+            return
+
+        view = memoryview(buf)
+        try:
+            while end >= 0:
+                frame = view[self._start:end]
+                self._start = self._scan = end + len(delimiter)
+                try:
+                    yield frame
+                finally:
+                    frame.release()
+                end = buf.find(delimiter, self._scan)
+            self._scan = len(buf)
+        finally:
+            view.release()
+            self._compact()
+
+    # Returns all complete lines decoded to str
+    # The whole run of complete lines is decoded straight from the buffer in
+    # one call and split afterwards, which is considerably cheaper in Python
+    # than decoding every memoryview slice separately
+    def lines(self, encoding = "ascii", errors = "replace"):
+        buf = self._buffer
+        delimiter = self._delimiter
+        end = buf.rfind(delimiter, self._scan)
+        self._scan = len(buf)
+        if end < 0:
+            return []
+
+        view = memoryview(buf)
+        try:
+            ret = str(view[self._start:end], encoding, errors).split(delimiter.decode(encoding))
+        finally:
+            view.release()
+        self._start = self._scan = end + len(delimiter)
+        self._compact()
+        return ret
+
+    def _compact(self):
+        if self._start == 0:
+            return
+        if self._start == len(self._buffer):
+            del self._buffer[:]
+        elif self._start > (len(self._buffer) >> 1):
+            del self._buffer[:self._start]
+        else:
+            return
+        self._scan -= self._start
+        self._start = 0
+
+    def clear(self):
+        del self._buffer[:]
+        self._start = 0
+        self._scan = 0
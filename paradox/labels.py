@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import threading
+
+# LabelCache class
+# Persistent area / zone / user labels, so a restart does not need a full
+# AL/ZL/UL sweep before names are known. Labels are stored together with the
+# time they were read from the panel; the file is bound to the panel type and
+# ignored if the panel type changes. Labels are set and saved by the panel
+# sync and invalidated from the MQTT network thread, so access is locked.
+#
+# File format (JSON): {"panel": "EVOHD", "area": {"1": ["Name", 1700000000.0]}, "zone": {...}, "user": {...}}
+class LabelCache:
+    _log = None
+    _path = None
+    _panel_type = None
+    _labels = None
+    _lock = None
+    _dirty = False
+
+    kinds = ("area", "zone", "user")
+
+    def __init__(self, path, panel_type, logger_name):
+        self._log = logging.getLogger(logger_name)
+        self._path = path
+        self._panel_type = panel_type
+        self._labels = dict((kind, {}) for kind in self.kinds)
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not self._path:
+            return False
+
+        try:
+            with open(self._path, "r") as cache_file:
+                data = json.loads(cache_file.read())
+        except (IOError, OSError, ValueError) as e:
+            self._log.info("Label cache not loaded: %s" % (e))
+            return False
+
+        if data.get("panel") != self._panel_type:
+            self._log.info("Label cache belongs to panel type %s; ignoring" % (data.get("panel")))
+            return False
+
+        with self._lock:
+            for kind in self.kinds:
+                self._labels[kind] = dict((int(id), (label[0], label[1])) for id, label in data.get(kind, {}).items())
+        self._log.info("Loaded label cache: %s" % (", ".join("%d %ss" % (len(self._labels[kind]), kind) for kind in self.kinds)))
+        return True
+
+    def save(self):
+        if not self._path:
+            return
+
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {"panel": self._panel_type}
+            for kind in self.kinds:
+                data[kind] = dict((str(id), [name, timestamp]) for id, (name, timestamp) in self._labels[kind].items())
+
+            try:
+                tmp_path = self._path + ".tmp"
+                with open(tmp_path, "w") as cache_file:
+                    cache_file.write(json.dumps(data, separators=(",", ":")))
+                os.rename(tmp_path, self._path)
+                self._dirty = False
+            except (IOError, OSError) as e:
+                self._log.warning("Unable to save label cache: %s" % (e))
+
+    # Returns (name, timestamp) or None
+    def get(self, kind, id):
+        with self._lock:
+            return self._labels[kind].get(id)
+
+    def set(self, kind, id, name, timestamp):
+        with self._lock:
+            current = self._labels[kind].get(id)
+            self._labels[kind][id] = (name, timestamp)
+            if (current == None) or (current[0] != name):
+                self._dirty = True
+            elif timestamp - current[1] >= 60:
+                # Only revalidated; persist new timestamp now and then
+                self._dirty = True
+
+    def invalidate(self):
+        with self._lock:
+            for kind in self.kinds:
+                self._labels[kind].clear()
+            self._dirty = True
+        self.save()
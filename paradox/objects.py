@@ -1,41 +1,121 @@
-class PRT_Area:
-    id = None
-    name = None
-    arm_disarmed = None
-    arm_armed = None
-    arm_force = None
-    arm_stay = None
-    arm_instant = None
-    zone_in_memory = None
-    trouble = None
-    not_ready = None
-    in_programming = None
-    in_alarm = None
-    strobe = None
-
-    last_state_update = None
-    last_name_update = None
+from paradox.store import nan
+from paradox.payload import Fragment
 
-    def __init__(self, id):
-        self.id = id
+# Attribute of a store backed entity mapped to a state bit
+class StoreField:
+    __slots__ = ("field",)
 
+    def __init__(self, field):
+        self.field = field
 
-class PRT_Zone:
-    id = None
-    open = None
-    tamper = None
-    fire = None
-    name = None
-    alarm = None
-    fire_alarm = None
-    supervision_lost = None
-    low_battery = None
+    def __get__(self, entity, owner):
+        if entity == None:
+            return self
+        return entity._store.get(entity._slot, self.field)
 
-    last_state_update = None
-    last_name_update = None
+    def __set__(self, entity, state):
+        entity._store.set(entity._slot, self.field, state)
 
-    def __init__(self, id):
+# Attribute of a store backed entity mapped to a timestamp array (None = NaN)
+class StoreTime:
+    __slots__ = ("array",)
+
+    def __init__(self, array):
+        self.array = array
+
+    def __get__(self, entity, owner):
+        if entity == None:
+            return self
+        timestamp = getattr(entity._store, self.array)[entity._slot]
+        return None if timestamp != timestamp else timestamp
+
+    def __set__(self, entity, timestamp):
+        getattr(entity._store, self.array)[entity._slot] = nan if timestamp == None else timestamp
+
+class StoreName:
+    __slots__ = ()
+
+    def __get__(self, entity, owner):
+        if entity == None:
+            return self
+        return entity._store.names[entity._slot]
+
+    def __set__(self, entity, name):
+        entity._store.names[entity._slot] = name
+
+# Entity view of one StateStore slot (id - 1)
+class PRT_StoreEntity:
+    __slots__ = ("id", "_store", "_slot")
+
+    name = StoreName()
+    last_state_update = StoreTime("state_update")
+    last_name_update = StoreTime("name_update")
+
+    def __init__(self, id, store):
         self.id = id
+        self._store = store
+        self._slot = id - 1
+
+    # Sets several fields at once; returns list of changed fields
+    def update(self, states, now = None):
+        return self._store.changed_fields(self._store.update(self._slot, states, now))
+
+    @property
+    def version(self):
+        return self._store.version[self._slot]
+
+    # getData() as a Fragment; rebuilt only after a state or label change
+    def getFragment(self):
+        cached = self._store.fragments[self._slot]
+        if (cached == None) or (cached[0] != self.version) or (cached[1]["name"] != self.name):
+            cached = (self.version, Fragment(self.getData()))
+            self._store.fragments[self._slot] = cached
+        return cached[1]
+
+
+class PRT_Area(PRT_StoreEntity):
+    __slots__ = ()
+
+    arm_disarmed = StoreField("arm_disarmed")
+    arm_armed = StoreField("arm_armed")
+    arm_force = StoreField("arm_force")
+    arm_stay = StoreField("arm_stay")
+    arm_instant = StoreField("arm_instant")
+    zone_in_memory = StoreField("zone_in_memory")
+    trouble = StoreField("trouble")
+    not_ready = StoreField("not_ready")
+    in_programming = StoreField("in_programming")
+    in_alarm = StoreField("in_alarm")
+    strobe = StoreField("strobe")
+
+    def getData(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "arm_disarmed": self.arm_disarmed,
+            "arm_armed": self.arm_armed,
+            "arm_force": self.arm_force,
+            "arm_stay": self.arm_stay,
+            "arm_instant": self.arm_instant,
+            "zone_in_memory": self.zone_in_memory,
+            "trouble": self.trouble,
+            "not_ready": self.not_ready,
+            "in_programming": self.in_programming,
+            "in_alarm": self.in_alarm,
+            "strobe": self.strobe
+        }
+
+
+class PRT_Zone(PRT_StoreEntity):
+    __slots__ = ()
+
+    open = StoreField("open")
+    tamper = StoreField("tamper")
+    fire = StoreField("fire")
+    alarm = StoreField("alarm")
+    fire_alarm = StoreField("fire_alarm")
+    supervision_lost = StoreField("supervision_lost")
+    low_battery = StoreField("low_battery")
 
     def getData(self):
         return {
@@ -51,13 +131,13 @@ class PRT_Zone:
         }
 
 class PRT_User:
-    id = None
-    name = None
-
-    last_name_update = None
+    __slots__ = ("id", "name", "last_name_update", "_fragment")
 
     def __init__(self, id):
         self.id = id
+        self.name = None
+        self.last_name_update = None
+        self._fragment = None
 
     def getData(self):
         return {
@@ -65,16 +145,22 @@ class PRT_User:
             "name": self.name
         }
 
+    # getData() as a Fragment; rebuilt only after a label change
+    def getFragment(self):
+        if (self._fragment == None) or (self._fragment["name"] != self.name):
+            self._fragment = Fragment(self.getData())
+        return self._fragment
+
 class PRT_PGM:
-    id = None
-    state = None
-    
-    last_status_update = None
+    __slots__ = ("id", "state", "last_status_update")
 
     def __init__(self, id):
         self.id = id
+        self.state = None
+        self.last_status_update = None
 
     def getData(self):
         return {
-            "id": self.id
+            "id": self.id,
+            "state": self.state
         }
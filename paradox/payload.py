@@ -0,0 +1,41 @@
+import json
+
+# Fragment class
+# Entity data (getData() dict) together with its JSON encoding, computed
+# once and reused until the entity changes. It is a plain dict otherwise,
+# so payload consumers do not need to know about it.
+class Fragment(dict):
+    json = None
+
+    def __init__(self, data):
+        dict.__init__(self, data)
+        self.json = json.dumps(data)
+
+# Payload keys which may hold a Fragment (entity data)
+fragment_keys = ("data", "user")
+
+# True if the event payload holds a Fragment (see encode_event)
+def has_fragment(payload):
+    for key in fragment_keys:
+        if type(payload.get(key)) is Fragment:
+            return True
+    return False
+
+# json.dumps() for event payloads: Fragment values are spliced in already
+# encoded instead of being serialized again
+def encode_event(payload):
+    rest = None
+    tail = ""
+    for key in fragment_keys:
+        value = payload.get(key)
+        if type(value) is Fragment:
+            if rest == None:
+                rest = payload.copy()
+            del rest[key]
+            tail += ', "%s": %s' % (key, value.json)
+    if rest == None:
+        return json.dumps(payload)
+
+    if not rest:
+        return "{" + tail[2:] + "}"
+    return json.dumps(rest)[:-1] + tail + "}"
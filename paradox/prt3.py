@@ -3,22 +3,247 @@ import sys
 import serial
 import io
 import re
+import select
+import threading
 import time
-from common.config import get_config
+from common.config import get_config, get_config_default
+from common.binary import zone_fields, area_fields
 from paradox.objects import *
-from threading import Lock
+from paradox.framing import LineFramer
+from paradox.tokenizer import tokenize, match_response, EventToken, PgmToken, CommToken, ReplyToken
+from paradox.commands import PriorityLock, PRIORITY_POLL
+from paradox.scheduler import SyncScheduler
+from paradox.labels import LabelCache
+from paradox.snapshot import StateSnapshot
+from paradox.store import StateStore
 
 logger_name = 'prt3_mqtt'
 
+# Precompiled command response patterns
+regex_area_label = re.compile("^(AL)([0-9]{3})(.{16})$")
+regex_area_status = re.compile("^(RA)([0-9]{3})([DAFSI])([MO])([TO])([NO])([PO])([AO])([SO])$")
+regex_zone_label = re.compile("^(ZL)([0-9]{3})(.{16})$")
+regex_zone_status = re.compile("^(RZ)([0-9]{3})([COTF])([AO])([FO])([SO])([LO])$")
+regex_user_label = re.compile("^(UL)([0-9]{3})(.{16})$")
+
+# Event name tables (built once, shared by all event handlers)
+# Zone events: group -> (log description, event name, zone fields to set, update state timestamp, notify)
+zone_events = {
+    0: ("Zone OK", "ok", (("open", False), ("tamper", False), ("fire", False)), True, True),
+    1: ("Zone open", "open", (("open", True),), True, True),
+    2: ("Zone in tamper", "tamper", (("tamper", True),), True, True),
+    3: ("Zone in fire loop trouble", "fire_loop_trouble", (("fire", True),), True, True),
+    23: ("Zone bypassed", "bypassed", (), False, True),
+    24: ("Zone in alarm", "alarm", (("alarm", True),), False, True),
+    25: ("Zone in fire alarm", "fire_alarm", (("fire_alarm", True),), False, True),
+    26: ("Zone alarm restore", "alarm_restore", (("alarm", False),), False, True),
+    27: ("Zone fire alarm restore", "fire_alarm_restore", (("fire_alarm", False),), False, True),
+    32: ("Zone shutdown", "shutdown", (), False, True),
+    33: ("Zone tamper", "tamper", (("tamper", True),), False, True),
+    34: ("Zone tamper restore", "tamper_restore", (("tamper", False),), False, True),
+    41: ("Zone battery low", "lowbatt", (("low_battery", True),), False, False),
+    42: ("Zone lost supervision", "nosupervision", (("supervision_lost", True),), False, False),
+    43: ("Zone battery low restored", "lowbatt_restore", (("low_battery", False),), False, False),
+    44: ("Zone restored supervision", "nosupervision_restore", (("supervision_lost", False),), False, False),
+    55: ("Intellizone triggered", "intellizone_triggered", (), False, False)
+}
+
+nonreportable_events = {
+    0: "tlm_trouble",
+    1: "smoke_detector_reset",
+    2: "arm_nodelay",
+    3: "arm_in_stay",
+    4: "arm_in_away",
+    5: "fullarm_in_stay",
+    6: "voice_access",
+    7: "remote_access",
+    8: "pc_comm_fail",
+    9: "midnight",
+    10: "ip_user_login",
+    11: "ip_user_logout",
+    12: "user_callup",
+    13: "force_answer",
+    14: "force_hangup"
+}
+
+useraccess_events = {
+    5: "keypad_usercode_entered",
+    6: "door_access",
+    7: "bypass_programming_access"
+}
+
+arming_sources = {
+    9: "mastercode",
+    10: "usercode"
+}
+
+special_arming_events = {
+    0: "auto",
+    1: "winload",
+    2: "late_to_close",
+    3: "no_movement",
+    4: "partial",
+    5: "onetouch",
+    6: "_future_",
+    7: "_future_",
+    8: "invoice_module"
+}
+
+early_late_states = {
+    28: "early",
+    29: "late",
+    46: "early",
+    47: "late"
+}
+
+# Disarm events: group -> (state, source)
+disarming_events = {
+    13: ("ok", "mastercode"),
+    14: ("ok", "usercode"),
+    15: ("ok", "keyswitch"),
+    16: ("after_alarm", "mastercode"),
+    17: ("after_alarm", "usercode"),
+    18: ("after_alarm", "keyswitch"),
+    19: ("during_alarm", "mastercode"),
+    20: ("during_alarm", "usercode"),
+    21: ("during_alarm", "keyswitch")
+}
+
+special_disarming_events = {
+    0: "auto_cancelled",
+    1: "onetouch_instant",
+    2: "winload",
+    3: "winload_afteralarm",
+    4: "winload_cancelledalarm",
+    5: "_future_",
+    6: "_future_",
+    7: "_future_",
+    8: "invoice_module"
+}
+
+special_alarm_sources = {
+    0: "emergency_panic",
+    1: "medical_panic",
+    2: "fire_panic",
+    3: "recent_closing",
+    4: "police_code",
+    5: "global_shutdown"
+}
+
+trouble_events = {
+    36: "trouble",
+    37: "restore"
+}
+
+trouble_sources = {
+    0: "tlm",
+    1: "ac_failure",
+    2: "battery_failure",
+    3: "aux_current_limit",
+    4: "bell_current_limit",
+    5: "bell_absent",
+    6: "clock",
+    7: "global_fire_loop",
+    8: "panel_tamper"
+}
+
+module_trouble_events = {
+    38: "trouble",
+    39: "restore"
+}
+
+module_trouble_sources = {
+    0: "combus_fault",
+    1: "tamper",
+    2: "memory_error",
+    3: "tlm_trouble",
+    4: "fail_to_communicate",
+    5: "printer_fault",
+    6: "ac_failure",
+    7: "battery_failure",
+    8: "aux_failure"
+}
+
+special_events = {
+    0: "full_startup",
+    1: "software_reset",
+    2: "test_report",
+    3: "future_use",
+    4: "winload_in",
+    5: "winload_out",
+    6: "installer_programming_in",
+    7: "installer_programming_out"
+}
+
+door_events = {
+    49: "request_exit",
+    50: "access_denied",
+    51: "left_open_alarm",
+    52: "forced_open_alarm",
+    53: "left_open_restore",
+    54: "forced_open_restore"
+}
+
+combus_events = {
+    58: "module_assigned",
+    59: "module_removed"
+}
+
+access_events = {
+    62: "granted",
+    63: "denied"
+}
+
+# Status events: group -> event -> (event, kind)
+status_events = {
+    64: {
+        0: ("arm", "normal"),
+        1: ("arm", "force"),
+        2: ("arm", "stay"),
+        3: ("arm", "instant"),
+        4: ("alarm", "strobe"),
+        5: ("alarm", "silent"),
+        6: ("alarm", "audible"),
+        7: ("alarm", "fire")
+    },
+    65: {
+        0: ("ready", None),
+        1: ("exit_delay", None),
+        2: ("entry_delay", None),
+        3: ("system_trouble", None),
+        4: ("alarm_in_memory", None),
+        5: ("zones_bypassed", None),
+        6: ("bypass_master_installer_programming", None),
+        7: ("keypad_lockout", None)
+    },
+    66: {
+        0: ("intellizone_delay_enganged", None),
+        1: ("fire_delay_enganged", None),
+        2: ("auto_arm", None),
+        3: ("voice_arm", None),
+        4: ("tamper", None),
+        5: ("zone_low_battery", None),
+        6: ("fire_loop_trouble", None),
+        7: ("zone_supervision_trouble", None)
+    }
+}
+
+pgm_states = {
+    "ON": True,
+    "OFF": False
+}
+
 # PRT class
 # Defines structures we can read/write on PRT3 and its operations
 class PRT:
-    areas = [None]*8
-    zones = [None]*192
-    users = [None]*1000
-    pgm = [None]*30
+    areas = None
+    zones = None
+    users = None
+    pgm = None
+    _area_store = None
+    _zone_store = None
     _config = None
-    _buffer = ""
+    _framer = None
     _panel_type = None
     _sum_areas = 0
     _sum_zones = 0
@@ -27,201 +252,77 @@ class PRT:
     _serial = None
     _log = None
     _event_callback = None
+    _state_callback = None
     _serial_lock = None
+    _read = None
+    _scheduler = None
+    _name_update = None
+    _labels = None
+    _snapshot = None
+    _snapshot_interval = None
+    _snapshot_saved = None
+    _snapshot_dirty = False
+    _stale = None
+    _stale_lock = None
+    _stale_published = False
 
     def input_serial(self, buf, regex_response = None):
-        self._buffer = self._buffer + buf
-        self._log.debug("Received data: %s" % (buf.strip().replace('\r', ';')))
+        if isinstance(buf, str):
+            buf = buf.encode("ascii")
+        if self._log.isEnabledFor(logging.DEBUG):
+            self._log.debug("Received data: %s" % (buf.strip().replace(b'\r', b';').decode("ascii", "replace")))
+
+        self._framer.feed(buf)
         ret = []
-        if '\r' in self._buffer:
-            command = self._buffer.split('\r')
-            for x in range(0, len(command)-1):
-                event_ret = self.parse_event(command[x], regex_response)
-                if event_ret != None:
-                    ret.append(event_ret)
-            self._buffer = command[-1]
+        for line in self._framer.lines():
+            event_ret = self.parse_event(line, regex_response)
+            if event_ret != None:
+                ret.append(event_ret)
         return ret
 
     def process_zone_event(self, group, event, area):
-        # Zone OK
-        if group == 0:
-            self._log.info("Zone OK: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].open = False
-            self.zones[event-1].tamper = False
-            self.zones[event-1].fire = False
-            self.zones[event-1].last_state_update = time.time()
-
-        # Zone open
-        if group == 1:
-            self._log.info("Zone open: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].open = True
-            self.zones[event-1].last_state_update = time.time()
-
-        # Zone in tamper
-        if group == 2:
-            self._log.info("Zone in tamper: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].tamper = True
-            self.zones[event-1].last_state_update = time.time()
-
-        # Zone in fire loop trouble
-        if group == 3:
-            self._log.info("Zone in fire loop trouble: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].fire = True
-            self.zones[event-1].last_state_update = time.time()
-
-        if group == 23:
-            self._log.info("Zone bypassed: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-
-        if group == 24:
-            self._log.info("Zone in alarm: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].alarm = True
-
-        if group == 25:
-            self._log.info("Zone in fire alarm: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].fire_alarm = True
-
-        if group == 26:
-            self._log.info("Zone alarm restore: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].alarm = False
-
-        if group == 27:
-            self._log.info("Zone fire alarm restore: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].fire_alarm = False
-
-        if group == 32:
-            self._log.info("Zone shutdown: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-
-        if group == 33:
-            self._log.info("Zone tamper: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].tamper = True
-
-        if group == 34:
-            self._log.info("Zone tamper restore: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].tamper = False
-
-        if group == 41:
-            self._log.info("Zone battery low: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].low_battery = True
-
-        if group == 42:
-            self._log.info("Zone lost supervision: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].supervision_lost = True
-
-        if group == 43:
-            self._log.info("Zone battery low restored: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].low_battery = False
-
-        if group == 44:
-            self._log.info("Zone restored supervision: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-            self.zones[event-1].supervision_lost = False
-
-        if group == 55:
-            self._log.info("Intellizone triggered: %d/%d [%s / %s]" % (area, event, self.areas[area-1].name, self.zones[event-1].name))
-
-        # Zone status queue notification
-        if (self._event_callback) and ((0 <= group <= 3) or (23 <= group <= 27) or (32 <= group <= 34)):
-            payload = {
-                "type": "zone",
-                "event": {
-                    0: "ok",
-                    1: "open",
-                    2: "tamper",
-                    3: "fire_loop_trouble",
-                    23: "bypassed",
-                    24: "alarm",
-                    25: "fire_alarm",
-                    26: "alarm_restore",
-                    27: "fire_alarm_restore",
-                    32: "shutdown",
-                    33: "tamper",
-                    34: "tamper_restore",
-                    41: "lowbatt",
-                    42: "nosupervision",
-                    43: "lowbatt_restore",
-                    44: "nosupervision_restore",
-                    55: "intellizone_triggered"
-                }[group],
-                "area": area,
-                "data": self.zones[event-1].getData(),
-            }
-            payload["timestamp"] = time.time()
-            self._event_callback(payload, "zone/" + str(event))
-  
-    def process_nonreportable_event(self, group, event, area):
-        payload = {"type": "unknown", "area": None}
-        if event == 0:
-            payload = {"type": "tlm_trouble", "area": area}
-                    
-        if event == 1:
-            payload = {"type": "smoke_detector_reset", "area": area}
-
-        if event == 2:
-            payload = {"type": "arm_nodelay", "area": area}
-
-        if event == 3:
-            payload = {"type": "arm_in_stay", "area": area}
-
-        if event == 4:
-            payload = {"type": "arm_in_away", "area": area}
-
-        if event == 5:
-            payload = {"type": "fullarm_in_stay", "area": area}
-
-        if event == 6:
-            payload = {"type": "voice_access", "area": area}
-
-        if event == 7:
-            payload = {"type": "remote_access", "area": area}
-
-        if event == 8:
-            payload = {"type": "pc_comm_fail", "area": area}
-
-        if event == 9:
-            payload = {"type": "midnight", "area": area}
-
-        if event == 10:
-            payload = {"type": "ip_user_login", "area": area}
-
-        if event == 11:
-            payload = {"type": "ip_user_logout", "area": area}
-
-        if event == 12:
-            payload = {"type": "user_callup", "area": area}
+        description, event_name, fields, state_update, notify = zone_events[group]
+        zone = self.zones[event-1]
+        self._log.info("%s: %d/%d [%s / %s]" % (description, area, event, self.areas[area-1].name, zone.name))
+
+        changed = zone.update(dict(fields))
+        if state_update:
+            zone.last_state_update = time.time()
+            self._scheduler.freshen("zone", event, zone.last_state_update)
+        confirmed = self.state_changed("zone", event, changed)
+
+        # Zone status queue notification; events repeating the known state
+        # are not sent (events without state such as bypass always are).
+        # Silent events (battery / supervision) only update the state topic
+        if notify and self._event_callback and (changed or confirmed or (not fields)):
+            self.publish_delta("zone", event, changed, event_name, area)
+        elif changed or confirmed:
+            self.publish_state("zone", event)
 
-        if event == 13:
-            payload = {"type": "force_answer", "area": area}
+    def process_nonreportable_event(self, group, event, area):
+        if event in nonreportable_events:
+            payload = {"type": nonreportable_events[event], "area": area}
+        else:
+            payload = {"type": "unknown", "area": None}
 
-        if event == 14:
-            payload = {"type": "force_hangup", "area": area}
-        
         self._log.info("Nonreportable event; type = %s, area = %s" % (payload["type"], payload["area"]))
         self._event_callback(payload, "nonrep")
 
     def process_useraccess_event(self, group, event, area):
-        payload = {"type": "unknown", "user": None, "area": None}
+        payload = {
+            "type": useraccess_events[group],
+            "area": area
+        }
 
         if group == 5:
-            payload = {
-                "type": "keypad_usercode_entered",
-                "area": area,
-                "user": self.users[event].getData() if self.users[event] else None
-            }
-        
-        if group == 6:
-            payload = {
-                "type": "door_access",
-                "area": area,
-                "door": event
-            }
-
-        if group == 7:
-            payload = {
-                "type": "bypass_programming_access",
-                "area": area,
-                "user": event
-            }
+            payload["user"] = self.users[event].getFragment() if event in self.users else None
+        elif group == 6:
+            payload["door"] = event
+        else:
+            payload["user"] = event
 
-        self._log.info("User access event; type = %s, user = %s, area = %s" % (payload["type"], payload["user"]["name"] if payload["user"] else "unknown", payload["area"]))
+        user = payload.get("user")
+        self._log.info("User access event; type = %s, user = %s, area = %s" % (payload["type"], user["name"] if isinstance(user, dict) else user, payload["area"]))
         self._event_callback(payload, "useraccess")
 
     def process_delayzonealarm_event(self, group, event, area):
@@ -234,22 +335,17 @@ class PRT:
         self._event_callback(payload, "txdelayzonealarm")
 
     def process_arming_event(self, group, event, area):
-        payload = {"type": "unknown", "user": None, "area": None, "source": None, "event": None}
-
         # Arm with master code / user code
-        if (9 <= group <= 10):
+        if group in arming_sources:
             payload = {
                 "type": "arm",
-                "source": {
-                    9: "mastercode",
-                    10: "usercode"
-                }[group],
+                "source": arming_sources[group],
                 "area": area,
-                "user": self.users[event].getData() if self.users[event] else None
+                "user": self.users[event].getFragment() if event in self.users else None
             }
-        
+
         # Arm with keyswitch
-        if group == 11:
+        elif group == 11:
             payload = {
                 "type": "arm",
                 "source": "keyswitch",
@@ -259,115 +355,63 @@ class PRT:
             }
 
         # Special arming
-        if group == 12:
+        elif group == 12:
             payload = {
                 "type": "arm",
                 "source": "special",
                 "area": area,
-                "event": {
-                    0: "auto",
-                    1: "winload",
-                    2: "late_to_close",
-                    3: "no_movement",
-                    4: "partial",
-                    5: "onetouch",
-                    6: "_future_",
-                    7: "_future_",
-                    8: "invoice_module"
-                }[event],
+                "event": special_arming_events[event],
                 "user": None
             }
 
         # Early / late arm
-        if (46 <= group <= 47):
+        else:
             payload = {
                 "type": "arm",
-                "state": {
-                    46: "early",
-                    47: "late"
-                }[group],
+                "state": early_late_states[group],
                 "source": "usercode",
                 "area": area,
-                "user": self.users[event].getData() if self.users[event] else None
+                "user": self.users[event].getFragment() if event in self.users else None
             }
 
         self._log.info("Arming event; type = %s, source = %s, user = %s, area = %s" % (payload["type"], payload["source"], payload["user"]["name"] if payload["user"] else "unknown", payload["area"]))
         self._event_callback(payload, "arming")
 
     def process_disarming_event(self, group, event, area):
-        payload = {"type": "unknown", "state": None, "source": None, "area": None, "user": None}
-
-        # Disarm with master code / user code
-        if (13 <= group <= 14) or (16 <= group <= 17) or (19 <= group <= 20):
+        # Disarm with master code / user code / keyswitch
+        if group in disarming_events:
+            state, source = disarming_events[group]
             payload = {
                 "type": "disarm",
-                "state": {
-                    13: "ok",
-                    14: "ok",
-                    16: "after_alarm",
-                    17: "after_alarm",
-                    19: "during_alarm",
-                    20: "during_alarm"
-                }[group],
-                "source": {
-                    13: "mastercode",
-                    14: "usercode",
-                    16: "mastercode",
-                    17: "usercode",
-                    19: "mastercode",
-                    20: "usercode"
-                }[group],
-                "area": area,
-                "user": self.users[event].getData() if self.users[event] else None
-            }
-        
-        # Disarm with keyswitch
-        if (group == 15) or (group == 18) or (group == 21):
-            payload = {
-                "type": "disarm",
-                "state": {
-                    15: "ok",
-                    18: "after_alarm",
-                    21: "during_alarm",
-                }[group],
-                "source": "keyswitch",
-                "area": area,
-                "keyswitch": event,
-                "user": None
+                "state": state,
+                "source": source,
+                "area": area
             }
+            if source == "keyswitch":
+                payload["keyswitch"] = event
+                payload["user"] = None
+            else:
+                payload["user"] = self.users[event].getFragment() if event in self.users else None
 
         # Special disarming
-        if group == 22:
+        elif group == 22:
             payload = {
                 "type": "disarm",
                 "source": "special",
                 "state": None,
                 "area": area,
-                "event": {
-                    0: "auto_cancelled",
-                    1: "onetouch_instant",
-                    2: "winload",
-                    3: "winload_afteralarm",
-                    4: "winload_cancelledalarm",
-                    5: "_future_",
-                    6: "_future_",
-                    7: "_future_",
-                    8: "invoice_module"
-                }[event],
+                "event": special_disarming_events[event],
                 "user": None
             }
-    
+
         # Early / late disarm
-        if (28 <= group <= 29):
+        else:
             payload = {
                 "type": "disarm",
-                "state": {
-                    28: "early",
-                    29: "late"
-                }[group],
+                "state": early_late_states[group],
                 "source": "usercode",
                 "area": area,
-                "user": self.users[event].getData() if self.users[event] else None
+                "user": self.users[event].getFragment() if event in self.users else None
             }
 
         self._log.info("Disarming event; type = %s, state = %s, source = %s, user = %s, area = %s" % (payload["type"], payload["state"], payload["source"], payload["user"]["name"] if payload["user"] else "unknown", payload["area"]))
@@ -376,14 +420,7 @@ class PRT:
     def process_special_alarm_event(self, group, event, area):
         payload = {
             "type": "special_alarm",
-            "source": {
-                0: "emergency_panic",
-                1: "medical_panic",
-                2: "fire_panic",
-                3: "recent_closing",
-                4: "police_code",
-                5: "global_shutdown"
-            }[event],
+            "source": special_alarm_sources[event],
             "area": area
         }
         self._log.info("Special alarm event; type = %s, source = %s, area = %s" % (payload["type"], payload["source"], payload["area"]))
@@ -395,7 +432,7 @@ class PRT:
             "user": event,
             "area": area
         }
-        self._log.info("Special alarm event; type = %s, user = %s, area = %s" % (payload["type"], payload["user"]["name"] if payload["user"] else "unknown", payload["area"]))
+        self._log.info("Special alarm event; type = %s, user = %s, area = %s" % (payload["type"], payload["user"], payload["area"]))
         self._event_callback(payload, "duress_alarm")
 
     def process_special_tamper_event(self, group, event, area):
@@ -410,21 +447,8 @@ class PRT:
     def process_trouble_event(self, group, event, area):
         payload = {
             "type": "trouble",
-            "event": {
-                36: "trouble",
-                37: "restore"
-            }[group],
-            "source": {
-                0: "tlm",
-                1: "ac_failure",
-                2: "battery_failure",
-                3: "aux_current_limit",
-                4: "bell_current_limit",
-                5: "bell_absent",
-                6: "clock",
-                7: "global_fire_loop",
-                8: "panel_tamper"
-            }[event],
+            "event": trouble_events[group],
+            "source": trouble_sources[event],
             "area": area
         }
 
@@ -434,21 +458,8 @@ class PRT:
     def process_module_event(self, group, event, area):
         payload = {
             "type": "module_trouble",
-            "event": {
-                38: "trouble",
-                39: "restore"
-            }[group],
-            "source": {
-                0: "combus_fault",
-                1: "tamper",
-                2: "memory_error",
-                3: "tlm_trouble",
-                4: "fail_to_communicate",
-                5: "printer_fault",
-                6: "ac_failure",
-                7: "battery_failure",
-                8: "aux_failure"
-            }[event],
+            "event": module_trouble_events[group],
+            "source": module_trouble_sources[event],
             "area": area
         }
 
@@ -462,28 +473,23 @@ class PRT:
             "area": area
         }
 
-        self._log.info("Fail to Communicate on telephone number; telephone_number = %s, area = %s" % (payload["event"], payload["area"]))
+        self._log.info("Fail to Communicate on telephone number; telephone_number = %s, area = %s" % (payload["telephone_number"], payload["area"]))
         self._event_callback(payload, "comm_fail_telephone")
 
     def process_special_event(self, group, event, area):
         payload = {
             "type": "special_event",
-            "event": {
-                0: "full_startup",
-                1: "software_reset",
-                2: "test_report",
-                3: "future_use",
-                4: "winload_in",
-                5: "winload_out",
-                6: "installer_programming_in",
-                7: "installer_programming_out"
-            }[event],
+            "event": special_events[event],
             "area": area
         }
 
         self._log.info("Special event; event = %s, area = %s" % (payload["event"], payload["area"]))
         self._event_callback(payload, "special_event")
 
+        # Labels may have been changed while programming
+        if payload["event"] in ("winload_out", "installer_programming_out"):
+            self.invalidate_labels()
+
     def process_utility_key_event(self, group, event, area):
         payload = {
             "type": "utility_key",
@@ -497,14 +503,7 @@ class PRT:
     def process_door_event(self, group, event, area):
         payload = {
             "type": "door",
-            "event": {
-                49: "request_exit",
-                50: "access_denied",
-                51: "left_open_alarm",
-                52: "forced_open_alarm",
-                53: "left_open_restore",
-                54: "forced_open_restore"
-            }[group],
+            "event": door_events[group],
             "door": event,
             "area": area
         }
@@ -515,10 +514,7 @@ class PRT:
     def process_combus_event(self, group, event, area):
         payload = {
             "type": "combus",
-            "event": {
-                58: "module_assigned",
-                59: "module_removed"
-            }[group],
+            "event": combus_events[group],
             "module_addr": event,
             "module": area
         }
@@ -540,79 +536,22 @@ class PRT:
     def process_access_granted_event(self, group, event, area):
         payload = {
             "type": "access",
-            "event": {
-                62: "granted",
-                63: "denied"
-            }[group],
+            "event": access_events[group],
             "user": event,
             "area": area
         }
 
-        self._log.info("Access granted/denied event; event = %s, user = %s, area = %s" % (payload["event"], payload["user"]["name"] if payload["user"] else "unknown", payload["area"]))
+        self._log.info("Access granted/denied event; event = %s, user = %s, area = %s" % (payload["event"], payload["user"], payload["area"]))
         self._event_callback(payload, "access")
 
     def process_status_event(self, group, event, area):
-        payload = {"type": "status", "event": None, "area": None, "kind": None}
-        
-        if group == 64:
-            payload = {
-                "type": "status",
-                "event": {
-                    0: "arm",
-                    1: "arm",
-                    2: "arm",
-                    3: "arm",
-                    4: "alarm",
-                    5: "alarm",
-                    6: "alarm",
-                    7: "alarm"
-                }[event],
-                "kind": {
-                    0: "normal",
-                    1: "force",
-                    2: "stay",
-                    3: "instant",
-                    4: "strobe",
-                    5: "silent",
-                    6: "audible",
-                    7: "fire"
-                }[event],
-                "area": area
-            }
-
-        if group == 65:
-            payload = {
-                "type": "status",
-                "event": {
-                    0: "ready",
-                    1: "exit_delay",
-                    2: "entry_delay",
-                    3: "system_trouble",
-                    4: "alarm_in_memory",
-                    5: "zones_bypassed",
-                    6: "bypass_master_installer_programming",
-                    7: "keypad_lockout"
-                }[event],
-                "kind": None,
-                "area": area
-            }
-
-        if group == 66:
-            payload = {
-                "type": "status",
-                "event": {
-                    0: "intellizone_delay_enganged",
-                    1: "fire_delay_enganged",
-                    2: "auto_arm",
-                    3: "voice_arm",
-                    4: "tamper",
-                    5: "zone_low_battery",
-                    6: "fire_loop_trouble",
-                    7: "zone_supervision_trouble"
-                }[event],
-                "kind": None,
-                "area": area
-            }
+        status_event, status_kind = status_events[group][event]
+        payload = {
+            "type": "status",
+            "event": status_event,
+            "kind": status_kind,
+            "area": area
+        }
 
         self._log.info("System status event; type = %s, event = %s, kind = %s, area = %s" % (payload["type"], payload["event"], payload["kind"], payload["area"]))
         self._event_callback(payload, "status")
@@ -620,15 +559,15 @@ class PRT:
     def process_vpgm_event(self, pgm, state):
         payload = {
             "id": pgm,
-            "state": {
-                "ON": True,
-                "OFF": False
-            }[state]
+            "state": pgm_states[state]
         }
         self.pgm[pgm-1].state = payload["state"]
+        self.pgm[pgm-1].last_status_update = time.time()
+        self.state_changed("pgm", pgm, True)
 
         self._log.info("Virtual PGM event: %s / %s" % (pgm, state))
         self._event_callback(payload, "pgm/"+str(pgm))
+        self.publish_state("pgm", pgm)
 
     def process_unknown_event(self, str):
         self._log.warn("Unknown event command: %s" % (str))
@@ -644,235 +583,344 @@ class PRT:
             "data": str
         }, "unknown")
 
-    def parse_event(self, str, regex_response = None):
-        self._log.debug("Parsing: %s" % (str))
-        regex_comm = "^COMM&(ok|fail)$"
-        regex_event = "^G([0-9]{3})N([0-9]{3})A([0-9]{3})$"
-        regex_pgm = "^PGM([0-9]{2})(ON|OFF)$"
-
-        if (regex_response != None) and (re.search(regex_response, str)):
-            rx = re.split(regex_response, str)
-            return rx
-
-        elif (re.search(regex_comm, str)):
-            rx = re.split(regex_event, str)
-            if rx:
-                comm_state = rx[1]
-                if (comm_state == "ok"):
-                    self._log.info("PRT3 Communication OK")
-                else:
-                    self._log.error("PRT3 Communication FAILED")
-
-        elif (re.search(regex_event, str)):
-            rx = re.split(regex_event, str)
+    def process_reply(self, token, regex_response = None):
+        if regex_response != None:
+            rx = match_response(token, regex_response)
             if rx:
-                cmd_group = int(rx[1])
-                cmd_event = int(rx[2])
-                cmd_area = int(rx[3])
-                self._log.debug("Match [EVENT] gr=%d en=%d ar=%d" % (cmd_group, cmd_event, cmd_area))
-
-                # Zone events
-                if (0 <= cmd_group <= 3) or (23 <= cmd_group <= 27) or (32 <= cmd_group <= 34) or (41 <= cmd_group <= 44) or (cmd_group == 55):
-                    self.process_zone_event(cmd_group, cmd_event, cmd_area)
-
-                # Non-reportable events
-                elif cmd_group == 4:
-                    self.process_nonreportable_event(cmd_group, cmd_event, cmd_area)
-                
-                # User code entered on keypad
-                elif (5 <= cmd_group <= 7):
-                    self.process_useraccess_event(cmd_group, cmd_event, cmd_area)
-
-                # TX Delay Zone Alarm
-                elif cmd_group == 8:
-                    self.process_delayzonealarm_event(cmd_group, cmd_event, cmd_area)
-
-                elif (9 <= cmd_group <= 12) or (46 <= cmd_group <= 47):
-                    self.process_arming_event(cmd_group, cmd_event, cmd_area)
-
-                elif (13 <= cmd_group <= 22) or (28 <= cmd_group <= 29):
-                    self.process_disarming_event(cmd_group, cmd_event, cmd_area)
-                
-                elif cmd_group == 30:
-                    self.process_special_alarm_event(cmd_group, cmd_event, cmd_area)
-                
-                elif cmd_group == 31:
-                    self.process_duress_alarm_event(cmd_group, cmd_event, cmd_area)
-
-                elif cmd_group == 35:
-                    self.process_special_tamper_event(cmd_group, cmd_event, cmd_area)
-
-                elif (36 <= cmd_group <= 37):
-                    self.process_trouble_event(cmd_group, cmd_event, cmd_area)
-
-                elif (38 <= cmd_group <= 39):
-                    self.process_module_event(cmd_group, cmd_event, cmd_area)
-
-                elif cmd_group == 40:
-                    self.process_comm_fail_event(cmd_group, cmd_event, cmd_area)
-
-                elif cmd_group == 45:
-                    self.process_special_event(cmd_group, cmd_event, cmd_area)
-
-                elif cmd_group == 48:
-                    self.process_utility_key_event(cmd_group, cmd_event, cmd_area)
-
-                elif (49 <= cmd_group <= 54):
-                    self.process_door_event(cmd_group, cmd_event, cmd_area)
+                return rx
+        self.process_unknown_command(token.line)
+        return None
 
-                elif (58 <= cmd_group <= 59):
-                    self.process_combus_event(cmd_group, cmd_event, cmd_area)
+    def parse_event(self, line, regex_response = None):
+        self._log.debug("Parsing: %s" % (line))
+        token = tokenize(line)
+        kind = type(token)
 
-                elif (60 <= cmd_group <= 61):
-                    self.process_future_use_event(cmd_group, cmd_event, cmd_area)
+        if kind is ReplyToken:
+            return self.process_reply(token, regex_response)
 
-                elif (62 <= cmd_group <= 63):
-                    self.process_access_granted_event(cmd_group, cmd_event, cmd_area)
+        elif kind is EventToken:
+            self._log.debug("Match [EVENT] gr=%d en=%d ar=%d" % (token.group, token.event, token.area))
 
-                elif (64 <= cmd_group <= 66):
-                    self.process_status_event(cmd_group, cmd_event, cmd_area)
+            handler = event_dispatch[token.group] if token.group < len(event_dispatch) else None
 
-                else:
-                    self.process_unknown_event(str)
+            # Event codes not present in the name table of the group are
+            # unknown
+            names = event_names[token.group] if handler else None
+            if handler and ((names == None) or (token.event in names)):
+                try:
+                    handler(self, token.group, token.event, token.area)
+                except:
+                    self._log.exception("Unable to process event: %s" % (line))
+            else:
+                self.process_unknown_event(line)
 
-            return None
+        elif kind is PgmToken:
+            self.process_vpgm_event(token.pgm, token.state)
 
-        elif (re.search(regex_pgm, str)):
-            rx = re.split(regex_pgm, str)
-            if rx:
-                cmd_pgm = int(rx[1])
-                cmd_state = rx[2]
-                self.process_vpgm_event(cmd_pgm, cmd_state)
+        elif kind is CommToken:
+            if token.ok:
+                self._log.info("PRT3 Communication OK")
+            else:
+                self._log.error("PRT3 Communication FAILED")
 
         else:
-            self.process_unknown_command(str)
-            return None
+            self.process_unknown_command(line)
+
+        return None
 
     def serial_readline(self, timeout = 0.5):
         timer_start = time.time()
-        ret = ""
+        ret = b""
         eol = False
         while ((time.time() - timer_start <= timeout) and (not eol)):
             readbytes = self._ser.read()
             if len(readbytes) > 0:
                 ret += readbytes
-                if readbytes == '\r':
+                if readbytes == b'\r':
                     eol = True
         return ret
-    
-    def wait_response(self, regex):
-        ret = None
-        counter = 0
-        while (counter < 10) and (ret == None):
-            counter += 1
-            serin = self.serial_readline()
-            if (serin != ''):
+
+    def serial_read(self, timeout = 0.5):
+        # Block on the port descriptor until data arrives (or timeout expires)
+        # and drain everything waiting in the input buffer with a single read
+        ready, _, _ = select.select([self._ser.fileno()], [], [], timeout)
+        if not ready:
+            return b""
+        return self._ser.read(self._ser.in_waiting or 1)
+
+    def wait_response(self, regex, timeout = 5.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            serin = self._read()
+            if serin:
                 ret = self.input_serial(serin, regex)
-                if ret != None:
+                if ret:
                     return ret
 
         return None
     
-    def prt3_command(self, cmd, regex):
-        self._serial_lock.acquire()
+    def prt3_command(self, cmd, regex, priority = PRIORITY_POLL):
+        self._serial_lock.acquire(priority)
         self._log.debug("Sending command: %s" % (cmd))
-        self._ser.write(cmd + "\r")
+        self._ser.write((cmd + "\r").encode("ascii"))
         self._log.debug("Sent; waiting for response")
         ret = self.wait_response(regex)
         self._serial_lock.release()
         return ret
     
+    def name_update_due(self, entity):
+        return (entity.last_name_update == None) or ((time.time() - entity.last_name_update) >= self._name_update)
+
+    def update_area_label(self, id, ret):
+        for area in ret or []:
+            if area[1] == "AL":
+                name = self.areas[id-1].name
+                self.areas[id-1].name = area[3].strip()
+                self.areas[id-1].last_name_update = time.time()
+                if self.areas[id-1].name != name:
+                    self.publish_state("area", id)
+                self._labels.set("area", id, self.areas[id-1].name, self.areas[id-1].last_name_update)
+
+    def update_area_status(self, id, ret):
+        for area in ret or []:
+            if area[1] == "RA":
+                changed = self.areas[id-1].update({
+                    "arm_disarmed": (area[3] == 'D'),
+                    "arm_armed": (area[3] == 'A'),
+                    "arm_force": (area[3] == 'F'),
+                    "arm_stay": (area[3] == 'S'),
+                    "arm_instant": (area[3] == 'I'),
+                    "zone_in_memory": (area[4] == 'M'),
+                    "trouble": (area[5] == 'T'),
+                    "not_ready": (area[6] == 'N'),
+                    "in_programming": (area[7] == 'P'),
+                    "in_alarm": (area[8] == 'A'),
+                    "strobe": (area[9] == 'S')
+                })
+                self.areas[id-1].last_state_update = time.time()
+                self._scheduler.freshen("area", id, self.areas[id-1].last_state_update)
+                if self.state_changed("area", id, changed) or changed:
+                    self.publish_delta("area", id, changed)
+
+    def update_zone_label(self, id, ret):
+        for zone in ret or []:
+            if zone[1] == "ZL":
+                name = self.zones[id-1].name
+                self.zones[id-1].name = zone[3].strip()
+                self.zones[id-1].last_name_update = time.time()
+                if self.zones[id-1].name != name:
+                    self.publish_state("zone", id)
+                self._labels.set("zone", id, self.zones[id-1].name, self.zones[id-1].last_name_update)
+
+    def update_zone_status(self, id, ret):
+        for zone in ret or []:
+            if zone[1] == "RZ":
+                changed = self.zones[id-1].update({
+                    "open": (zone[3] == 'O'),
+                    "tamper": (zone[3] == 'T'),
+                    "fire": (zone[3] == 'F'),
+                    "alarm": (zone[4] == 'A'),
+                    "fire_alarm": (zone[5] == 'F'),
+                    "supervision_lost": (zone[6] == 'S'),
+                    "low_battery": (zone[7] == 'L')
+                })
+                self.zones[id-1].last_state_update = time.time()
+                self._scheduler.freshen("zone", id, self.zones[id-1].last_state_update)
+                if self.state_changed("zone", id, changed) or changed:
+                    self.publish_delta("zone", id, changed)
+
+    def update_user_label(self, id, ret):
+        self.users[0].name = "Master Technician"
+
+        for user in ret or []:
+            if user[1] == "UL":
+                self.users[id].name = user[3].strip()
+                self.users[id].last_name_update = time.time()
+                self._labels.set("user", id, self.users[id].name, self.users[id].last_name_update)
+                self._scheduler.freshen("user", id, self.users[id].last_name_update)
+
+    def command_stats(self):
+        return self._serial_lock.stats.getData()
+
     def fetch_area(self, id):
         self._log.debug("Fetching area [%d]" % (id))
-        name_update = get_config(self._config, "prt3.refresh.names") * 60
 
         # Request area label
-        if (self.areas[id-1].last_name_update == None) or ((time.time() - self.areas[id-1].last_name_update) >= name_update):
-            ret = self.prt3_command("AL%03d" % (id), "^(AL)([0-9]{3})(.{16})$")
-            for area in ret:
-                if area[1] == "AL":
-                    self.areas[id-1].name = area[3].strip()
-                    self.areas[id-1].last_name_update = time.time()
+        if self.name_update_due(self.areas[id-1]):
+            self.update_area_label(id, self.prt3_command("AL%03d" % (id), regex_area_label))
 
         # Request area status
-        ret = self.prt3_command("RA%03d" % (id), "^(RA)([0-9]{3})([DAFSI])([MO])([TO])([NO])([PO])([AO])([SO])$")
-        for area in ret:
-            if area[1] == "RA":
-                self.areas[id-1].arm_disarmed = (area[3] == 'D')
-                self.areas[id-1].arm_armed = (area[3] == 'A')
-                self.areas[id-1].arm_force = (area[3] == 'F')
-                self.areas[id-1].arm_stay = (area[3] == 'S')
-                self.areas[id-1].arm_instant = (area[3] == 'I')
-                self.areas[id-1].zone_in_memory = (area[4] == 'M')
-                self.areas[id-1].trouble = (area[5] == 'T')
-                self.areas[id-1].not_ready = (area[6] == 'N')
-                self.areas[id-1].in_programming = (area[7] == 'P')
-                self.areas[id-1].in_alarm = (area[8] == 'A')
-                self.areas[id-1].strobe = (area[9] == 'S')
-                self.areas[id-1].last_state_update = time.time()
+        self.update_area_status(id, self.prt3_command("RA%03d" % (id), regex_area_status))
     
     def fetch_zone(self, id):
         self._log.debug("Fetching zone [%d]" % (id))
-        name_update = get_config(self._config, "prt3.refresh.names") * 60
 
         # Request zone label
-        if (self.zones[id-1].last_name_update == None) or ((time.time() - self.zones[id-1].last_name_update) >= name_update):
-            ret = self.prt3_command("ZL%03d" % (id), "^(ZL)([0-9]{3})(.{16})$")
-            for zone in ret:
-                if zone[1] == "ZL":
-                    self.zones[id-1].name = zone[3].strip()
-                    self.zones[id-1].last_name_update = time.time()
+        if self.name_update_due(self.zones[id-1]):
+            self.update_zone_label(id, self.prt3_command("ZL%03d" % (id), regex_zone_label))
 
         # Request zone status
-        ret = self.prt3_command("RZ%03d" % (id), "^(RZ)([0-9]{3})([COTF])([AO])([FO])([SO])([LO])$")
-        for zone in ret:
-            if zone[1] == "RZ":
-                self.zones[id-1].open = (zone[3] == 'O')
-                self.zones[id-1].tamper = (zone[3] == 'T')
-                self.zones[id-1].fire = (zone[3] == 'F')
-                self.zones[id-1].alarm = (zone[4] == 'A')
-                self.zones[id-1].fire_alarm = (zone[5] == 'F')
-                self.zones[id-1].supervision_lost = (zone[6] == 'S')
-                self.zones[id-1].low_battery = (zone[7] == 'L')
-                self.zones[id-1].last_state_update = time.time()
+        self.update_zone_status(id, self.prt3_command("RZ%03d" % (id), regex_zone_status))
 
     def fetch_user(self, id):
         self._log.debug("Fetching user [%d]" % (id))
 
-        self.users[0].name = "Master Technician"
-
         # Request user label
-        ret = self.prt3_command("UL%03d" % (id), "^(UL)([0-9]{3})(.{16})$")
-        for user in ret:
-            if user[1] == "UL":
-                self.users[id].name = user[3].strip()
-                self.users[id].last_name_update = time.time()
-
-    def panel_sync(self):
-        self._log.debug("Panel sync poll")
-        area_update = get_config(self._config, "prt3.refresh.area") * 60
-        zone_update = get_config(self._config, "prt3.refresh.zone") * 60
-        user_update = get_config(self._config, "prt3.refresh.user") * 60
+        self.update_user_label(id, self.prt3_command("UL%03d" % (id), regex_user_label))
+
+    # Entities due for refresh during panel sync
+    def sync_due(self):
+        fetch = {
+            "area": self.fetch_area,
+            "zone": self.fetch_zone,
+            "user": self.fetch_user
+        }
+        for kind, id in self._scheduler.pop_due(time.time()):
+            yield fetch[kind], id
+
+    # Time the next entity is due for refresh (None if nothing is monitored)
+    def next_sync(self):
+        return self._scheduler.next_wakeup()
+
+    # Entity state was read from the panel. Returns True when the entity was
+    # published stale from the snapshot and is confirmed now.
+    def state_changed(self, kind, id, changed):
+        if changed:
+            self._snapshot_dirty = True
+        if self._stale and ((kind, id) in self._stale):
+            with self._stale_lock:
+                self._stale.discard((kind, id))
+                return self._stale_published
+        return False
+
+    # Publishes changed fields of a zone / area with the entity version
+    def publish_delta(self, kind, id, changed, event = "update", area = None):
+        entity = self.zones[id-1] if kind == "zone" else self.areas[id-1]
+        data = {"id": id}
+        for field in changed:
+            data[field] = getattr(entity, field)
 
-        for area in self.areas:
-            if (area != None) and ( (area.last_state_update == None) or (time.time() - area.last_state_update >= area_update) ):
-                self.fetch_area(area.id)
+        payload = {
+            "type": kind,
+            "event": event
+        }
+        if kind == "zone":
+            payload["area"] = area
+        payload["data"] = data
+        payload["version"] = entity.version
+        payload["timestamp"] = time.time()
+        payload["stale"] = False
+        self._event_callback(payload, kind + "/" + str(id))
+        self.publish_state(kind, id)
+
+    # Full current state of a zone / area / PGM for the retained state topics
+    def publish_state(self, kind, id):
+        if self._state_callback == None:
+            return
+
+        if kind == "pgm":
+            state = self.pgm[id-1].getData()
+        else:
+            entity = self.zones[id-1] if kind == "zone" else self.areas[id-1]
+            state = entity.getData()
+            state["version"] = entity.version
+        state["stale"] = (self._stale != None) and ((kind, id) in self._stale)
+        self._state_callback(kind, id, state)
+
+    # Ids of zones and areas whose state changed after <since>
+    def changed_since(self, since):
+        return {
+            "area": [slot + 1 for slot in self._area_store.changed_since(since) if self.areas[slot] != None],
+            "zone": [slot + 1 for slot in self._zone_store.changed_since(since) if self.zones[slot] != None]
+        }
 
-        for zone in self.zones:
-            if (zone != None) and ( (zone.last_state_update == None) or (time.time() - zone.last_state_update >= zone_update) ):
-                self.fetch_zone(zone.id)
+    # Writes the state snapshot when the model changed or the interval expired
+    def checkpoint(self, force = False):
+        if self._snapshot == None:
+            return
+
+        now = time.time()
+        if force or self._snapshot_dirty or (now - self._snapshot_saved >= self._snapshot_interval):
+            self._snapshot_dirty = False
+            self._snapshot_saved = now
+            self._snapshot.save(now, self._zone_store, self._area_store, self.pgm)
+
+    # Publishes states restored from the snapshot which were not confirmed
+    # by the panel yet (flagged stale). In thread mode this runs on the MQTT
+    # network thread while the serial loop confirms entities.
+    def publish_stale(self):
+        with self._stale_lock:
+            stale = sorted(self._stale or [])
+            self._stale_published = True
+        for kind, id in stale:
+            # Confirmed by the panel in the meantime (published as such)
+            if (kind, id) not in self._stale:
+                continue
+            if kind == "zone":
+                zone = self.zones[id-1]
+                self._event_callback({
+                    "type": "zone",
+                    "event": "snapshot",
+                    "area": None,
+                    "data": zone.getFragment(),
+                    "version": zone.version,
+                    "timestamp": zone.last_state_update,
+                    "stale": True
+                }, "zone/" + str(id))
+            elif kind == "area":
+                area = self.areas[id-1]
+                self._event_callback({
+                    "type": "area",
+                    "event": "snapshot",
+                    "data": area.getFragment(),
+                    "version": area.version,
+                    "timestamp": area.last_state_update,
+                    "stale": True
+                }, "area/" + str(id))
+            elif kind == "pgm":
+                self._event_callback({
+                    "id": id,
+                    "state": self.pgm[id-1].state,
+                    "stale": True
+                }, "pgm/" + str(id))
+            self.publish_state(kind, id)
+        if stale:
+            self._log.info("Published %d stale states from snapshot" % (len(stale)))
+
+    # Called when entities were rescheduled outside of panel sync
+    def sync_changed(self):
+        pass
+
+    # Forget all cached labels and refetch every monitored entity
+    def invalidate_labels(self):
+        self._log.info("Panel programming finished; refreshing labels")
+        self._labels.invalidate()
+
+        now = time.time()
+        for kind, entities in (("area", self.areas), ("zone", self.zones), ("user", self.users.values())):
+            for entity in entities:
+                if (entity != None) and (entity.id != 0 or kind != "user"):
+                    entity.last_name_update = None
+                    self._scheduler.schedule(kind, entity.id, now)
+        self.sync_changed()
 
-        for user in self.users:
-            if (user != None) and (user.id != 0) and ( (user.last_name_update == None) or (time.time() - user.last_name_update >= user_update) ):
-                self.fetch_user(user.id)
+    def panel_sync(self):
+        self._log.debug("Panel sync poll")
+        for fetch, id in self.sync_due():
+            fetch(id)
+        self._labels.save()
 
-    def __init__(self, config, event_callback):
+    def __init__(self, config, event_callback, state_callback = None):
         self._log = logging.getLogger(logger_name)
         self._config = config
         self._event_callback = event_callback
-        self._serial_lock = Lock()
+        self._state_callback = state_callback
+        self._serial_lock = PriorityLock()
+        self._stale_lock = threading.Lock()
+        self._framer = LineFramer()
         
-        self._serial_lock.acquire()
+        self._serial_lock.acquire(counted = False)
 
         # Open serial port
         try:
@@ -882,10 +930,27 @@ class PRT:
             self._log.error("Invalid port configuration: %s" % (get_config(self._config, "prt3")))
             sys.exit(1)
 
+        # Serial read mode: "bulk" drains all waiting bytes per read,
+        # "line" reads byte by byte until end of line
+        read_mode = get_config_default(self._config, "prt3.read_mode", "bulk")
+        if read_mode == "line":
+            self._read = self.serial_readline
+        else:
+            self._read = self.serial_read
+        self._log.debug("Serial read mode: %s" % (read_mode))
+
         self._log.info("Opening serial port %s" % (serial_port))
         self._ser = serial.Serial(port=serial_port, baudrate=serial_speed, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, 
                     bytesize=serial.EIGHTBITS, timeout=0.1, xonxoff=False, rtscts=False, dsrdtr=False)
 
+        # Entity state of this instance; zone / area states are packed
+        self._area_store = StateStore(8, area_fields)
+        self._zone_store = StateStore(192, zone_fields)
+        self.areas = [None] * self._area_store.size
+        self.zones = [None] * self._zone_store.size
+        self.users = {}
+        self.pgm = [None] * 30
+
         # Load panel configuration
         cfg_panel = get_config(self._config, "panel")
     
@@ -896,17 +961,18 @@ class PRT:
             # Load monitored area ranges
             for i in cfg_panel["areas"]:
                 for i2 in range(i[0], i[1]+1):
-                    self.areas[i2-1] = PRT_Area(i2)
+                    self.areas[i2-1] = PRT_Area(i2, self._area_store)
                     self._sum_areas += 1
 
             # Load monitored zone ranges
             for i in cfg_panel["zones"]:
                 for i2 in range(i[0], i[1]+1):
-                    self.zones[i2-1] = PRT_Zone(i2)
+                    self.zones[i2-1] = PRT_Zone(i2, self._zone_store)
                     self._sum_zones += 1
 
             # Load monitored user ranges
             self.users[0] = PRT_User(0)
+            self.users[0].name = "Master Technician"
             for i in cfg_panel["users"]:
                 for i2 in range(i[0], i[1]+1):
                     self.users[i2] = PRT_User(i2)
@@ -916,10 +982,50 @@ class PRT:
             self._log.error("Unable to parse panel config")
             sys.exit(1)
 
+        # Labels known from previous runs; revalidated once older than
+        # prt3.refresh.names
+        self._labels = LabelCache(get_config_default(self._config, "prt3.label_cache", None), self._panel_type, logger_name)
+        self._labels.load()
+        for kind, entities in (("area", self.areas), ("zone", self.zones), ("user", self.users.values())):
+            for entity in entities:
+                cached = self._labels.get(kind, entity.id) if entity != None else None
+                if cached != None:
+                    entity.name, entity.last_name_update = cached
+
+        self._name_update = get_config(self._config, "prt3.refresh.names") * 60
+
+        # Refresh schedule for monitored entities (all due right away, users
+        # with a cached label one refresh interval after it was read)
+        self._scheduler = SyncScheduler({
+            "area": get_config(self._config, "prt3.refresh.area") * 60,
+            "zone": get_config(self._config, "prt3.refresh.zone") * 60,
+            "user": get_config(self._config, "prt3.refresh.user") * 60
+        })
+        for area in self.areas:
+            if area != None:
+                self._scheduler.schedule("area", area.id, 0)
+        for zone in self.zones:
+            if zone != None:
+                self._scheduler.schedule("zone", zone.id, 0)
+        for user in self.users.values():
+            if user.id != 0:
+                self._scheduler.schedule("user", user.id, 0)
+                if user.last_name_update != None:
+                    self._scheduler.freshen("user", user.id, user.last_name_update)
+
         # Init PGMs
         for i in range(1,30):
             self.pgm[i-1] = PRT_PGM(i)
-        
+
+        # Warm start: last known states until the scheduler confirms them
+        snapshot_path = get_config_default(self._config, "prt3.snapshot.path", None)
+        if snapshot_path:
+            self._snapshot = StateSnapshot(snapshot_path, self._panel_type, logger_name)
+            self._snapshot_interval = get_config_default(self._config, "prt3.snapshot.interval", 60)
+            self._snapshot_saved = time.time()
+            configured = {"zone": self.zones, "area": self.areas, "pgm": self.pgm}
+            self._stale = set((kind, id) for kind, id in self._snapshot.load(self._zone_store, self._area_store, self.pgm) if configured[kind][id-1] != None)
+
         self._log.debug("Panel object successfully initialized")
         self._log.debug("* Areas = %d; Zones = %d; Users = %d" % (self._sum_areas, self._sum_zones, self._sum_users))
         
@@ -930,11 +1036,56 @@ class PRT:
         # Close serial port before quitting
         self._log.info("Closing serial port")
         self._ser.close()
+        self._labels.save()
+        self.checkpoint(force = True)
 
-    def loop(self):
-        self._serial_lock.acquire()
-        serin = self.serial_readline()
+    def loop(self, timeout = 0.5):
+        self._serial_lock.acquire(counted = False)
+        serin = self._read(timeout)
         self._serial_lock.release()
-        if (serin != ''):
+        if serin:
             self.input_serial(serin)
 
+
+# Event dispatch table indexed by event group (0 - 66); groups without
+# a handler are reported through process_unknown_event
+event_dispatch = [None] * 67
+for _groups, _handler in (
+    (list(zone_events), PRT.process_zone_event),
+    ([4], PRT.process_nonreportable_event),
+    (list(useraccess_events), PRT.process_useraccess_event),
+    ([8], PRT.process_delayzonealarm_event),
+    ([9, 10, 11, 12, 46, 47], PRT.process_arming_event),
+    ([13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 28, 29], PRT.process_disarming_event),
+    ([30], PRT.process_special_alarm_event),
+    ([31], PRT.process_duress_alarm_event),
+    ([35], PRT.process_special_tamper_event),
+    (list(trouble_events), PRT.process_trouble_event),
+    (list(module_trouble_events), PRT.process_module_event),
+    ([40], PRT.process_comm_fail_event),
+    ([45], PRT.process_special_event),
+    ([48], PRT.process_utility_key_event),
+    (list(door_events), PRT.process_door_event),
+    (list(combus_events), PRT.process_combus_event),
+    ([60, 61], PRT.process_future_use_event),
+    (list(access_events), PRT.process_access_granted_event),
+    (list(status_events), PRT.process_status_event)
+):
+    for _group in _groups:
+        event_dispatch[_group] = _handler
+
+# Event name table by event group for groups whose handler names the event
+# code (None: every event code is valid)
+event_names = [None] * 67
+for _groups, _names in (
+    ([12], special_arming_events),
+    ([22], special_disarming_events),
+    ([30], special_alarm_sources),
+    (list(trouble_events), trouble_sources),
+    (list(module_trouble_events), module_trouble_sources),
+    ([45], special_events)
+):
+    for _group in _groups:
+        event_names[_group] = _names
+for _group, _names in status_events.items():
+    event_names[_group] = _names
@@ -0,0 +1,102 @@
+import asyncio
+import time
+from common.config import get_config_default
+from paradox.commands import CommandEngine, PRIORITY_POLL
+from paradox.prt3 import PRT, logger_name, regex_area_label, regex_area_status, regex_zone_label, regex_zone_status, regex_user_label
+
+# AsyncPRT class
+# PRT running on an asyncio event loop: the serial port is read from a loop
+# reader callback as soon as data arrives and commands are coroutines
+# waiting for their response instead of polling the port. Commands go
+# through a CommandEngine which keeps several of them in flight.
+class AsyncPRT(PRT):
+    _loop = None
+    _commands = None
+    _sync_wakeup = None
+
+    def _on_serial_readable(self):
+        try:
+            serin = self._ser.read(self._ser.in_waiting or 1)
+        except Exception as e:
+            self._log.error("Serial read failed: %s" % (e))
+            return
+
+        if serin:
+            self.input_serial(serin)
+
+    def _write_command(self, cmd):
+        self._ser.write((cmd + "\r").encode("ascii"))
+
+    # Replies are correlated with in-flight commands by their echo prefix
+    def process_reply(self, token, regex_response = None):
+        if not self._commands.resolve(token):
+            self.process_unknown_command(token.line)
+        return None
+
+    async def command(self, cmd, regex, priority = PRIORITY_POLL):
+        return await self._commands.submit(cmd, regex, priority = priority)
+
+    def command_stats(self):
+        return self._commands.stats.getData()
+
+    async def fetch_area(self, id):
+        self._log.debug("Fetching area [%d]" % (id))
+
+        # Request area label
+        if self.name_update_due(self.areas[id-1]):
+            self.update_area_label(id, await self.command("AL%03d" % (id), regex_area_label))
+
+        # Request area status
+        self.update_area_status(id, await self.command("RA%03d" % (id), regex_area_status))
+
+    async def fetch_zone(self, id):
+        self._log.debug("Fetching zone [%d]" % (id))
+
+        # Request zone label
+        if self.name_update_due(self.zones[id-1]):
+            self.update_zone_label(id, await self.command("ZL%03d" % (id), regex_zone_label))
+
+        # Request zone status
+        self.update_zone_status(id, await self.command("RZ%03d" % (id), regex_zone_status))
+
+    async def fetch_user(self, id):
+        self._log.debug("Fetching user [%d]" % (id))
+
+        # Request user label
+        self.update_user_label(id, await self.command("UL%03d" % (id), regex_user_label))
+
+    # All due entities are fetched concurrently; the command engine keeps
+    # the pipeline to the panel full
+    async def panel_sync(self):
+        self._log.debug("Panel sync poll")
+        ret = await asyncio.gather(*[fetch(id) for fetch, id in self.sync_due()], return_exceptions = True)
+        for error in ret:
+            if isinstance(error, Exception):
+                self._log.error("Panel sync failed: %s" % (error))
+        self._labels.save()
+
+    def sync_changed(self):
+        self._sync_wakeup.set()
+
+    # Sleeps until the next entity is due for refresh or the schedule changed
+    async def wait_sync(self):
+        next_sync = self.next_sync()
+        try:
+            await asyncio.wait_for(self._sync_wakeup.wait(), max(0.0, next_sync - time.time()) if next_sync != None else 10)
+        except asyncio.TimeoutError:
+            pass
+        self._sync_wakeup.clear()
+
+    def __init__(self, config, event_callback, loop, state_callback = None):
+        PRT.__init__(self, config, event_callback, state_callback)
+        self._loop = loop
+        self._sync_wakeup = asyncio.Event()
+        self._commands = CommandEngine(loop, self._write_command, logger_name,
+            depth = get_config_default(config, "prt3.pipeline.depth", None),
+            timeout = get_config_default(config, "prt3.pipeline.timeout", None))
+        self._loop.add_reader(self._ser.fileno(), self._on_serial_readable)
+
+    def close(self):
+        self._loop.remove_reader(self._ser.fileno())
+        self._commands.close()
+        PRT.close(self)
@@ -0,0 +1,284 @@
+import collections
+import logging
+import threading
+import time
+import paho.mqtt.client as mqtt
+
+# Publish classes, in dispatch order. Critical messages (alarms, arming and
+# request responses) are sent with QoS 1 and are never shed in favour of
+# lower classes; status messages are shed first.
+publish_critical = 0
+publish_normal = 1
+publish_status = 2
+publish_class_names = ("critical", "normal", "status")
+publish_qos = (1, 0, 0)
+
+# Event topic families (first topic level) by publish class; all other
+# families are normal
+publish_families = {
+    "arming": publish_critical,
+    "special_alarm": publish_critical,
+    "duress_alarm": publish_critical,
+    "txdelayzonealarm": publish_critical,
+    "special_tamper": publish_critical,
+    "status": publish_status,
+    "future_use": publish_status,
+    "metrics": publish_status
+}
+
+# Zone events (payload "event") raised above the class of their family
+publish_zone_events = {
+    "alarm": publish_critical,
+    "fire_alarm": publish_critical
+}
+
+def publish_class(topic):
+    if not topic:
+        return publish_normal
+    return publish_families.get(topic.split("/", 1)[0], publish_normal)
+
+# Publish class of an event payload sent on <topic>
+def event_class(topic, event):
+    if topic and topic.startswith("zone/"):
+        return publish_zone_events.get(event.get("event"), publish_normal)
+    return publish_class(topic)
+
+# PublishQueue class
+# Bounded outbound queue in front of the paho client. Messages wait in one
+# FIFO per publish class while the broker is disconnected or <max_inflight>
+# messages are still unacknowledged (QoS 1: PUBACK received, QoS 0: written
+# to the socket), and are dispatched critical first. Once <high_water>
+# messages are queued new status messages are dropped; at <max_queued> the
+# oldest message of the lowest class not above the new one is dropped
+# (or the new one if only higher classes are queued).
+#
+# With an EventSpool, events (messages that are not retained) published while
+# the broker is disconnected go to the spool instead and are replayed by
+# replay() after reconnecting, marked with the time they were spooled, at
+# their original class capped at normal so a replay cannot crowd out live
+# critical events:
+#
+#   {"spooled": 1589712345.67, <original event>}
+#
+# paho holds its own locks while calling on_publish, so the queue lock is
+# never held during client.publish(); a single dispatcher at a time keeps
+# the order within a class.
+class PublishQueue:
+    _log = None
+    _client = None
+    _lock = None
+    _dispatch_lock = None
+    _queues = None
+    _depth = 0
+    _inflight = None
+    _reserved = 0
+    _early = None
+    _connected = False
+    _spool = None
+
+    max_queued = None
+    high_water = None
+    max_inflight = None
+
+    # Counters
+    _max_depth = 0
+    _sent = 0
+    _acked = 0
+    _lost = 0
+    _dropped = None
+    _latency_count = 0
+    _latency_sum = 0
+    _latency_max = 0
+
+    def __init__(self, client, max_queued, high_water, max_inflight, logger_name, spool = None):
+        self._log = logging.getLogger(logger_name)
+        self._client = client
+        self._lock = threading.Lock()
+        self._dispatch_lock = threading.Lock()
+        self._queues = [collections.deque() for i in publish_class_names]
+        self._inflight = {}
+        self._early = {}
+        self._dropped = [0] * len(publish_class_names)
+        self.max_queued = max_queued
+        self.high_water = min(high_water, max_queued)
+        self.max_inflight = max_inflight
+        self._spool = spool
+        client.max_inflight_messages_set(max_inflight)
+
+    def put(self, topic, payload, cls = publish_normal, retain = False):
+        with self._lock:
+            if self._spool and (not self._connected) and (not retain):
+                self._spool.append(time.time(), cls, topic, payload)
+                return True
+            if (self._depth >= self.high_water) and (cls == publish_status):
+                self._dropped[cls] += 1
+                return False
+            if self._depth >= self.max_queued:
+                for victim in range(len(self._queues) - 1, cls - 1, -1):
+                    if self._queues[victim]:
+                        self._queues[victim].popleft()
+                        self._dropped[victim] += 1
+                        self._depth -= 1
+                        break
+                else:
+                    self._dropped[cls] += 1
+                    return False
+            self._append(cls, topic, payload, retain)
+
+        self.dispatch()
+        return True
+
+    def _append(self, cls, topic, payload, retain):
+        self._queues[cls].append((topic, payload, retain))
+        self._depth += 1
+        if self._depth > self._max_depth:
+            self._max_depth = self._depth
+
+    # Moves up to <limit> spooled events to the queue while connected and
+    # the queue is below half the high-water mark; returns True if events
+    # are left to replay
+    def replay(self, limit):
+        with self._lock:
+            if (not self._spool) or (not self._connected):
+                return False
+            if self._depth < self.high_water // 2:
+                for timestamp, cls, topic, payload in self._spool.read(limit):
+                    if payload.startswith(b"{") and (not payload.startswith(b'{"spooled":')):
+                        payload = (b'{"spooled":%r' % (timestamp)) + (b"," if payload[1:2] != b"}" else b"") + payload[1:]
+                    self._append(max(cls, publish_normal), topic, payload, False)
+            pending = not self._spool.empty()
+
+        self.dispatch()
+        return pending
+
+    # Next message to publish (reserving an in-flight slot) or None
+    def _next(self):
+        if (not self._connected) or (len(self._inflight) + self._reserved >= self.max_inflight):
+            return None
+        for cls, queue in enumerate(self._queues):
+            if queue:
+                self._depth -= 1
+                self._reserved += 1
+                return (cls,) + queue.popleft()
+        return None
+
+    def dispatch(self):
+        while self._dispatch_lock.acquire(False):
+            try:
+                while True:
+                    with self._lock:
+                        item = self._next()
+                    if item == None:
+                        break
+                    self._send(*item)
+            finally:
+                self._dispatch_lock.release()
+
+            # Retry if a message or an ack arrived after the last check
+            with self._lock:
+                if (not self._connected) or (len(self._inflight) + self._reserved >= self.max_inflight) or (self._depth == 0):
+                    return
+
+    def _send(self, cls, topic, payload, retain):
+        qos = publish_qos[cls]
+        sent = time.time()
+        try:
+            info = self._client.publish(topic, payload, qos = qos, retain = retain)
+        except (ValueError, TypeError) as e:
+            self._log.error("Unable to send MQTT message to %s: %s" % (topic, e))
+            with self._lock:
+                self._reserved -= 1
+                self._lost += 1
+            return
+
+        with self._lock:
+            self._reserved -= 1
+            if (info.rc == mqtt.MQTT_ERR_NO_CONN) and (qos == 0):
+                # Not sent; keep it for the next connection
+                self._queues[cls].appendleft((topic, payload, retain))
+                self._depth += 1
+                self._connected = False
+                return
+            self._sent += 1
+            if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                self._lost += 1
+                return
+            acked = self._early.pop(info.mid, None)
+            if acked == None:
+                self._inflight[info.mid] = (sent, qos)
+            else:
+                self._record_ack(sent, qos, acked)
+
+    def _record_ack(self, sent, qos, acked):
+        self._acked += 1
+        if qos:
+            latency = acked - sent
+            self._latency_count += 1
+            self._latency_sum += latency
+            if latency > self._latency_max:
+                self._latency_max = latency
+
+    # paho on_publish: QoS 1 acknowledged / QoS 0 written
+    def acked(self, mid):
+        now = time.time()
+        with self._lock:
+            entry = self._inflight.pop(mid, None)
+            if entry == None:
+                # publish() has not returned yet
+                self._early[mid] = now
+                return
+            self._record_ack(entry[0], entry[1], now)
+        self.dispatch()
+
+    def connected(self):
+        with self._lock:
+            self._connected = True
+        self.dispatch()
+
+    # QoS 0 messages not yet written are discarded by paho on disconnect;
+    # QoS 1 messages are resent by paho after reconnecting
+    def disconnected(self):
+        with self._lock:
+            self._connected = False
+            for mid, (sent, qos) in list(self._inflight.items()):
+                if qos == 0:
+                    del self._inflight[mid]
+                    self._lost += 1
+            self._early.clear()
+
+    # Queued events are kept in the spool (if any) for the next run
+    def close(self):
+        if not self._spool:
+            return
+        with self._lock:
+            now = time.time()
+            for cls, queue in enumerate(self._queues):
+                for topic, payload, retain in queue:
+                    if not retain:
+                        self._spool.append(now, cls, topic, payload)
+                queue.clear()
+            self._depth = 0
+            self._spool.close()
+
+    # Messages queued or not yet acknowledged
+    def pending(self):
+        with self._lock:
+            return self._depth + len(self._inflight) + self._reserved
+
+    def getData(self):
+        with self._lock:
+            return {
+                "depth": self._depth,
+                "max_depth": self._max_depth,
+                "inflight": len(self._inflight),
+                "sent": self._sent,
+                "acked": self._acked,
+                "lost": self._lost,
+                "dropped": dict(zip(publish_class_names, self._dropped)),
+                "ack_latency": {
+                    "count": self._latency_count,
+                    "avg": round(self._latency_sum * 1000 / self._latency_count, 3) if self._latency_count else None,
+                    "max": round(self._latency_max * 1000, 3)
+                },
+                "spool": self._spool.getData() if self._spool else None
+            }
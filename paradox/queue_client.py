@@ -1,53 +1,259 @@
 import logging
 import sys
+import json
+import threading
+import time
 from common.config import get_config, get_config_default
 import paho.mqtt.client as mqtt
+from common.binary import encode_state
+from common.mqtt_asyncio import AsyncioHelper
+from paradox.publish import PublishQueue, publish_class, publish_critical, publish_normal
+from paradox.spool import EventSpool
 
 logger_name = 'prt3_mqtt'
 
+# Channel class
+# Outbound topics of one panel on a shared connection: events, responses,
+# broadcasts and the retained state of the panel's model. With a panel id
+# every topic gets the id as its first level below the configured queue
+# topic; without one the configured topics are used as they are.
+class Channel:
+    _publisher = None
+    _events_topic = None
+    _responses_topic = None
+    _broadcasts_topic = None
+    _state_topic = None
+    _binary_topic = None
+    _state = None
+    _state_lock = None
+    _state_dirty = False
+    _snapshot_interval = None
+    _snapshot_sent = 0
+
+    panel_id = None
+
+    def __init__(self, config, publisher, panel_id = None):
+        self._publisher = publisher
+        self.panel_id = panel_id
+        suffix = ("/" + panel_id) if panel_id else ""
+        self._events_topic = get_config(config, "queue.queues.events") + suffix
+        self._responses_topic = get_config(config, "queue.queues.responses") + suffix
+        self._broadcasts_topic = get_config(config, "queue.queues.broadcasts") + suffix
+
+        # Retained state topics (disabled when queue.queues.state is not set)
+        self._state_topic = get_config_default(config, "queue.queues.state", None)
+        self._state = {}
+        self._state_lock = threading.Lock()
+        self._snapshot_interval = get_config_default(config, "queue.snapshot_interval", 1)
+
+        # Compact binary copy of the state topics (opt-in, queue.queues.binary)
+        if self._state_topic:
+            self._state_topic += suffix
+            self._binary_topic = get_config_default(config, "queue.queues.binary", None)
+            if self._binary_topic:
+                self._binary_topic += suffix
+
+    # <cls> overrides the publish class of the topic family
+    def send_event(self, payload, topic = None, cls = None):
+        qtopic = self._events_topic + (("/" + topic) if topic else "")
+        self._publisher.put(qtopic, payload, publish_class(topic) if cls == None else cls)
+
+    # Retained compact state of one zone / area / PGM; only sent when it
+    # differs from the last one
+    def send_state(self, kind, id, state):
+        if self._state_topic == None:
+            return
+
+        fragment = json.dumps(state, separators = (",", ":"))
+        with self._state_lock:
+            entities = self._state.setdefault(kind, {})
+            if entities.get(id) == fragment:
+                return
+            entities[id] = fragment
+            self._state_dirty = True
+
+        self._put_state(kind, id, fragment, state)
+
+    def _put_state(self, kind, id, fragment, state):
+        if not self._publisher.put("%s/%s/%d" % (self._state_topic, kind, id), fragment, publish_normal, True):
+            # Shed; forget it so the next update of the entity is sent
+            with self._state_lock:
+                if self._state[kind].get(id) == fragment:
+                    del self._state[kind][id]
+                    self._state_dirty = True
+        if self._binary_topic:
+            self._publisher.put("%s/%s/%d" % (self._binary_topic, kind, id), encode_state(kind, id, state, time.time()), publish_normal, True)
+
+    # Sends all cached state fragments and the snapshot again; retained
+    # updates shed from the queue or lost with the connection are not
+    # resent otherwise
+    def republish(self):
+        if self._state_topic == None:
+            return
+
+        with self._state_lock:
+            fragments = [(kind, id, entities[id]) for kind, entities in self._state.items() for id in sorted(entities)]
+            if not fragments:
+                return
+            self._state_dirty = True
+
+        for kind, id, fragment in fragments:
+            self._put_state(kind, id, fragment, json.loads(fragment))
+        self.send_snapshot(True)
+
+    # Retained snapshot of the whole model ("<state>/snapshot"), assembled
+    # from the per-entity fragments; sent at most every snapshot interval
+    def send_snapshot(self, force = False):
+        if self._state_topic == None:
+            return
+
+        now = time.time()
+        with self._state_lock:
+            if (not self._state_dirty) or ((not force) and (now - self._snapshot_sent < self._snapshot_interval)):
+                return
+            parts = ['"timestamp":%r' % (now)]
+            for kind in sorted(self._state):
+                entities = self._state[kind]
+                parts.append('"%s":{%s}' % (kind, ",".join('"%d":%s' % (id, entities[id]) for id in sorted(entities))))
+            self._state_dirty = False
+            self._snapshot_sent = now
+
+        if not self._publisher.put(self._state_topic + "/snapshot", '{%s}' % (",".join(parts)), publish_normal, True):
+            with self._state_lock:
+                self._state_dirty = True
+
+    def send_broadcast(self, payload, topic = None):
+        self._publisher.put(self._broadcasts_topic, payload, publish_normal)
+
+    # Request responses are critical (QoS 1)
+    def send_response(self, payload, topic = None):
+        _topic = self._responses_topic + (("/" + topic) if topic else "")
+        self._publisher.put(_topic, payload, publish_critical)
+
 class Client:
     _log = None
     _config = None
     _client = None
     _msg_callback = None
+    _connect_callback = None
+    _aio = None
+    _publisher = None
+    _loop = None
+    _replay_lock = None
+    _replay_armed = False
+    _replay_batch = 1
+    _channels = None
+
+    channel = None
 
     def _on_connect(self, client, userdata, flags, rc):
         self._log.info("Connected to queue with result code %d" % (rc))
         req_topic = get_config(self._config, "queue.queues.requests") + "/#"
         self._log.info("Subscribing to topic: %s" % (req_topic))
         client.subscribe(req_topic)
+        self._publisher.connected()
+        for channel in self._channels:
+            channel.republish()
+        self._start_replay()
+        if self._connect_callback:
+            self._connect_callback()
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._log.info("Disconnected from queue with result code %d" % (rc))
+        self._publisher.disconnected()
+        if self._aio:
+            self._aio.disconnected(rc)
 
     def _on_message(self, client, userdata, msg):
         if self._msg_callback:
             self._msg_callback(userdata, msg)
 
-    def send_event(self, payload, topic = None):
-        try:
-            qtopic = get_config(self._config, "queue.queues.events") + (("/" + topic) if topic else "")
-            self._client.publish(qtopic, payload)
-        except:
-            self._log.error("Unable to send MQTT event")
+    def _on_publish(self, client, userdata, mid):
+        self._publisher.acked(mid)
+
+    # Spooled events are replayed in small batches every 0.1 s
+    def _start_replay(self):
+        with self._replay_lock:
+            if self._replay_armed:
+                return
+            self._replay_armed = True
+        self._schedule(0.1, self._replay)
+
+    def _replay(self):
+        with self._replay_lock:
+            self._replay_armed = False
+        if self._publisher.replay(self._replay_batch):
+            self._start_replay()
+
+    def _schedule(self, delay, callback):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._loop.call_later, delay, callback)
+        else:
+            timer = threading.Timer(delay, callback)
+            timer.daemon = True
+            timer.start()
+
+    # Topics of the panel <panel_id> ("<queue topic>/<panel_id>/..."), on
+    # this connection
+    def panel_channel(self, panel_id):
+        channel = Channel(self._config, self._publisher, panel_id)
+        self._channels.append(channel)
+        return channel
+
+    def send_event(self, payload, topic = None, cls = None):
+        self.channel.send_event(payload, topic, cls)
+
+    def send_state(self, kind, id, state):
+        self.channel.send_state(kind, id, state)
+
+    def send_snapshot(self, force = False):
+        self.channel.send_snapshot(force)
 
     def send_broadcast(self, payload, topic = None):
-        try:
-            self._client.publish(get_config(self._config, "queue.queues.broadcasts"), payload)
-        except:
-            self._log.error("Unable to send MQTT broadcast")
+        self.channel.send_broadcast(payload, topic)
 
     def send_response(self, payload, topic = None):
-        try:
-            _topic = get_config(self._config, "queue.queues.responses") + (("/" + topic) if topic else "")
-            self._client.publish(_topic, payload)
-        except:
-            self._log.error("Unable to send MQTT response")
+        self.channel.send_response(payload, topic)
 
-    def __init__(self, config, msg_callback):
+    # Number of outbound messages queued or waiting for an ack
+    def pending(self):
+        return self._publisher.pending()
+
+    # Outbound queue counters (depth, drops, ack latency)
+    def publish_stats(self):
+        return self._publisher.getData()
+
+    # With an asyncio event loop given, the MQTT client is driven from that
+    # loop; otherwise paho runs its own network thread. connect_callback is
+    # called every time the connection to the broker is established. The
+    # connection is only opened by start(), once the panel channels are set
+    # up.
+    def __init__(self, config, msg_callback, loop = None, connect_callback = None):
         self._log = logging.getLogger(logger_name)
         self._config = config
 
         self._client = mqtt.Client(client_id = "prt3_mqtt")
         self._client.on_connect = self._on_connect
         self._client.on_message = self._on_message
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+
+        # Bounded outbound queue, with events spooled to disk while the
+        # broker is unreachable (queue.spool.path)
+        spool = None
+        spool_path = get_config_default(config, "queue.spool.path", None)
+        if spool_path:
+            spool = EventSpool(spool_path,
+                get_config_default(config, "queue.spool.segment_size", 1048576),
+                get_config_default(config, "queue.spool.max_size", 67108864),
+                get_config_default(config, "queue.spool.overflow", "drop_oldest"), logger_name)
+            self._replay_batch = max(1, int(get_config_default(config, "queue.spool.replay_rate", 50) / 10))
+        self._replay_lock = threading.Lock()
+        self._loop = loop
+        self._publisher = PublishQueue(self._client,
+            get_config_default(config, "queue.publish.max_queued", 1000),
+            get_config_default(config, "queue.publish.high_water", 800),
+            get_config_default(config, "queue.publish.max_inflight", 20), logger_name, spool)
 
         tls_enabled = False
         if (get_config_default(config, "queue.tls", False)):
@@ -65,11 +271,24 @@ class Client:
                 self._client.tls_insecure_set(True)
         
         self._log.info("Initializing MQTT client")
-        self._client.connect_async(get_config(self._config, "queue.host"), get_config(self._config, "queue.port"))
-
         self._msg_callback = msg_callback
-        self._client.loop_start()
+        self._connect_callback = connect_callback
+
+        # Topics of a single panel (the connection's own)
+        self.channel = Channel(config, self._publisher)
+        self._channels = [self.channel]
+
+    def start(self):
+        self._client.connect_async(get_config(self._config, "queue.host"), get_config(self._config, "queue.port"))
+        if self._loop:
+            self._aio = AsyncioHelper(self._loop, self._client, logger_name)
+            self._aio.connect()
+        else:
+            self._client.loop_start()
 
     def close(self):
         self._log.info("Disconnecting from message broker")
+        if self._aio:
+            self._aio.close()
         self._client.disconnect()
+        self._publisher.close()
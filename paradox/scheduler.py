@@ -0,0 +1,68 @@
+import heapq
+import threading
+
+# SyncScheduler class
+# Deadline ordered refresh schedule for configured panel entities
+#
+# Entities ("area", "zone", "user") are kept in a heap keyed on the time
+# their state is due for refresh. Rescheduling an entity (eg. after a
+# G-event freshened it) pushes a new entry; outdated heap entries are
+# skipped when they reach the top, so every operation is O(log n). In thread
+# mode entities are also rescheduled from the MQTT network thread (events
+# parsed while a request waits for its response), so the heap is locked.
+class SyncScheduler:
+    _heap = None
+    _due = None
+    _interval = None
+    _retry = None
+    _lock = None
+
+    def __init__(self, interval, retry = 10):
+        self._heap = []
+        self._due = {}
+        self._interval = interval
+        self._retry = retry
+        self._lock = threading.Lock()
+
+    def schedule(self, kind, id, due):
+        with self._lock:
+            self._schedule(kind, id, due)
+
+    def _schedule(self, kind, id, due):
+        self._due[(kind, id)] = due
+        heapq.heappush(self._heap, (due, kind, id))
+
+        # Drop outdated entries once they outnumber the live ones
+        if len(self._heap) > 4 * len(self._due) + 64:
+            self._heap = [(due, kind, id) for (kind, id), due in self._due.items()]
+            heapq.heapify(self._heap)
+
+    # Entity state was refreshed at <now>; next refresh after full interval
+    def freshen(self, kind, id, now):
+        with self._lock:
+            if (kind, id) in self._due:
+                self._schedule(kind, id, now + self._interval[kind])
+
+    # Pops all entities due at <now>. Each of them is rescheduled for a retry
+    # (a successful refresh calls freshen and moves it further away)
+    def pop_due(self, now):
+        ret = []
+        with self._lock:
+            while self._heap and (self._heap[0][0] <= now):
+                due, kind, id = heapq.heappop(self._heap)
+                if self._due.get((kind, id)) != due:
+                    continue
+                ret.append((kind, id))
+                self._schedule(kind, id, now + min(self._retry, self._interval[kind]))
+        return ret
+
+    # Time of the earliest pending refresh (None if nothing is scheduled)
+    def next_wakeup(self):
+        with self._lock:
+            heap = self._heap
+            while heap and (self._due.get((heap[0][1], heap[0][2])) != heap[0][0]):
+                heapq.heappop(heap)
+            return heap[0][0] if heap else None
+
+    def __len__(self):
+        return len(self._due)
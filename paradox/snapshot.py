@@ -0,0 +1,95 @@
+import logging
+import math
+import os
+import struct
+
+# Packed record layouts (little endian). Zone / area records hold the two
+# StateStore bitmasks (known fields, set fields) as they are; timestamps are
+# doubles with NaN for "never updated".
+snapshot_magic = b"PRTS"
+snapshot_version = 1
+snapshot_header = struct.Struct("<4sB16sdHHH")
+zone_record = struct.Struct("<HBBd")
+area_record = struct.Struct("<HHHd")
+pgm_record = struct.Struct("<HBBd")
+
+def pack_time(timestamp):
+    return float("nan") if timestamp == None else timestamp
+
+def unpack_time(timestamp):
+    return None if math.isnan(timestamp) else timestamp
+
+# StateSnapshot class
+# Warm-start checkpoint of the panel model (zone, area and PGM states with
+# their update timestamps) in a compact binary file. Labels are kept by
+# LabelCache. The file is bound to the panel type and replaced atomically.
+class StateSnapshot:
+    _log = None
+    _path = None
+    _panel_type = None
+
+    def __init__(self, path, panel_type, logger_name):
+        self._log = logging.getLogger(logger_name)
+        self._path = path
+        self._panel_type = panel_type
+
+    def save(self, saved, zone_store, area_store, pgms):
+        zones = [slot for slot in range(zone_store.size) if zone_store.known[slot]]
+        areas = [slot for slot in range(area_store.size) if area_store.known[slot]]
+        pgms = [pgm for pgm in pgms if (pgm != None) and (pgm.state != None)]
+
+        data = [snapshot_header.pack(snapshot_magic, snapshot_version, self._panel_type.encode("ascii"), saved, len(zones), len(areas), len(pgms))]
+        for slot in zones:
+            data.append(zone_record.pack(slot + 1, zone_store.known[slot], zone_store.value[slot], zone_store.state_update[slot]))
+        for slot in areas:
+            data.append(area_record.pack(slot + 1, area_store.known[slot], area_store.value[slot], area_store.state_update[slot]))
+        for pgm in pgms:
+            data.append(pgm_record.pack(pgm.id, True, pgm.state, pack_time(pgm.last_status_update)))
+
+        try:
+            tmp_path = self._path + ".tmp"
+            with open(tmp_path, "wb") as snapshot_file:
+                snapshot_file.write(b"".join(data))
+            os.rename(tmp_path, self._path)
+            return True
+        except (IOError, OSError) as e:
+            self._log.warning("Unable to save state snapshot: %s" % (e))
+            return False
+
+    # Restores saved states into the zone / area stores and PGMs; returns
+    # the list of restored (kind, id)
+    def load(self, zone_store, area_store, pgms):
+        try:
+            with open(self._path, "rb") as snapshot_file:
+                data = snapshot_file.read()
+            magic, version, panel_type, saved, sum_zones, sum_areas, sum_pgms = snapshot_header.unpack_from(data, 0)
+        except (IOError, OSError, struct.error) as e:
+            self._log.info("State snapshot not loaded: %s" % (e))
+            return []
+
+        if (magic != snapshot_magic) or (version != snapshot_version) or (panel_type.rstrip(b"\0") != self._panel_type.encode("ascii")):
+            self._log.info("State snapshot does not match panel; ignoring")
+            return []
+
+        expected = snapshot_header.size + sum_zones * zone_record.size + sum_areas * area_record.size + sum_pgms * pgm_record.size
+        if len(data) != expected:
+            self._log.warning("State snapshot truncated; ignoring")
+            return []
+
+        restored = []
+        offset = snapshot_header.size
+        for kind, store, record, count in (("zone", zone_store, zone_record, sum_zones), ("area", area_store, area_record, sum_areas)):
+            for id, known, value, timestamp in record.iter_unpack(data[offset:offset + count * record.size]):
+                if 0 < id <= store.size:
+                    store.update_masks(id - 1, known, value, unpack_time(timestamp) or saved)
+                    store.state_update[id - 1] = timestamp
+                    restored.append((kind, id))
+            offset += count * record.size
+        for id, known, value, timestamp in pgm_record.iter_unpack(data[offset:]):
+            if (0 < id <= len(pgms)) and (pgms[id-1] != None) and known:
+                pgms[id-1].state = bool(value)
+                pgms[id-1].last_status_update = unpack_time(timestamp)
+                restored.append(("pgm", id))
+
+        self._log.info("Restored %d entities from state snapshot" % (len(restored)))
+        return restored
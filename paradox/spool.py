@@ -0,0 +1,198 @@
+import logging
+import os
+import struct
+
+# Spool record (little endian): timestamp (d), publish class (B), reserved (B),
+# topic length (H), payload length (I), followed by topic and payload
+spool_record = struct.Struct("<dBBHI")
+spool_prefix = "spool-"
+spool_suffix = ".log"
+spool_position = "position"
+
+# EventSpool class
+# Append-only on-disk spool for events published while the broker is
+# unreachable. Records are appended to numbered segment files in <path>
+# (rotated at <segment_size> bytes) and read back in order; a segment is
+# removed once it has been read completely. The read position is kept in
+# "<path>/position", so records still in the spool survive a restart.
+#
+# When the spool holds <max_size> bytes the overflow policy applies:
+# "drop_oldest" removes the oldest segment, "drop_new" refuses new records.
+# Not thread safe; PublishQueue calls it with its lock held.
+class EventSpool:
+    _log = None
+    _path = None
+    _segments = None
+    _sizes = None
+    _write_file = None
+    _read_segment = None
+    _read_file = None
+    _read_offset = 0
+    _size = 0
+
+    segment_size = None
+    max_size = None
+    overflow = None
+
+    # Counters
+    _spooled = 0
+    _replayed = 0
+    _dropped = 0
+    _dropped_bytes = 0
+
+    def __init__(self, path, segment_size, max_size, overflow, logger_name):
+        self._log = logging.getLogger(logger_name)
+        self._path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.overflow = overflow
+
+        try:
+            os.makedirs(path, exist_ok = True)
+            names = os.listdir(path)
+        except OSError as e:
+            self._log.error("Unable to open spool directory %s: %s" % (path, e))
+            names = []
+
+        self._segments = sorted(int(name[len(spool_prefix):-len(spool_suffix)]) for name in names
+            if name.startswith(spool_prefix) and name.endswith(spool_suffix) and name[len(spool_prefix):-len(spool_suffix)].isdigit())
+        self._sizes = {}
+        for segment in self._segments:
+            self._sizes[segment] = os.path.getsize(self._segment_path(segment))
+        self._size = sum(self._sizes.values())
+
+        if self._segments:
+            self._read_segment = self._segments[0]
+            try:
+                with open(os.path.join(path, spool_position)) as position_file:
+                    segment, offset = [int(i) for i in position_file.read().split()]
+                if segment in self._sizes:
+                    self._read_segment = segment
+                    self._read_offset = offset
+            except (IOError, OSError, ValueError):
+                pass
+            self._log.info("Spool holds %d bytes in %d segments" % (self._size - self._read_offset, len(self._segments)))
+
+    def _segment_path(self, segment):
+        return os.path.join(self._path, "%s%08d%s" % (spool_prefix, segment, spool_suffix))
+
+    def _remove_segment(self, segment):
+        if (segment == self._segments[-1]) and self._write_file:
+            self._write_file.close()
+            self._write_file = None
+        if (segment == self._read_segment) and self._read_file:
+            self._read_file.close()
+            self._read_file = None
+        self._segments.remove(segment)
+        self._size -= self._sizes.pop(segment)
+        try:
+            os.remove(self._segment_path(segment))
+        except OSError as e:
+            self._log.warning("Unable to remove spool segment: %s" % (e))
+        if segment == self._read_segment:
+            self._read_segment = self._segments[0] if self._segments else None
+            self._read_offset = 0
+
+    # Appends one record; returns False if it was refused or not written
+    def append(self, timestamp, cls, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        topic = topic.encode("utf-8")
+        record = spool_record.pack(timestamp, cls, 0, len(topic), len(payload)) + topic + payload
+
+        while self._size + len(record) > self.max_size:
+            if (self.overflow == "drop_new") or (not self._segments):
+                self._dropped += 1
+                self._dropped_bytes += len(record)
+                return False
+            oldest = self._segments[0]
+            self._dropped_bytes += self._sizes[oldest] - (self._read_offset if oldest == self._read_segment else 0)
+            self._log.warning("Spool full; dropping oldest segment")
+            self._remove_segment(oldest)
+
+        try:
+            # Segments left by a previous run are not appended to
+            if (self._write_file == None) or (self._sizes[self._segments[-1]] + len(record) > self.segment_size):
+                if self._write_file:
+                    self._write_file.close()
+                segment = (self._segments[-1] + 1) if self._segments else 1
+                self._write_file = open(self._segment_path(segment), "ab")
+                self._segments.append(segment)
+                self._sizes[segment] = 0
+                if self._read_segment == None:
+                    self._read_segment = segment
+                    self._read_offset = 0
+            self._write_file.write(record)
+            self._write_file.flush()
+        except (IOError, OSError) as e:
+            self._log.error("Unable to write to spool: %s" % (e))
+            self._dropped += 1
+            return False
+
+        self._sizes[self._segments[-1]] += len(record)
+        self._size += len(record)
+        self._spooled += 1
+        return True
+
+    # Reads up to <limit> records in order; returns [(timestamp, class,
+    # topic, payload)]. Records read are removed from the spool.
+    def read(self, limit):
+        records = []
+        while (len(records) < limit) and (self._read_segment != None):
+            segment = self._read_segment
+            try:
+                if self._read_file == None:
+                    self._read_file = open(self._segment_path(segment), "rb")
+                    self._read_file.seek(self._read_offset)
+                header = self._read_file.read(spool_record.size)
+                if len(header) == spool_record.size:
+                    timestamp, cls, reserved, topic_len, payload_len = spool_record.unpack(header)
+                    data = self._read_file.read(topic_len + payload_len)
+                    if len(data) == topic_len + payload_len:
+                        records.append((timestamp, cls, data[:topic_len].decode("utf-8"), data[topic_len:]))
+                        self._read_offset += spool_record.size + len(data)
+                        continue
+            except (IOError, OSError, UnicodeDecodeError) as e:
+                self._log.error("Unable to read spool segment: %s" % (e))
+
+            # End of segment; a truncated record at the end is skipped
+            self._remove_segment(segment)
+
+        self._replayed += len(records)
+        self._save_position()
+        return records
+
+    def _save_position(self):
+        try:
+            position_path = os.path.join(self._path, spool_position)
+            if self._read_segment == None:
+                if os.path.exists(position_path):
+                    os.remove(position_path)
+                return
+            with open(position_path + ".tmp", "w") as position_file:
+                position_file.write("%d %d" % (self._read_segment, self._read_offset))
+            os.rename(position_path + ".tmp", position_path)
+        except (IOError, OSError) as e:
+            self._log.warning("Unable to save spool position: %s" % (e))
+
+    def empty(self):
+        return self._read_segment == None
+
+    def close(self):
+        if self._write_file:
+            self._write_file.close()
+            self._write_file = None
+        if self._read_file:
+            self._read_file.close()
+            self._read_file = None
+        self._save_position()
+
+    def getData(self):
+        return {
+            "size": self._size - self._read_offset,
+            "segments": len(self._segments),
+            "spooled": self._spooled,
+            "replayed": self._replayed,
+            "dropped": self._dropped,
+            "dropped_bytes": self._dropped_bytes
+        }
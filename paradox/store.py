@@ -0,0 +1,88 @@
+import array
+import time
+
+nan = float("nan")
+
+# StateStore class
+# Packed state of one entity group (zones or areas) of a PRT instance.
+# Entities are slots (id - 1); their boolean fields are bits of two masks,
+# "known" (field has been read from the panel) and "value". Timestamps are
+# kept in float arrays with NaN for "never". Every change of a field bumps
+# the slot's version and stamps its change time, so changes since a given
+# time can be found with a single scan.
+class StateStore:
+    fields = None
+    size = None
+    known = None
+    value = None
+    state_update = None
+    name_update = None
+    changed = None
+    version = None
+    names = None
+    fragments = None
+    _bits = None
+
+    def __init__(self, size, fields):
+        self.fields = fields
+        self.size = size
+        self._bits = dict((field, 1 << bit) for bit, field in enumerate(fields))
+
+        typecode = "B" if len(fields) <= 8 else "H"
+        self.known = array.array(typecode, [0]) * size
+        self.value = array.array(typecode, [0]) * size
+        self.state_update = array.array("d", [nan]) * size
+        self.name_update = array.array("d", [nan]) * size
+        self.changed = array.array("d", [0.0]) * size
+        self.version = array.array("I", [0]) * size
+        self.names = [None] * size
+        self.fragments = [None] * size
+
+    def get(self, slot, field):
+        bit = self._bits[field]
+        if self.known[slot] & bit:
+            return (self.value[slot] & bit) != 0
+        return None
+
+    def set(self, slot, field, state):
+        return self.update(slot, {field: state})
+
+    # Packs {field: True / False / None} into (known, value) masks; fields not
+    # given keep their current state
+    def pack(self, slot, states):
+        known = self.known[slot]
+        value = self.value[slot]
+        bits = self._bits
+        for field, state in states.items():
+            bit = bits[field]
+            if state is None:
+                known &= ~bit
+                value &= ~bit
+            else:
+                known |= bit
+                if state:
+                    value |= bit
+                else:
+                    value &= ~bit
+        return known, value
+
+    # Sets several fields at once; returns the mask of changed fields
+    def update(self, slot, states, now = None):
+        known, value = self.pack(slot, states)
+        return self.update_masks(slot, known, value, now)
+
+    def update_masks(self, slot, known, value, now = None):
+        changed = (self.known[slot] ^ known) | (self.value[slot] ^ value)
+        if changed:
+            self.known[slot] = known
+            self.value[slot] = value
+            self.changed[slot] = now or time.time()
+            self.version[slot] += 1
+        return changed
+
+    def changed_fields(self, mask):
+        return [field for field in self.fields if mask & self._bits[field]]
+
+    # Slots changed after <since>
+    def changed_since(self, since):
+        return [slot for slot, changed in enumerate(self.changed) if changed > since]
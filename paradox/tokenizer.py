@@ -0,0 +1,75 @@
+import re
+from collections import namedtuple
+
+# Typed tokens produced by tokenize()
+# Every line received from PRT3 is classified exactly once and handed over
+# to the handlers as one of these
+EventToken = namedtuple("EventToken", ["group", "event", "area"])
+PgmToken = namedtuple("PgmToken", ["pgm", "state"])
+CommToken = namedtuple("CommToken", ["ok"])
+ReplyToken = namedtuple("ReplyToken", ["prefix", "command", "id", "data", "line"])
+UnknownToken = namedtuple("UnknownToken", ["line"])
+
+# Three-digit field lookup ("000" .. "999" -> int); a single dict lookup both
+# validates and converts the fixed-width numeric fields
+_number3 = dict(("%03d" % (i), i) for i in range(1000))
+_number2 = dict(("%02d" % (i), i) for i in range(100))
+
+# Compiled response patterns (command replies are matched against regexes
+# supplied by the caller; compile each of them only once)
+_response_patterns = {}
+
+def compile_response(regex):
+    if hasattr(regex, "match"):
+        return regex
+    pattern = _response_patterns.get(regex)
+    if pattern is None:
+        pattern = re.compile(regex)
+        _response_patterns[regex] = pattern
+    return pattern
+
+def match_response(token, regex):
+    # Returns the same list re.split() would return for a full-line match
+    # (['', group1, group2, ..., '']) to keep callers unchanged
+    m = compile_response(regex).match(token.line)
+    if m:
+        return [""] + list(m.groups()) + [""]
+    return None
+
+# Classify a single line using fixed-offset slicing
+#   GgggNnnnAaaa        -> EventToken
+#   PGMnnON / PGMnnOFF  -> PgmToken
+#   COMM&ok / COMM&fail -> CommToken
+#   CCnnn...            -> ReplyToken (command echo prefix, eg. RZ005, AA001&ok)
+def tokenize(line):
+    length = len(line)
+    first = line[:1]
+
+    if first == "G":
+        if (length == 12) and (line[4] == "N") and (line[8] == "A"):
+            group = _number3.get(line[1:4])
+            event = _number3.get(line[5:8])
+            area = _number3.get(line[9:12])
+            if (group is not None) and (event is not None) and (area is not None):
+                return EventToken(group, event, area)
+        return UnknownToken(line)
+
+    if first == "P" and line[1:3] == "GM":
+        pgm = _number2.get(line[3:5])
+        state = line[5:]
+        if (state == "ON" or state == "OFF") and (pgm is not None):
+            return PgmToken(pgm, state)
+        return UnknownToken(line)
+
+    if first == "C" and line[1:5] == "OMM&":
+        state = line[5:]
+        if state == "ok" or state == "fail":
+            return CommToken(state == "ok")
+        return UnknownToken(line)
+
+    if length >= 5:
+        id = _number3.get(line[2:5])
+        if (id is not None) and line[:2].isalpha():
+            return ReplyToken(line[:5], line[:2], id, line[5:], line)
+
+    return UnknownToken(line)
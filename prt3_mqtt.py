@@ -7,18 +7,32 @@ import json
 import signal
 import argparse
 import re
+import asyncio
+import threading
 from paradox.prt3 import PRT
+from paradox.prt3_async import AsyncPRT
 from paradox.queue_client import Client
-from common.config import get_config
+from paradox.batching import EventBatcher
+from paradox.payload import encode_event, has_fragment
+from paradox.publish import publish_class, event_class
+from paradox.commands import PRIORITY_PANIC, PRIORITY_ARMING, PRIORITY_CONTROL
+from common.config import get_config, get_config_default, compile_panels, prt3_schema, ConfigError
 # from threading import Lock
 
 # Global constants
 logger_name = 'prt3_mqtt'
 
+# Time allowed for queued messages to be sent when exiting
+drain_timeout = 2
+
 # Global variables
 config = None
 can_exit = False
-last_sync = None
+loop = None
+exit_event = None
+panels = {}
+queue = None
+topic_request_regex = None
 
 # Parse arguments
 parser = argparse.ArgumentParser(description='Paradox PRT3 to MQTT interface')
@@ -38,16 +52,17 @@ log.addHandler(handler)
 # Install event handler for SIGINT to allow program to exit gracefully
 def exit_gracefully(sig, frame):
     global can_exit
-    global prt
-    global queue
     if (not can_exit):
         log.info("Caught ^C; exitting")
         can_exit = True
+        if exit_event:
+            exit_event.set()
     else:
         log.info("Caught second ^C; force exitting")
-        if 'prt' in globals():
-            prt.close()
-        if 'queue' in globals():
+        for panel in panels.values():
+            if panel.prt:
+                panel.prt.close()
+        if queue:
             queue.close()
         exit(0)
 signal.signal(signal.SIGINT, exit_gracefully)   
@@ -62,8 +77,6 @@ def process_request(client_id, request_id, request, topic = None):
     return ret
 
 def process_arming_request(request):
-    global prt
-    
     response = None
 
     req_code = None
@@ -83,7 +96,7 @@ def process_arming_request(request):
                 req_code))
             regex = "^"+cmd[:5]+"&(ok|fail)$"
             log.info("Processing arm request: %s****" % (cmd[:5]))
-            prt_response = prt.prt3_command(cmd, regex)
+            prt_response = yield cmd, regex
             response = {
                 "arm": {
                     "area": req_area,
@@ -103,7 +116,7 @@ def process_arming_request(request):
                 }[req_armtype]))
             regex = "^"+cmd[:5]+"&(ok|fail)$"
             log.info("Processing quick arm request: %s" % (cmd))
-            prt_response = prt.prt3_command(cmd, regex)
+            prt_response = yield cmd, regex
             response = {
                 "quickarm": {
                     "area": req_area,
@@ -117,7 +130,7 @@ def process_arming_request(request):
             cmd = str("AD%03d%s" % (req_area, req_code))
             regex = "^"+cmd[:5]+"&(ok|fail)$"
             log.info("Processing disarm request: %s****" % (cmd[:5]))
-            prt_response = prt.prt3_command(cmd, regex)
+            prt_response = yield cmd, regex
             response = {
                 "disarm": {
                     "area": req_area,
@@ -128,8 +141,6 @@ def process_arming_request(request):
     return response
 
 def process_panic_request(request):
-    global prt
-
     response = None
     
     if ("type" in request) and ("area" in request):
@@ -143,7 +154,7 @@ def process_panic_request(request):
             }[req_type], req_area))
         regex = "^"+cmd[:5]+"&(ok|fail)$"
         log.info("Processing panic request: %s" % (cmd))
-        prt_response = prt.prt3_command(cmd, regex)
+        prt_response = yield cmd, regex
         response = {
                 "area": req_area,
                 "result": prt_response
@@ -152,8 +163,6 @@ def process_panic_request(request):
     return response
 
 def process_smoke_reset_request(request):
-    global prt
-
     response = None
     
     if ("area" in request):
@@ -162,7 +171,7 @@ def process_smoke_reset_request(request):
         cmd = str("SR%03d" % (req_area))
         regex = "^"+cmd[:5]+"&(ok|fail)$"
         log.info("Processing smoke reset request: %s" % (cmd))
-        prt_response = prt.prt3_command(cmd, regex)
+        prt_response = yield cmd, regex
         response = {
                 "area": req_area,
                 "result": prt_response
@@ -171,8 +180,6 @@ def process_smoke_reset_request(request):
     return response
 
 def process_utility_key_request(request):
-    global prt
-
     response = None
     
     if ("id" in request):
@@ -181,7 +188,7 @@ def process_utility_key_request(request):
         cmd = str("UK%03d" % (req_id))
         regex = "^"+cmd[:5]+"&(ok|fail)$"
         log.info("Processing utility key request: %s" % (cmd))
-        prt_response = prt.prt3_command(cmd, regex)
+        prt_response = yield cmd, regex
         response = {
                 "id": req_id,
                 "result": prt_response
@@ -190,8 +197,6 @@ def process_utility_key_request(request):
     return response
 
 def process_virtual_input_request(request):
-    global prt
-
     response = None
     
     if ("id" in request) and ("state" in request):
@@ -204,7 +209,7 @@ def process_virtual_input_request(request):
         cmd = str("V%s%03d" % (req_state, req_id))
         regex = "^"+cmd[:5]+"&(ok|fail)$"
         log.info("Processing virtual input request: %s" % (cmd))
-        prt_response = prt.prt3_command(cmd, regex)
+        prt_response = yield cmd, regex
         response = {
                 "id": req_id,
                 "result": prt_response
@@ -212,7 +217,52 @@ def process_virtual_input_request(request):
 
     return response
 
+# Request handlers by topic operation
+# Handlers are generators yielding (command, response regex) tuples and
+# receiving the PRT3 response; the same handler runs on the blocking PRT
+# (execute_request) or on the asyncio one (execute_request_async)
+# (command priority: panic > arming > other controls > panel polling)
+request_handlers = {
+    "arming": (process_arming_request, PRIORITY_ARMING),
+    "panic": (process_panic_request, PRIORITY_PANIC),
+    "smokereset": (process_smoke_reset_request, PRIORITY_CONTROL),
+    "utilitykey": (process_utility_key_request, PRIORITY_CONTROL),
+    "vinput": (process_virtual_input_request, PRIORITY_CONTROL)
+}
+
+def execute_request(prt, handler, request, priority):
+    steps = handler(request)
+    try:
+        cmd, regex = next(steps)
+        while True:
+            cmd, regex = steps.send(prt.prt3_command(cmd, regex, priority))
+    except StopIteration as e:
+        return e.value
+
+async def execute_request_async(prt, handler, request, priority):
+    steps = handler(request)
+    try:
+        cmd, regex = next(steps)
+        while True:
+            cmd, regex = steps.send(await prt.command(cmd, regex, priority))
+    except StopIteration as e:
+        return e.value
+
+def send_request_response(panel, ret, client_id, request_id, response_topic):
+    ret["client_id"] = client_id
+    ret["request_id"] = request_id
+    panel.channel.send_response(json.dumps(ret), response_topic)
+
+async def process_request_async(panel, handler, priority, request, client_id, request_id, response_topic):
+    try:
+        ret = await execute_request_async(panel.prt, handler, request, priority)
+        send_request_response(panel, ret, client_id, request_id, response_topic)
+    except:
+        log.warn("Unable to process MQTT request [client_id = %s, request_id = %s]" % (client_id, request_id))
+
 # MQTT callback (process request via PRT3)
+# Request topics are "<requests>/<client>/<operation>" with a single panel
+# and "<requests>/<panel id>/<client>/<operation>" with several
 def mqtt_callback(userdata, msg):
     try:
         log.info("mqtt_callback() parsing payload")
@@ -222,49 +272,26 @@ def mqtt_callback(userdata, msg):
         request_id = payload["reqid"]
 
         for request in payload["request"]:
-            topic_root = get_config(config, "queue.queues.requests")
-            topic_regex = "^" + topic_root + "/([^/]+)/([^/]+)$"
-            if (re.search(topic_regex, msg.topic)):
-                rx = re.split(topic_regex, msg.topic)
-                topic_user = rx[1]
-                topic_operation = rx[2]
+            rx = topic_request_regex.match(msg.topic)
+            panel = None
+            if rx:
+                panel = panels.get(rx.group("panel") or None)
+            if panel:
+                topic_user = rx.group("user")
+                topic_operation = rx.group("operation")
+                panel.requests += 1
                 log.debug("Received MQTT request [user = %s; operation = %s; topic = %s, client_id = %s, request_id = %s]" % (topic_user, topic_operation, msg.topic, client_id, request_id))
 
-                ret = None
-                response_topic = None
-                
-                if topic_operation == "arming":
-                    ret = process_arming_request(request)
-                    ret["client_id"] = client_id
-                    ret["request_id"] = request_id
-                    response_topic = topic_user + "/arming"
-
-                elif topic_operation == "panic":
-                    ret = process_panic_request(request)
-                    ret["client_id"] = client_id
-                    ret["request_id"] = request_id
-                    response_topic = topic_user + "/panic"
-
-                elif topic_operation == "smokereset":
-                    ret = process_smoke_reset_request(request)
-                    ret["client_id"] = client_id
-                    ret["request_id"] = request_id
-                    response_topic = topic_user + "/smokereset"
-
-                elif topic_operation == "utilitykey":
-                    ret = process_utility_key_request(request)
-                    ret["client_id"] = client_id
-                    ret["request_id"] = request_id
-                    response_topic = topic_user + "/utilitykey"
-
-                elif topic_operation == "vinput":
-                    ret = process_virtual_input_request(request)
-                    ret["client_id"] = client_id
-                    ret["request_id"] = request_id
-                    response_topic = topic_user + "/vinput"
-
-                if ret:
-                    queue.send_response(json.dumps(ret), response_topic)
+                if topic_operation in request_handlers:
+                    handler, priority = request_handlers[topic_operation]
+                    response_topic = topic_user + "/" + topic_operation
+
+                    if loop:
+                        # Runs on the event loop; the request starts right away
+                        loop.create_task(process_request_async(panel, handler, priority, request, client_id, request_id, response_topic))
+                    else:
+                        ret = execute_request(panel.prt, handler, request, priority)
+                        send_request_response(panel, ret, client_id, request_id, response_topic)
             else:
                 log.warn("Invalid MQTT request topic [topic = %s; client_id = %s; request_id = %s]" % (msg.topic, client_id, request_id))
 
@@ -272,9 +299,87 @@ def mqtt_callback(userdata, msg):
         log.warn("Invalid MQTT request received: %s" % (msg.payload))
 
 
-# PRT3 event callback (send message to MQTT)
-def prt3_event_callback(event, topic = None):
-    queue.send_event(json.dumps(event), topic)
+# Panel class
+# One PRT3 module: its PRT (own serial port and panel model), its topics on
+# the shared MQTT connection, its event batcher and metrics
+class Panel:
+    id = None
+    config = None
+    prt = None
+    channel = None
+    batcher = None
+    requests = 0
+
+    def __init__(self, panel_id, panel_config):
+        self.id = panel_id
+        self.config = panel_config
+
+    # Opens the serial port; with <loop> the PRT runs on that event loop
+    def open(self, loop = None):
+        if self.id:
+            log.info("Starting panel %s" % (self.id))
+        if loop:
+            self.prt = AsyncPRT(self.config, self.event_callback, loop, self.state_callback)
+        else:
+            self.prt = PRT(self.config, self.event_callback, self.state_callback)
+
+    # Attaches the panel to the MQTT connection; <schedule> arms the event
+    # batching window timer
+    def attach(self, queue, schedule):
+        self.channel = queue.panel_channel(self.id) if self.id else queue.channel
+
+        # Event batching (queue.batch.window > 0)
+        window = get_config_default(self.config, "queue.batch.window", 0)
+        if window:
+            self.batcher = EventBatcher(self.channel.send_event, schedule, window,
+                get_config_default(self.config, "queue.batch.max", 64),
+                get_config_default(self.config, "queue.batch.compat", True), logger_name)
+            log.info("Batching events; window = %.3f s" % (window))
+
+    # PRT3 event callback (send message to MQTT); events raised above the
+    # class of their topic family (zone alarms) are sent at once, unbatched
+    def event_callback(self, event, topic = None):
+        cls = event_class(topic, event)
+        if self.batcher and (cls == publish_class(topic)):
+            self.batcher.add(event, topic)
+        else:
+            self.channel.send_event(encode_event(event) if has_fragment(event) else json.dumps(event), topic, cls)
+
+    def state_callback(self, kind, id, state):
+        self.channel.send_state(kind, id, state)
+
+    # Runtime metrics (sent as "metrics" event of the panel); publish
+    # counters are those of the shared connection
+    def publish_metrics(self):
+        metrics = {
+            "type": "metrics",
+            "timestamp": time.time(),
+            "commands": self.prt.command_stats(),
+            "requests": self.requests
+        }
+        if self.id:
+            metrics["panel"] = self.id
+        if self.batcher:
+            metrics["batches"] = self.batcher.getData()
+        metrics["publish"] = queue.publish_stats()
+        self.channel.send_event(json.dumps(metrics), "metrics")
+
+    # Pending events and the final snapshot before exiting
+    def flush(self):
+        if self.batcher:
+            self.batcher.flush()
+        self.channel.send_snapshot(force = True)
+
+def start_timer(delay, callback):
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+
+# Connected to broker; publish states restored from the snapshot
+def mqtt_connected():
+    for panel in panels.values():
+        if panel.prt:
+            panel.prt.publish_stale()
 
 # Read config file
 config_filename = args.config
@@ -291,6 +396,24 @@ except:
     type, value, traceback = sys.exc_info()
     log.error("Unable to read configuration: %s" % (value))
 
+# Validate configuration (all problems are reported at once); options not
+# specific to a panel (queue, mode, debug, metrics) are taken from the
+# first panel, which has them from the top level
+try:
+    panel_configs = compile_panels(config, prt3_schema)
+except ConfigError as e:
+    for error in e.errors:
+        log.error("Invalid configuration: %s" % (error))
+    sys.exit(1)
+config = panel_configs[0][1]
+for panel_id, panel_config in panel_configs:
+    panels[panel_id] = Panel(panel_id, panel_config)
+
+if panel_configs[0][0] == None:
+    topic_request_regex = re.compile("^" + re.escape(config.topics.requests) + "/(?P<panel>)(?P<user>[^/]+)/(?P<operation>[^/]+)$")
+else:
+    topic_request_regex = re.compile("^" + re.escape(config.topics.requests) + "/(?P<panel>[^/]+)/(?P<user>[^/]+)/(?P<operation>[^/]+)$")
+
 # Set loglevel
 loglevel_string = get_config(config, "debug.loglevel").upper()
 try:
@@ -319,18 +442,121 @@ if get_config(config, "debug.enabled"):
         log.debug("Waiting for debugger to attach")
         ptvsd.wait_for_attach()
 
-# Init MQTT queue and set callback
-queue = Client(config, mqtt_callback)
-
-# Init PRT3 processor and set callback
-prt = PRT(config, prt3_event_callback)
+# Main loop of one panel (blocking serial reads)
+def panel_loop(panel):
+    prt = panel.prt
+    last_metrics = time.time()
+    metrics_interval = get_config_default(panel.config, "metrics.interval", 60)
+
+    while (not can_exit):
+        next_sync = prt.next_sync()
+        if (next_sync != None) and (time.time() >= next_sync):
+            prt.panel_sync()
+            next_sync = prt.next_sync()
+        if metrics_interval and ((time.time() - last_metrics) >= metrics_interval):
+            panel.publish_metrics()
+            last_metrics = time.time()
+        prt.checkpoint()
+        panel.channel.send_snapshot()
+
+        # Read serial port until the next refresh is due (at most 0.5 s so
+        # MQTT requests get the port in time)
+        timeout = 0.5
+        if next_sync != None:
+            timeout = max(0.0, min(timeout, next_sync - time.time()))
+        prt.loop(timeout)
+
+    panel.flush()
+
+# Main loop (one thread per panel; MQTT on paho network thread)
+def main():
+    global queue
 
-# Main loop
-while (not can_exit):
-    if (last_sync == None) or ((time.time() - last_sync) >= 10):
-        prt.panel_sync()
-        last_sync = time.time()
-    prt.loop()
+    # Init PRT3 processors
+    for panel in panels.values():
+        panel.open()
+
+    # Init MQTT queue and set callback
+    queue = Client(config, mqtt_callback, connect_callback = mqtt_connected)
+    for panel in panels.values():
+        panel.attach(queue, start_timer)
+    queue.start()
+
+    threads = [threading.Thread(target = panel_loop, args = (panel,), name = "panel-%s" % (panel.id or "main"), daemon = True) for panel in panels.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.5)
+
+    drain_deadline = time.time() + drain_timeout
+    while queue.pending() and (time.time() < drain_deadline):
+        time.sleep(0.05)
+    queue.close()
+    for panel in panels.values():
+        panel.prt.close()
+
+# Main loop (asyncio; serial ports, panel sync and MQTT on a single event loop)
+async def panel_sync_task(panel):
+    while True:
+        await panel.prt.panel_sync()
+
+        # Sleep until the next entity is due for refresh
+        await panel.prt.wait_sync()
+
+async def metrics_task(panel, interval):
+    while True:
+        await asyncio.sleep(interval)
+        panel.publish_metrics()
+
+async def snapshot_task(panel):
+    while True:
+        await asyncio.sleep(1)
+        panel.prt.checkpoint()
+        panel.channel.send_snapshot()
+
+async def main_async():
+    global loop
+    global exit_event
+    global queue
 
-queue.close()
-prt.close()
+    loop = asyncio.get_running_loop()
+    exit_event = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, exit_gracefully, signal.SIGINT, None)
+
+    # Init PRT3 processors
+    for panel in panels.values():
+        panel.open(loop)
+
+    # Init MQTT queue and set callback
+    queue = Client(config, mqtt_callback, loop, connect_callback = mqtt_connected)
+    for panel in panels.values():
+        panel.attach(queue, loop.call_later)
+    queue.start()
+
+    tasks = []
+    for panel in panels.values():
+        tasks.append(loop.create_task(panel_sync_task(panel)))
+        tasks.append(loop.create_task(snapshot_task(panel)))
+        metrics_interval = get_config_default(panel.config, "metrics.interval", 60)
+        if metrics_interval:
+            tasks.append(loop.create_task(metrics_task(panel, metrics_interval)))
+
+    await exit_event.wait()
+    for task in tasks:
+        task.cancel()
+
+    for panel in panels.values():
+        panel.flush()
+    drain_deadline = time.time() + drain_timeout
+    while queue.pending() and (time.time() < drain_deadline):
+        await asyncio.sleep(0.05)
+    queue.close()
+    for panel in panels.values():
+        panel.prt.close()
+
+if get_config_default(config, "mode", "thread") == "asyncio":
+    log.info("Running in asyncio mode")
+    asyncio.run(main_async())
+else:
+    main()